@@ -24,8 +24,10 @@ class MMDToolsHelperPanel(bpy.types.Panel):
 	def draw(self, context):
 		layout = self.layout
 		row = layout.row()
+		multi_model.draw_model_operators(layout, context)
 
 from . import model
+from . import bone_maps
 from . import mmd_view
 from . import mmd_lamp_setup
 from . import convert_to_blender_camera
@@ -36,8 +38,15 @@ from . import armature_diagnostic
 from . import add_foot_leg_ik
 from . import add_hand_arm_ik
 from . import display_panel_groups
+from . import toon_ramp_cache
+from . import texture_resolver
+from . import bone_graph
 from . import toon_textures_to_node_editor_shader
 from . import toon_modifier
+from . import material_dedup
+from . import texture_atlas
+from . import image_dedup
+from . import multi_model
 from . import reverse_japanese_english
 from . import miscellaneous_tools
 from . import blender_bone_names_to_japanese_bone_names
@@ -45,6 +54,7 @@ from . import blender_bone_names_to_japanese_bone_names
 
 import importlib
 importlib.reload(model)
+importlib.reload(bone_maps)
 importlib.reload(mmd_view)
 importlib.reload(mmd_lamp_setup)
 importlib.reload(convert_to_blender_camera)
@@ -55,8 +65,15 @@ importlib.reload(armature_diagnostic)
 importlib.reload(add_foot_leg_ik)
 importlib.reload(add_hand_arm_ik)
 importlib.reload(display_panel_groups)
+importlib.reload(toon_ramp_cache)
+importlib.reload(texture_resolver)
+importlib.reload(bone_graph)
 importlib.reload(toon_textures_to_node_editor_shader)
 importlib.reload(toon_modifier)
+importlib.reload(material_dedup)
+importlib.reload(texture_atlas)
+importlib.reload(image_dedup)
+importlib.reload(multi_model)
 importlib.reload(reverse_japanese_english)
 importlib.reload(miscellaneous_tools)
 importlib.reload(blender_bone_names_to_japanese_bone_names)
@@ -65,6 +82,7 @@ importlib.reload(blender_bone_names_to_japanese_bone_names)
 
 def register():
 	bpy.utils.register_class(MMDToolsHelperPanel)
+	model.register()
 	mmd_view.register()
 	mmd_lamp_setup.register()
 	convert_to_blender_camera.register()
@@ -77,6 +95,10 @@ def register():
 	display_panel_groups.register()
 	toon_textures_to_node_editor_shader.register()
 	toon_modifier.register()
+	material_dedup.register()
+	texture_atlas.register()
+	image_dedup.register()
+	multi_model.register()
 	reverse_japanese_english.register()
 	miscellaneous_tools.register()
 	blender_bone_names_to_japanese_bone_names.register()
@@ -84,6 +106,7 @@ def register():
 
 def unregister():
 	bpy.utils.unregister_class(MMDToolsHelperPanel)
+	model.unregister()
 	mmd_view.unregister()
 	mmd_lamp_setup.unregister()
 	convert_to_blender_camera.unregister()
@@ -96,6 +119,10 @@ def unregister():
 	display_panel_groups.unregister()
 	toon_textures_to_node_editor_shader.unregister()
 	toon_modifier.unregister()
+	material_dedup.unregister()
+	texture_atlas.unregister()
+	image_dedup.unregister()
+	multi_model.unregister()
 	reverse_japanese_english.unregister()
 	miscellaneous_tools.unregister()
 	blender_bone_names_to_japanese_bone_names.unregister()
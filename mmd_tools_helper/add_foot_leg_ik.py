@@ -1,6 +1,7 @@
 import bpy
 import math
 from . import model
+from . import bone_graph
 
 print("add_foot_leg_ik-->")
 
@@ -83,11 +84,11 @@ def clear_IK(context):
                         IK_target_bones.append(constraint.subtarget)
 
     # 收集 IK 尖端骨骼
+    graph = bone_graph.BoneGraph(armature_obj.data)
     for bone_name in IK_target_bones:
-        if bone_name in armature_obj.data.bones:
-            for child in armature_obj.data.bones[bone_name].children:
-                if child.name not in IK_target_tip_bones:
-                    IK_target_tip_bones.append(child.name)
+        for child_name in graph.children_names(bone_name):
+            if child_name not in IK_target_tip_bones:
+                IK_target_tip_bones.append(child_name)
 
     # 删除 IK 骨骼
     bones_to_delete = set(IK_target_bones + IK_target_tip_bones)
@@ -132,7 +133,9 @@ def main(context):
     english = ["knee_L", "knee_R", "ankle_L", "ankle_R", "toe_L", "toe_R"]
     japanese = ["左ひざ", "右ひざ", "左足首", "右足首", "左つま先", "右つま先"]
     japanese_L_R = ["ひざ.L", "ひざ.R", "足首.L", "足首.R", "つま先.L", "つま先.R"]
-    bone_keys = armature_obj.data.bones.keys()
+    # 骨骼层级快照（名称索引、长度等），只读取一次
+    graph = bone_graph.BoneGraph(armature_obj.data)
+    bone_keys = graph.index
 
     # 检测骨骼语言类型
     has_english = all(b in bone_keys for b in english)
@@ -193,8 +196,7 @@ def main(context):
         raise Exception(f"无法设置膝盖 IK 限制: {str(e)}")
 
     # 计算骨骼长度（基于脚踝骨骼）
-    ankle_bone = armature_obj.data.bones[ANKLE_LEFT]
-    LENGTH = ankle_bone.length
+    LENGTH = float(graph.length[graph.index[ANKLE_LEFT]])
     HALF_LENGTH = LENGTH * 0.5
     TIP_LENGTH = LENGTH * 0.05  # 尖端骨骼长度
 
@@ -1,6 +1,7 @@
 import bpy
 import math
 from . import model  # 依赖外部model模块，需确保该模块存在且适配3.6
+from . import bone_graph
 
 class Add_MMD_Hand_Arm_IK_Panel(bpy.types.Panel):
     """Add hand and arm IK bones and constraints to active MMD model"""
@@ -44,11 +45,12 @@ def clear_IK(context):
                             if constraint.subtarget not in IK_target_bones:
                                 IK_target_bones.append(constraint.subtarget)
     
+    # 骨骼层级快照，查询子骨骼不再逐个访问RNA
+    graph = bone_graph.BoneGraph(armature.data)
     for b_name in IK_target_bones:
-        if b_name in armature.pose.bones:
-            for child_bone in armature.pose.bones[b_name].children:
-                if child_bone.name not in IK_target_tip_bones:
-                    IK_target_tip_bones.append(child_bone.name)
+        for child_name in graph.children_names(b_name):
+            if child_name not in IK_target_tip_bones:
+                IK_target_tip_bones.append(child_name)
     
     bones_to_be_deleted = set(IK_target_bones + IK_target_tip_bones)
     print("bones to be deleted = ", bones_to_be_deleted)
@@ -110,28 +112,21 @@ def main(context):
     WRIST_LEFT_BONE = ["左中指１", "中指１.L", "middle1_L"]
     WRIST_RIGHT_BONE = ["右中指１", "中指１.R", "middle1_R"]
 
-    ARM_LEFT = ARM_RIGHT = ELBOW_LEFT = ELBOW_RIGHT = WRIST_LEFT = WRIST_RIGHT = None
-
+    # 一次读取骨骼层级快照，按名称索引查找目标骨骼
+    graph = bone_graph.BoneGraph(armature.data)
     print('\nSearching for target bones...')
-    for b in armature.data.bones:
-        if b.name in ARM_LEFT_BONE:
-            ARM_LEFT = b.name
-            print(f'ARM_LEFT = {ARM_LEFT}')
-        if b.name in ARM_RIGHT_BONE:
-            ARM_RIGHT = b.name
-            print(f'ARM_RIGHT = {ARM_RIGHT}')
-        if b.name in ELBOW_LEFT_BONE:
-            ELBOW_LEFT = b.name
-            print(f'ELBOW_LEFT = {ELBOW_LEFT}')
-        if b.name in ELBOW_RIGHT_BONE:
-            ELBOW_RIGHT = b.name
-            print(f'ELBOW_RIGHT = {ELBOW_RIGHT}')
-        if b.name in WRIST_LEFT_BONE:
-            WRIST_LEFT = b.name
-            print(f'WRIST_LEFT = {WRIST_LEFT}')
-        if b.name in WRIST_RIGHT_BONE:
-            WRIST_RIGHT = b.name
-            print(f'WRIST_RIGHT = {WRIST_RIGHT}')
+    ARM_LEFT = graph.find(ARM_LEFT_BONE)
+    ARM_RIGHT = graph.find(ARM_RIGHT_BONE)
+    ELBOW_LEFT = graph.find(ELBOW_LEFT_BONE)
+    ELBOW_RIGHT = graph.find(ELBOW_RIGHT_BONE)
+    WRIST_LEFT = graph.find(WRIST_LEFT_BONE)
+    WRIST_RIGHT = graph.find(WRIST_RIGHT_BONE)
+    print(f'ARM_LEFT = {ARM_LEFT}')
+    print(f'ARM_RIGHT = {ARM_RIGHT}')
+    print(f'ELBOW_LEFT = {ELBOW_LEFT}')
+    print(f'ELBOW_RIGHT = {ELBOW_RIGHT}')
+    print(f'WRIST_LEFT = {WRIST_LEFT}')
+    print(f'WRIST_RIGHT = {WRIST_RIGHT}')
 
     missing_bones = []
     if not ARM_LEFT: missing_bones.append("ARM_LEFT (elbow_L/左ひじ/ひじ.L)")
@@ -144,7 +139,16 @@ def main(context):
     if missing_bones:
         raise Exception(f"Missing required bones: {', '.join(missing_bones)}")
 
-    elbow_length = armature.data.bones[ELBOW_LEFT].length
+    # 用骨骼层级快照确认IK链：肘IK带动手肘和上臂两节，中指IK只带动手腕一节
+    ik_chains = {}
+    for b_name, chain_count in ((ARM_LEFT, 2), (ARM_RIGHT, 2), (ELBOW_LEFT, 1), (ELBOW_RIGHT, 1)):
+        chain = [graph.names[i] for i in graph.chain(graph.index[b_name], chain_count)]
+        if len(chain) < chain_count:
+            raise Exception(f"IK chain of {b_name} needs {chain_count} bones, found: {', '.join(chain)}")
+        print(f'IK chain of {b_name} = {chain}')
+        ik_chains[b_name] = chain
+
+    elbow_length = float(graph.length[graph.index[ELBOW_LEFT]])
     DOUBLE_LENGTH_OF_ELBOW_BONE = elbow_length * 2
     TWENTIETH_LENGTH_OF_ELBOW_BONE = elbow_length * 0.05
 
@@ -208,10 +212,10 @@ def main(context):
         ik_const.use_tail = True
         ik_const.iterations = iterations
 
-    add_ik_constraint(ARM_LEFT, "elbow_IK_L", chain_count=2)
-    add_ik_constraint(ARM_RIGHT, "elbow_IK_R", chain_count=2)
-    add_ik_constraint(ELBOW_LEFT, "middle1_IK_L", chain_count=1, iterations=6)
-    add_ik_constraint(ELBOW_RIGHT, "middle1_IK_R", chain_count=1, iterations=6)
+    add_ik_constraint(ARM_LEFT, "elbow_IK_L", chain_count=len(ik_chains[ARM_LEFT]))
+    add_ik_constraint(ARM_RIGHT, "elbow_IK_R", chain_count=len(ik_chains[ARM_RIGHT]))
+    add_ik_constraint(ELBOW_LEFT, "middle1_IK_L", chain_count=len(ik_chains[ELBOW_LEFT]), iterations=6)
+    add_ik_constraint(ELBOW_RIGHT, "middle1_IK_R", chain_count=len(ik_chains[ELBOW_RIGHT]), iterations=6)
 
     for bone_name in [ARM_LEFT, ARM_RIGHT, ELBOW_LEFT, ELBOW_RIGHT]:
         if hasattr(armature.pose.bones[bone_name], "mmd_bone"):
@@ -1,5 +1,5 @@
 import bpy
-from . import import_csv
+from . import bone_maps
 from . import model
 
 
@@ -24,25 +24,9 @@ class ArmatureDiagnosticPanel(bpy.types.Panel):
 
 
 def main(context):
-	missing_bone_names = []
-	BONE_NAMES_DICTIONARY = import_csv.use_csv_bones_dictionary()
-	FINGER_BONE_NAMES_DICTIONARY = import_csv.use_csv_bones_fingers_dictionary()
 	SelectedBoneMap = bpy.context.scene.selected_armature_to_diagnose
-	BoneMapIndex = BONE_NAMES_DICTIONARY[0].index(SelectedBoneMap)
-	FingerBoneMapIndex = FINGER_BONE_NAMES_DICTIONARY[0].index(SelectedBoneMap)
-	bpy.context.scene.objects.active = model.findArmature(bpy.context.active_object)
-	for b in BONE_NAMES_DICTIONARY:
-		if BONE_NAMES_DICTIONARY.index(b) != 0:
-			if b[BoneMapIndex] != '':
-				if b[BoneMapIndex] not in ["upper body 2", "上半身2"]:
-					if b[BoneMapIndex] not in bpy.context.active_object.data.bones.keys():
-						missing_bone_names.append(b[BoneMapIndex])
-	for b in FINGER_BONE_NAMES_DICTIONARY:
-		if FINGER_BONE_NAMES_DICTIONARY.index(b) != 0:
-			if b[FingerBoneMapIndex] != '':
-				if b[FingerBoneMapIndex] not in ["thumb0_L", "thumb0_R", "左親指0", "親指0.L", "右親指0", "親指0.R"]:
-					if b[FingerBoneMapIndex] not in bpy.context.active_object.data.bones.keys():
-						missing_bone_names.append(b[FingerBoneMapIndex])
+	bpy.context.view_layer.objects.active = model.findArmature(bpy.context.active_object)
+	missing_bone_names = bone_maps.missing_bone_names(bpy.context.active_object.data.bones.keys(), SelectedBoneMap)
 	print("\nSelected diagnostic bone map is:")
 	print(SelectedBoneMap)
 	print("These bone names of", SelectedBoneMap, "are missing from the active armature:" )
@@ -64,7 +48,7 @@ class ArmatureDiagnostic(bpy.types.Operator):
 		return context.active_object is not None
 
 	def execute(self, context):
-		bpy.context.scene.objects.active = model.findArmature(bpy.context.active_object)
+		bpy.context.view_layer.objects.active = model.findArmature(bpy.context.active_object)
 		print()
 		print()
 		print(bpy.context.active_object.name, "all bone names")
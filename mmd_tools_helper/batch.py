@@ -0,0 +1,231 @@
+# Headless batch conversion of whole model libraries.
+#
+# Runs a configured sequence of the add-on's operators on every model file of a
+# directory or manifest, saving each converted model as a .blend file with a
+# per-file json report next to it. Sub-directories of the input are mirrored
+# under the output directory.
+#
+# Usage (mmd_tools and mmd_tools_helper must be installed):
+#
+#   blender -b --addons mmd_tools,mmd_tools_helper --python-expr "from mmd_tools_helper import batch; batch.main()" -- --input models/ --output converted/ --steps rename_bones,foot_leg_ik,hand_arm_ik
+#
+# --input is a directory (searched for .pmx, .pmd and .blend files) or a manifest:
+# a .txt file with one path per line or a .json file containing a list of paths.
+#
+# With --worker, file paths are read from stdin instead and one report line is
+# printed per file; this is how batch_pool.py drives several Blender processes.
+
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+
+import bpy
+from . import model
+from . import boneMaps_renamer
+from .batch_pool import find_model_files, input_root, summarize_reports, write_summary, RESULT_PREFIX
+
+DEFAULT_STEPS = ['rename_bones', 'foot_leg_ik', 'hand_arm_ik', 'display_panel_groups', 'toon_nodes']
+
+
+def load_model(filepath):
+	"""Loads a model file into a clean session and returns the MMD root objects"""
+	if filepath.lower().endswith('.blend'):
+		bpy.ops.wm.open_mainfile(filepath=filepath)
+	else:
+		bpy.ops.wm.read_homefile(use_empty=True)
+		bpy.ops.mmd_tools.import_model(filepath=filepath)
+	return [o for o in bpy.context.scene.objects if getattr(o, 'mmd_type', None) == 'ROOT']
+
+
+# Each step runs one of the add-on's operators on one MMD model, exactly as
+# the corresponding button of the N-panel does, and returns the operator result.
+
+def step_rename_bones(root, options):
+	armature = model.armature(root)
+	model.activate(armature)
+	scene = bpy.context.scene
+	if options.origin == 'auto':
+		detected = boneMaps_renamer.detect_origin_armature_type(armature)
+		if not detected:
+			raise RuntimeError("Could not detect the armature type")
+		scene.Origin_Armature_Type = detected[0].bone_map
+	else:
+		scene.Origin_Armature_Type = options.origin
+	scene.Destination_Armature_Type = options.destination
+	return bpy.ops.object.bones_renamer()
+
+
+def step_foot_leg_ik(root, options):
+	model.activate(model.armature(root))
+	return bpy.ops.object.add_foot_leg_ik()
+
+
+def step_hand_arm_ik(root, options):
+	model.activate(model.armature(root))
+	return bpy.ops.object.add_hand_arm_ik()
+
+
+def step_display_panel_groups(root, options):
+	model.activate(model.armature(root))
+	bpy.context.scene.display_panel_options = options.display_panel_option
+	return bpy.ops.object.add_display_panel_groups()
+
+
+def step_toon_nodes(root, options):
+	meshes = list(model.meshes(root))
+	if len(meshes) == 0:
+		raise RuntimeError("The model has no meshes")
+	model.activate(meshes[0])
+	return bpy.ops.mmd_tools_helper.mmd_toon_render_node_editor()
+
+
+def step_material_dedup(root, options):
+	model.activate(model.armature(root))
+	return bpy.ops.mmd_tools_helper.material_dedup()
+
+
+def step_image_dedup(root, options):
+	return bpy.ops.mmd_tools_helper.image_dedup()
+
+
+STEPS = {
+	'rename_bones': step_rename_bones,
+	'foot_leg_ik': step_foot_leg_ik,
+	'hand_arm_ik': step_hand_arm_ik,
+	'display_panel_groups': step_display_panel_groups,
+	'material_dedup': step_material_dedup,
+	'image_dedup': step_image_dedup,
+	'toon_nodes': step_toon_nodes,
+	}
+
+
+def output_name(filepath, options):
+	"""Returns the output path of a model file without extension. The directories of the
+	file below options.input_root are mirrored, so files with the same name do not collide."""
+	name = os.path.splitext(os.path.basename(filepath))[0]
+	if options.input_root:
+		relative = os.path.relpath(os.path.abspath(filepath), options.input_root)
+		if relative != os.pardir and not relative.startswith(os.pardir + os.sep):
+			name = os.path.splitext(relative)[0]
+	path = os.path.join(options.output, name)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	return path
+
+
+def output_path(filepath, options):
+	return output_name(filepath, options) + ".blend"
+
+
+def convert_file(filepath, options):
+	"""Runs the configured steps on every model of one file and saves the result.
+	Returns the report of the file as a dict."""
+	report = {'file': filepath, 'output': None, 'status': 'ok', 'error': None, 'models': [], 'seconds': 0.0}
+	start = time.perf_counter()
+	try:
+		roots = load_model(filepath)
+		if len(roots) == 0:
+			raise RuntimeError("No MMD model found")
+		for root in roots:
+			model_report = {'name': root.name, 'steps': []}
+			report['models'].append(model_report)
+			for step in options.steps:
+				step_start = time.perf_counter()
+				step_report = {'step': step, 'status': 'ok', 'error': None}
+				try:
+					result = STEPS[step](root, options)
+					if 'FINISHED' not in result:
+						step_report['status'] = 'cancelled'
+				except Exception as e:
+					step_report['status'] = 'error'
+					step_report['error'] = str(e)
+				step_report['seconds'] = round(time.perf_counter() - step_start, 4)
+				model_report['steps'].append(step_report)
+				if step_report['status'] != 'ok':
+					report['status'] = 'partial'
+					if options.stop_on_error:
+						break
+		if bpy.context.mode != 'OBJECT':
+			bpy.ops.object.mode_set(mode='OBJECT')
+		out = output_path(filepath, options)
+		bpy.ops.wm.save_as_mainfile(filepath=out, copy=True)
+		report['output'] = out
+	except Exception as e:
+		report['status'] = 'error'
+		report['error'] = str(e)
+		report['traceback'] = traceback.format_exc()
+	report['seconds'] = round(time.perf_counter() - start, 4)
+	return report
+
+
+def write_report(report, options):
+	with open(output_name(report['file'], options) + ".report.json", 'w', encoding='utf-8') as f:
+		json.dump(report, f, ensure_ascii=False, indent=1)
+
+
+def run(files, options):
+	"""Converts a list of model files, writing a report per file and a summary. Returns the list of reports."""
+	os.makedirs(options.output, exist_ok=True)
+	reports = []
+	for filepath in files:
+		print("mmd_tools_helper batch:", filepath)
+		report = convert_file(filepath, options)
+		write_report(report, options)
+		print("mmd_tools_helper batch:", report['status'], report['seconds'], "s", report['error'] or '')
+		reports.append(report)
+	write_summary(summarize_reports(reports), options.output)
+	return reports
+
+
+def serve(options):
+	"""Worker mode: converts the files named on stdin, one per line, until stdin is closed"""
+	os.makedirs(options.output, exist_ok=True)
+	for line in sys.stdin:
+		filepath = line.strip()
+		if filepath == '':
+			continue
+		report = convert_file(filepath, options)
+		write_report(report, options)
+		sys.stdout.write(RESULT_PREFIX + json.dumps(report, ensure_ascii=False) + "\n")
+		sys.stdout.flush()
+
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(prog="mmd_tools_helper.batch", description="Batch convert MMD models with mmd_tools_helper")
+	parser.add_argument('--input', help="directory of model files, or a .txt/.json manifest")
+	parser.add_argument('--output', required=True, help="directory for the converted .blend files and reports")
+	parser.add_argument('--recursive', action='store_true', help="also search sub-directories of --input")
+	parser.add_argument('--input-root', help="directory whose sub-directories are mirrored under --output (default: --input, or the common directory of a manifest's files)")
+	parser.add_argument('--steps', default=','.join(DEFAULT_STEPS), help="comma separated steps: " + ', '.join(STEPS))
+	parser.add_argument('--origin', default='auto', help="bone map of the source armatures, or 'auto' to detect it per model")
+	parser.add_argument('--destination', default='mmd_english', help="bone map to rename bones to")
+	parser.add_argument('--display-panel-option', default='add_display_panel_groups', choices=['no_change', 'display_panel_groups_from_bone_groups', 'add_display_panel_groups'])
+	parser.add_argument('--stop-on-error', action='store_true', help="skip the remaining steps of a model after a failed step")
+	parser.add_argument('--worker', action='store_true', help="read file paths from stdin (used by batch_pool)")
+	options = parser.parse_args(argv)
+	if options.input is None and not options.worker:
+		parser.error("--input is required")
+	options.steps = [s.strip() for s in options.steps.split(',') if s.strip() != '']
+	for s in options.steps:
+		if s not in STEPS:
+			parser.error("unknown step: " + s)
+	return options
+
+
+def main(argv=None):
+	"""Entry point for blender -b ... -- <arguments>"""
+	if argv is None:
+		argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+	options = parse_args(argv)
+	if options.worker:
+		serve(options)
+		return 0
+	files = find_model_files(options.input, options.recursive)
+	if options.input_root is None:
+		options.input_root = input_root(options.input, files)
+	reports = run(files, options)
+	failed = sum(1 for r in reports if r['status'] == 'error')
+	print("mmd_tools_helper batch: converted", len(reports) - failed, "of", len(reports), "files")
+	return 1 if failed else 0
@@ -0,0 +1,263 @@
+# Multi-process driver for the headless batch runner (batch.py).
+#
+# A single Blender process edits data on one thread only, so this driver starts
+# several headless Blender workers and feeds them model files from one shared
+# queue, largest files first so that the long conversions do not end up last.
+# Each idle worker takes the next file from the queue. A worker which crashes
+# or hangs is restarted and its file is retried. The per-model reports of all
+# workers are aggregated into one batch_summary.json.
+#
+# This module does not use bpy and runs as a script with any Python 3
+# interpreter, without importing the add-on package:
+#
+#   python mmd_tools_helper/batch_pool.py --blender /path/to/blender --workers 16 --input models/ --output converted/ -- --steps rename_bones,foot_leg_ik
+#
+# Arguments after "--" are passed to every worker's batch.main().
+
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+RESULT_PREFIX = "MTH_RESULT "
+
+MODEL_EXTENSIONS = ('.pmx', '.pmd', '.blend')
+
+
+def find_model_files(input_path, recursive=False):
+	"""Returns the model files of a directory, or the files listed in a manifest
+	(a .txt file with one path per line or a .json file containing a list of paths)"""
+	if os.path.isdir(input_path):
+		files = []
+		for dirpath, dirnames, filenames in os.walk(input_path):
+			dirnames.sort()
+			for f in sorted(filenames):
+				if f.lower().endswith(MODEL_EXTENSIONS):
+					files.append(os.path.join(dirpath, f))
+			if not recursive:
+				break
+		return files
+	base = os.path.dirname(os.path.abspath(input_path))
+	with open(input_path, encoding='utf-8') as manifest:
+		if input_path.lower().endswith('.json'):
+			entries = json.load(manifest)
+		else:
+			entries = [line.strip() for line in manifest if line.strip() != '' and not line.lstrip().startswith('#')]
+	return [os.path.join(base, e) for e in entries]
+
+
+def input_root(input_path, files):
+	"""Returns the directory whose structure is mirrored under the output directory:
+	the input directory, or the deepest directory containing every file of a manifest"""
+	if os.path.isdir(input_path):
+		return os.path.abspath(input_path)
+	if len(files) == 0:
+		return os.path.dirname(os.path.abspath(input_path))
+	return os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files])
+
+
+def summarize_reports(reports, **extra):
+	summary = {
+		'files': len(reports),
+		'ok': sum(1 for r in reports if r['status'] == 'ok'),
+		'partial': sum(1 for r in reports if r['status'] == 'partial'),
+		'error': sum(1 for r in reports if r['status'] == 'error'),
+		'seconds': round(sum(r['seconds'] for r in reports), 4),
+		}
+	summary.update(extra)
+	summary['reports'] = [{'file': r['file'], 'status': r['status'], 'seconds': r['seconds'], 'error': r['error']} for r in reports]
+	return summary
+
+
+def write_summary(summary, output):
+	with open(os.path.join(output, "batch_summary.json"), 'w', encoding='utf-8') as f:
+		json.dump(summary, f, ensure_ascii=False, indent=1)
+
+
+def file_size(filepath):
+	try:
+		return os.path.getsize(filepath)
+	except OSError:
+		return 0
+
+
+# default per-file timeout: DEFAULT_TIMEOUT seconds plus DEFAULT_TIMEOUT_PER_MB per megabyte of the file
+DEFAULT_TIMEOUT = 300.0
+DEFAULT_TIMEOUT_PER_MB = 30.0
+
+
+def file_timeout(filepath, options):
+	"""Returns the seconds after which the worker converting a file is killed, or None with --timeout 0"""
+	if not options.timeout:
+		return None
+	return options.timeout + getattr(options, 'timeout_per_mb', DEFAULT_TIMEOUT_PER_MB) * file_size(filepath) / (1024 * 1024)
+
+
+class Worker:
+	"""One headless Blender process converting the files it is sent on stdin"""
+
+	def __init__(self, number, command, log_path):
+		self.number = number
+		self.command = command
+		self.log_path = log_path
+		self.process = None
+		self.log = None
+		self.started = 0
+
+	def start(self):
+		if self.log is None:
+			self.log = open(self.log_path, 'a', encoding='utf-8')
+		self.process = subprocess.Popen(
+			self.command,
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.STDOUT,
+			encoding='utf-8',
+			errors='replace',
+			bufsize=1,
+			)
+		self.started += 1
+
+	def alive(self):
+		return self.process is not None and self.process.poll() is None
+
+	def convert(self, filepath, timeout=None):
+		"""Sends one file to the worker and waits for its report.
+		Returns None if the worker died or timed out before reporting."""
+		timer = None
+		if timeout:
+			timer = threading.Timer(timeout, self.kill)
+			timer.start()
+		try:
+			self.process.stdin.write(filepath + "\n")
+			self.process.stdin.flush()
+			for line in self.process.stdout:
+				if line.startswith(RESULT_PREFIX):
+					return json.loads(line[len(RESULT_PREFIX):])
+				self.log.write(line)
+			return None
+		except (BrokenPipeError, OSError, ValueError):
+			return None
+		finally:
+			if timer is not None:
+				timer.cancel()
+
+	def kill(self):
+		if self.alive():
+			self.process.kill()
+
+	def stop(self):
+		if self.alive():
+			try:
+				self.process.stdin.close()
+				self.process.wait(timeout=30)
+			except (OSError, subprocess.TimeoutExpired):
+				self.process.kill()
+		if self.log is not None:
+			self.log.close()
+			self.log = None
+
+
+def worker_command(options, worker_args):
+	expr = "from %s import batch; batch.main()" % options.addon_module
+	command = [options.blender, '-b', '--addons', 'mmd_tools,' + options.addon_module, '--python-expr', expr, '--', '--worker', '--output', options.output]
+	if getattr(options, 'input_root', None):
+		command += ['--input-root', options.input_root]
+	return command + worker_args
+
+
+def run(files, options, worker_args):
+	"""Converts files with options.workers Blender processes. Returns the summary dict."""
+	os.makedirs(options.output, exist_ok=True)
+	jobs = queue.Queue()
+	for filepath in sorted(files, key=file_size, reverse=True):
+		jobs.put((filepath, 0))
+	reports = []
+	reports_lock = threading.Lock()
+	crashes = []
+	command = worker_command(options, worker_args)
+
+	def serve(number):
+		worker = Worker(number, command, os.path.join(options.output, "worker-%d.log" % number))
+		try:
+			while True:
+				try:
+					filepath, attempt = jobs.get_nowait()
+				except queue.Empty:
+					return
+				if not worker.alive():
+					worker.start()
+				start = time.perf_counter()
+				report = worker.convert(filepath, file_timeout(filepath, options))
+				if report is None:
+					seconds = round(time.perf_counter() - start, 4)
+					worker.kill()
+					with reports_lock:
+						crashes.append({'file': filepath, 'worker': number, 'attempt': attempt, 'seconds': seconds})
+					print("mmd_tools_helper batch_pool: worker", number, "died on", filepath, flush=True)
+					if attempt < options.retries:
+						jobs.put((filepath, attempt + 1))
+						continue
+					report = {'file': filepath, 'output': None, 'status': 'error', 'error': "worker crashed or timed out", 'models': [], 'seconds': seconds}
+				report['worker'] = number
+				with reports_lock:
+					reports.append(report)
+					done = len(reports)
+				print("mmd_tools_helper batch_pool: [%d/%d]" % (done, len(files)), report['status'], report['seconds'], "s", filepath, flush=True)
+		finally:
+			worker.stop()
+
+	start = time.perf_counter()
+	threads = [threading.Thread(target=serve, args=(n,), daemon=True) for n in range(max(1, options.workers))]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	summary = summarize_reports(
+		reports,
+		workers=len(threads),
+		wall_seconds=round(time.perf_counter() - start, 4),
+		crashes=crashes,
+		)
+	write_summary(summary, options.output)
+	return summary
+
+
+def parse_args(argv):
+	if '--' in argv:
+		worker_args = argv[argv.index('--') + 1:]
+		argv = argv[:argv.index('--')]
+	else:
+		worker_args = []
+	parser = argparse.ArgumentParser(prog="mmd_tools_helper.batch_pool", description="Batch convert MMD models with several headless Blender processes")
+	parser.add_argument('--blender', default='blender', help="path of the Blender executable")
+	parser.add_argument('--addon-module', default=__package__ or 'mmd_tools_helper', help="module name of the installed mmd_tools_helper add-on")
+	parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="number of Blender processes")
+	parser.add_argument('--retries', type=int, default=1, help="how many times a file is retried after its worker crashed")
+	parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="seconds after which a worker converting one file is killed and the file retried, plus --timeout-per-mb for each megabyte of the file (0: no timeout)")
+	parser.add_argument('--timeout-per-mb', type=float, default=DEFAULT_TIMEOUT_PER_MB, help="seconds added to --timeout per megabyte of the file")
+	parser.add_argument('--input', required=True, help="directory of model files, or a .txt/.json manifest")
+	parser.add_argument('--output', required=True, help="directory for the converted .blend files and reports")
+	parser.add_argument('--recursive', action='store_true', help="also search sub-directories of --input")
+	options = parser.parse_args(argv)
+	options.output = os.path.abspath(options.output)
+	return options, worker_args
+
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+	options, worker_args = parse_args(argv)
+	files = [os.path.abspath(f) for f in find_model_files(options.input, options.recursive)]
+	options.input_root = input_root(options.input, files)
+	summary = run(files, options, worker_args)
+	print("mmd_tools_helper batch_pool:", summary['ok'], "ok,", summary['partial'], "partial,", summary['error'], "failed of", summary['files'], "files in", summary['wall_seconds'], "s")
+	return 1 if summary['error'] else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,6 +1,6 @@
 import bpy
 from . import model
-from . import import_csv
+from . import bone_maps
 
 # 全局变量：记录已注册的类和属性，确保反注册时精准清理
 _registered_classes = []
@@ -28,8 +28,10 @@ class BonesRenamerPanel_MTH(bpy.types.Panel):
         col.label(text="Mass Rename Bones", icon="ARMATURE_DATA")
         col.separator(factor=1.0)  # 分隔线：提升UI可读性
         
-        # 源骨骼类型选择
-        col.prop(context.scene, "Origin_Armature_Type", text="From")
+        # 源骨骼类型选择（可自动检测）
+        row = col.row(align=True)
+        row.prop(context.scene, "Origin_Armature_Type", text="From")
+        row.operator("object.bones_renamer_detect", text="", icon="VIEWZOOM")
         # 目标骨骼类型选择
         col.prop(context.scene, "Destination_Armature_Type", text="To")
         col.separator(factor=1.0)
@@ -60,24 +62,18 @@ def unhide_all_armatures():
 
 
 def print_missing_bone_names():
-    missing_bone_names = []
+    SelectedBoneMap = bpy.context.scene.Destination_Armature_Type
+    # 修复：检查目标骨骼映射是否存在于字典中
     try:
         # 新增：捕获CSV读取异常（避免CSV文件缺失导致崩溃）
-        BONE_NAMES_DICTIONARY = import_csv.use_csv_bones_dictionary()
-        FINGER_BONE_NAMES_DICTIONARY = import_csv.use_csv_bones_fingers_dictionary()
+        table_headers = [table.columns for table in bone_maps.tables()]
     except Exception as e:
         print(f"Failed to load bone dictionary: {str(e)}")
         return
-    
-    SelectedBoneMap = bpy.context.scene.Destination_Armature_Type
-    # 修复：检查目标骨骼映射是否存在于字典中
-    if SelectedBoneMap not in BONE_NAMES_DICTIONARY[0] or SelectedBoneMap not in FINGER_BONE_NAMES_DICTIONARY[0]:
+    if any(SelectedBoneMap not in columns for columns in table_headers):
         print(f"Destination bone map '{SelectedBoneMap}' not found in dictionary!")
         return
     
-    BoneMapIndex = BONE_NAMES_DICTIONARY[0].index(SelectedBoneMap)
-    FingerBoneMapIndex = FINGER_BONE_NAMES_DICTIONARY[0].index(SelectedBoneMap)
-    
     # 确保激活对象是骨架
     armature = model.findArmature(bpy.context.active_object)
     if not armature:
@@ -85,23 +81,8 @@ def print_missing_bone_names():
         return
     
     bpy.context.view_layer.objects.active = armature
-    armature_bones = armature.data.bones.keys()  # 提前缓存骨骼名称，减少重复查询
-    
-    # 检查主体骨骼
-    for bone_entry in BONE_NAMES_DICTIONARY[1:]:  # 优化：用enumerate替代index()，提升效率
-        bone_name = bone_entry[BoneMapIndex]
-        if (bone_name != '' 
-            and bone_name not in ["upper body 2", "上半身2"] 
-            and bone_name not in armature_bones):
-            missing_bone_names.append(bone_name)
-    
-    # 检查手指骨骼
-    for bone_entry in FINGER_BONE_NAMES_DICTIONARY[1:]:
-        bone_name = bone_entry[FingerBoneMapIndex]
-        if (bone_name != '' 
-            and bone_name not in ["thumb0_L", "thumb0_R", "左親指0", "親指0.L", "右親指0", "親指0.R"] 
-            and bone_name not in armature_bones):
-            missing_bone_names.append(bone_name)
+    # 主体骨骼与手指骨骼（不含MMD半标准骨骼）
+    missing_bone_names = bone_maps.missing_bone_names(armature.data.bones.keys(), SelectedBoneMap)
     
     # 输出结果（优化格式，便于阅读）
     print("\n" + "="*50)
@@ -112,127 +93,180 @@ def print_missing_bone_names():
     print("="*50 + "\n")
 
 
-def rename_bones(boneMap1, boneMap2, BONE_NAMES_DICTIONARY): 
-    boneMaps = BONE_NAMES_DICTIONARY[0]
+def detect_origin_armature_type(armature):
+    """按骨骼名称为所有骨骼映射打分，返回可在 Origin_Armature_Type 中选择的最佳结果列表（最佳在前）"""
+    selectable = {item[0] for item in get_armature_type_items()}
+    scores = bone_maps.detect_armature_type(armature.data.bones.keys())
+    return [d for d in scores if d.bone_map in selectable and d.matched > 0]
+
+
+def collect_bone_renames(armature, boneMap1, boneMap2, bone_map_table):
+    """收集重命名计划 [(旧名称, 新名称, 英文名称或None)]，不修改骨架"""
     # 修复：检查源/目标映射是否有效
-    if boneMap1 not in boneMaps or boneMap2 not in boneMaps:
+    if boneMap1 not in bone_map_table.columns or boneMap2 not in bone_map_table.columns:
         raise ValueError(f"Invalid bone map: From '{boneMap1}' To '{boneMap2}'")
     
-    boneMap1_index = boneMaps.index(boneMap1)
-    boneMap2_index = boneMaps.index(boneMap2)
+    # 若目标是MMD日语骨骼，同时记录英文名称（字典第0列）
+    set_name_e = boneMap2 in ['mmd_japanese', 'mmd_japaneseLR']
     
+    # 优化：每根骨骼只做一次哈希查找（名称 -> 字典行号），不再遍历整个字典
+    src_index = bone_map_table.index[boneMap1]
+    dst_column = bone_map_table.columns[boneMap2]
+    renames = []
+    for src_bone in armature.data.bones.keys():
+        row_id = src_index.get(src_bone)
+        if row_id is None:
+            continue
+        bone_entry = bone_map_table.rows[row_id]
+        dst_bone = bone_entry[dst_column]
+        if dst_bone != '' and src_bone != dst_bone:
+            renames.append((src_bone, dst_bone, bone_entry[0] if set_name_e else None))
+    return renames
+
+
+def apply_bone_renames(armature, renames):
+    """一次性执行重命名计划，返回 (已重命名列表, 跳过列表)
+    
+    交换/循环冲突（A->B 同时 B->A）通过两阶段临时名称解决，
+    避免 Blender 自动添加 .001 后缀导致结果不确定。
+    目标名称已被计划外骨骼占用、或多个骨骼映射到同一名称时跳过。"""
     # 切换到对象模式（骨骼重命名必须在对象模式）
     if bpy.context.mode != 'OBJECT':
         bpy.ops.object.mode_set(mode='OBJECT')
     
-    armature = bpy.context.active_object
-    if armature.type != 'ARMATURE':
-        raise TypeError("Active object is not an armature!")
-    
-    # 优化：批量获取骨骼，减少API调用次数
     armature_bones = armature.data.bones
-    for bone_entry in BONE_NAMES_DICTIONARY[1:]:
-        src_bone = bone_entry[boneMap1_index]
-        dst_bone = bone_entry[boneMap2_index]
-        
-        if src_bone in armature_bones and dst_bone != '' and src_bone != dst_bone:
-            # 重命名骨骼（避免重复命名导致冲突）
-            try:
-                armature_bones[src_bone].name = dst_bone
-            except RuntimeError as e:
-                print(f"Failed to rename {src_bone} to {dst_bone}: {str(e)}")
-                continue
-            
-            # 若目标是MMD日语骨骼，更新mmd_bone属性
-            if boneMap2 in ['mmd_japanese', 'mmd_japaneseLR']:
-                bpy.ops.object.mode_set(mode='POSE')
-                pose_bone = armature.pose.bones.get(dst_bone)
-                if pose_bone and hasattr(pose_bone, "mmd_bone"):
-                    pose_bone.mmd_bone.name_e = bone_entry[0]  # 设置英文名称
-                bpy.ops.object.mode_set(mode='OBJECT')
-
-
-def rename_finger_bones(boneMap1, boneMap2, FINGER_BONE_NAMES_DICTIONARY):
-    # 逻辑与主体骨骼重命名一致，复用检查逻辑
-    boneMaps = FINGER_BONE_NAMES_DICTIONARY[0]
-    if boneMap1 not in boneMaps or boneMap2 not in boneMaps:
-        raise ValueError(f"Invalid finger bone map: From '{boneMap1}' To '{boneMap2}'")
+    existing_names = set(armature_bones.keys())
     
-    boneMap1_index = boneMaps.index(boneMap1)
-    boneMap2_index = boneMaps.index(boneMap2)
+    candidates = []
+    sources = set()
+    for old, new, name_e in renames:
+        if old not in existing_names or old in sources:
+            continue
+        sources.add(old)
+        candidates.append((old, new, name_e))
     
-    if bpy.context.mode != 'OBJECT':
-        bpy.ops.object.mode_set(mode='OBJECT')
+    # 同一目标名称由第一个未被跳过的骨骼获得；目标名称只能是空闲名称或计划内
+    # （会被改走）的源骨骼名称。跳过一项后其源名称不再空出、其目标名称可能
+    # 让给后面的骨骼，因此按最终计划重新检查，直到不再变化
+    conflicts = set()
+    changed = True
+    while changed:
+        changed = False
+        planned = []
+        target_names = set()
+        for i, (old, new, name_e) in enumerate(candidates):
+            if i not in conflicts and new not in target_names:
+                target_names.add(new)
+                planned.append((i, old, new, name_e))
+        planned_sources = {old for i, old, new, name_e in planned}
+        for i, old, new, name_e in planned:
+            if new in existing_names and new not in planned_sources:
+                conflicts.add(i)
+                changed = True
+    
+    planned_indices = {i for i, old, new, name_e in planned}
+    skipped = []
+    for i, (old, new, name_e) in enumerate(candidates):
+        if i in conflicts:
+            skipped.append((old, new, "destination name already used by another bone"))
+        elif i not in planned_indices:
+            skipped.append((old, new, "duplicate destination name"))
+    planned = [(old, new, name_e) for i, old, new, name_e in planned]
+    
+    # 第一阶段：名称会被其他骨骼占用的源骨骼先改为临时名称
+    current = {}
+    for i, (old, new, name_e) in enumerate(planned):
+        current[old] = old
+        if old in target_names:
+            temp_name = f"__mth_rename_{i}"
+            while temp_name in existing_names:
+                temp_name += "_"
+            armature_bones[old].name = temp_name
+            current[old] = temp_name
     
+    # 第二阶段：全部改为最终名称
+    renamed = []
+    failed = []
+    for old, new, name_e in planned:
+        bone = armature_bones[current[old]]
+        bone.name = new
+        if bone.name != new:
+            # 理论上不会发生（冲突已预先排除）；不保留临时名称或 .001 后缀
+            failed.append((bone, old, new))
+            continue
+        renamed.append((old, new, name_e))
+    for bone, old, new in failed:
+        bone.name = old
+        skipped.append((old, new, "destination name already used by another bone" if bone.name == old else f"left as {bone.name}"))
+    
+    # 第三阶段：一次性写入 mmd_bone 英文名称（姿态骨骼在对象模式下也可访问，无需切换模式）
+    pose_bones = armature.pose.bones
+    for old, new, name_e in renamed:
+        if name_e is not None:
+            pose_bone = pose_bones.get(new)
+            if pose_bone and hasattr(pose_bone, "mmd_bone"):
+                pose_bone.mmd_bone.name_e = name_e  # 设置英文名称
+    
+    for old, new, reason in skipped:
+        print(f"Failed to rename {old} to {new}: {reason}")
+    return renamed, skipped
+
+
+def rename_bones(boneMap1, boneMap2, bone_map_table):
     armature = bpy.context.active_object
     if armature.type != 'ARMATURE':
         raise TypeError("Active object is not an armature!")
-    
-    armature_bones = armature.data.bones
-    for bone_entry in FINGER_BONE_NAMES_DICTIONARY[1:]:
-        src_bone = bone_entry[boneMap1_index]
-        dst_bone = bone_entry[boneMap2_index]
-        
-        if src_bone in armature_bones and dst_bone != '' and src_bone != dst_bone:
-            try:
-                armature_bones[src_bone].name = dst_bone
-            except RuntimeError as e:
-                print(f"Failed to rename finger bone {src_bone} to {dst_bone}: {str(e)}")
-                continue
-            
-            if boneMap2 in ['mmd_japanese', 'mmd_japaneseLR']:
-                bpy.ops.object.mode_set(mode='POSE')
-                pose_bone = armature.pose.bones.get(dst_bone)
-                if pose_bone and hasattr(pose_bone, "mmd_bone"):
-                    pose_bone.mmd_bone.name_e = bone_entry[0]
-                bpy.ops.object.mode_set(mode='OBJECT')
+    return apply_bone_renames(armature, collect_bone_renames(armature, boneMap1, boneMap2, bone_map_table))
+
+
+def rename_finger_bones(boneMap1, boneMap2, finger_bone_map_table):
+    # 逻辑与主体骨骼重命名一致，复用检查逻辑
+    armature = bpy.context.active_object
+    if armature.type != 'ARMATURE':
+        raise TypeError("Active object is not an armature!")
+    result = apply_bone_renames(armature, collect_bone_renames(armature, boneMap1, boneMap2, finger_bone_map_table))
     
     # 更新源骨骼类型为当前目标类型（便于后续二次重命名）
     bpy.context.scene.Origin_Armature_Type = boneMap2
     print_missing_bone_names()
+    return result
 
 
 def main(context):
-    try:
-        # 找到并激活骨架对象（增加异常捕获）
-        armature = model.findArmature(context.active_object)
-        if not armature:
-            raise RuntimeError("No MMD armature found! Please select an MMD model.")
-        
-        context.view_layer.objects.active = armature
-        initial_mode = context.mode  # 保存初始模式，操作后恢复
-        
-        # 执行核心逻辑
-        use_international_fonts_display_names_bones()
-        unhide_all_armatures()
-        
-        # 加载骨骼字典（增加异常处理）
-        BONE_NAMES_DICTIONARY = import_csv.use_csv_bones_dictionary()
-        FINGER_BONE_NAMES_DICTIONARY = import_csv.use_csv_bones_fingers_dictionary()
-        
-        # 重命名骨骼
-        rename_bones(
-            context.scene.Origin_Armature_Type,
-            context.scene.Destination_Armature_Type,
-            BONE_NAMES_DICTIONARY
-        )
-        rename_finger_bones(
-            context.scene.Origin_Armature_Type,
-            context.scene.Destination_Armature_Type,
-            FINGER_BONE_NAMES_DICTIONARY
-        )
-        
-        # 切换到姿态模式并全选骨骼（便于用户后续操作）
-        bpy.ops.object.mode_set(mode='POSE')
-        bpy.ops.pose.select_all(action='SELECT')
-        
-        # 恢复初始模式（优化用户体验）
-        # bpy.ops.object.mode_set(mode=initial_mode)
-        
-    except Exception as e:
-        # 错误提示（同时输出到控制台和Blender信息区）
-        print(f"Bone rename failed: {str(e)}")
-        context.active_operator.report({'ERROR'}, str(e))
+    """执行重命名；失败时抛出异常，由操作器报告错误"""
+    # 找到并激活骨架对象
+    armature = model.findArmature(context.active_object)
+    if not armature:
+        raise RuntimeError("No MMD armature found! Please select an MMD model.")
+    
+    context.view_layer.objects.active = armature
+    initial_mode = context.mode  # 保存初始模式，操作后恢复
+    
+    # 执行核心逻辑
+    use_international_fonts_display_names_bones()
+    unhide_all_armatures()
+    
+    # 加载骨骼字典（已编译并缓存，含名称索引）
+    bone_map_table = bone_maps.bones_dictionary()
+    finger_bone_map_table = bone_maps.fingers_dictionary()
+    
+    # 重命名骨骼：主体与手指骨骼合并为一次事务
+    origin = context.scene.Origin_Armature_Type
+    destination = context.scene.Destination_Armature_Type
+    renames = collect_bone_renames(armature, origin, destination, bone_map_table)
+    renames += collect_bone_renames(armature, origin, destination, finger_bone_map_table)
+    apply_bone_renames(armature, renames)
+    
+    # 更新源骨骼类型为当前目标类型（便于后续二次重命名）
+    context.scene.Origin_Armature_Type = destination
+    print_missing_bone_names()
+    
+    # 切换到姿态模式并全选骨骼（便于用户后续操作）
+    bpy.ops.object.mode_set(mode='POSE')
+    bpy.ops.pose.select_all(action='SELECT')
+    
+    # 恢复初始模式（优化用户体验）
+    # bpy.ops.object.mode_set(mode=initial_mode)
 
 
 class BonesRenamer(bpy.types.Operator):
@@ -252,11 +286,49 @@ class BonesRenamer(bpy.types.Operator):
         )
 
     def execute(self, context):
-        main(context)
+        try:
+            main(context)
+        except Exception as e:
+            # 错误提示（同时输出到控制台和Blender信息区）；脚本调用时 bpy.ops 会抛出 RuntimeError
+            print(f"Bone rename failed: {str(e)}")
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
         self.report({'INFO'}, "Bone renaming completed (check console for missing bones)")
         return {'FINISHED'}
 
 
+class BonesRenamerDetect(bpy.types.Operator):
+    """Detect the bone naming standard of the active armature"""
+    bl_idname = "object.bones_renamer_detect"
+    bl_label = "Detect Armature Type"
+    bl_options = {'REGISTER', 'UNDO'}
+    bl_description = "Score all bone maps against the armature's bone names and set 'From' to the best match"
+
+    @classmethod
+    def poll(cls, context):
+        return (
+            context.active_object is not None
+            and model.findArmature(context.active_object) is not None
+        )
+
+    def execute(self, context):
+        armature = model.findArmature(context.active_object)
+        detected = detect_origin_armature_type(armature)
+        if not detected:
+            self.report({'WARNING'}, "No known bone names found in this armature")
+            return {'CANCELLED'}
+        
+        # 控制台输出完整排名，便于核对
+        print(f"\nDetected armature types of {armature.name}:")
+        for d in detected:
+            print(f"  {d.bone_map}: {d.matched}/{d.total} ({d.coverage:.0%})")
+        
+        best = detected[0]
+        context.scene.Origin_Armature_Type = best.bone_map
+        self.report({'INFO'}, f"Detected '{best.bone_map}' ({best.matched}/{best.total} bones, {best.coverage:.0%})")
+        return {'FINISHED'}
+
+
 # 定义骨骼类型枚举（单独提取，便于维护）
 def get_armature_type_items():
     return [
@@ -319,6 +391,7 @@ def register():
     # 2. 注册类（按依赖顺序：面板依赖操作器，先注册操作器）
     classes_to_register = [
         BonesRenamer,
+        BonesRenamerDetect,
         BonesRenamerPanel_MTH
     ]
     
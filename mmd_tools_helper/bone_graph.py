@@ -0,0 +1,105 @@
+# Read-only snapshot of the bone hierarchy of an armature.
+# The bones are read once (names and parents in one pass, rest positions and
+# selection with foreach_get) into numpy arrays: parent index per bone, the
+# children of every bone as a compressed (CSR) index, depth and length. The
+# bone structure algorithms of the add-on (IK setup, display panel groups,
+# combining bones ...) query this snapshot instead of Bone.parent/.children.
+# It must be built again after bones are added, removed or re-parented.
+# This module does not use bpy.
+
+import numpy
+
+
+class BoneGraph:
+	"""Snapshot of the bones of an armature (bpy.types.Armature)"""
+
+	def __init__(self, armature_data):
+		bones = armature_data.bones
+		count = len(bones)
+		self.names = []
+		parent_names = []
+		for b in bones:
+			self.names.append(b.name)
+			parent_names.append(b.parent.name if b.parent is not None else None)
+		self.index = {name: i for i, name in enumerate(self.names)}
+		self.parent = numpy.array([self.index[p] if p is not None else -1 for p in parent_names], dtype=numpy.int32)
+		self.head = numpy.empty(count * 3, dtype=numpy.float32)
+		self.tail = numpy.empty(count * 3, dtype=numpy.float32)
+		bones.foreach_get('head_local', self.head)
+		bones.foreach_get('tail_local', self.tail)
+		self.head = self.head.reshape(count, 3)
+		self.tail = self.tail.reshape(count, 3)
+		self.length = numpy.linalg.norm(self.tail - self.head, axis=1)
+		self.selected = numpy.zeros(count, dtype=bool)
+		bones.foreach_get('select', self.selected)
+		# children of bone i: self.child_order[self.child_start[i]:self.child_start[i + 1]], in bone order
+		self.child_order = numpy.argsort(self.parent, kind='stable').astype(numpy.int32)
+		self.child_start = numpy.searchsorted(self.parent[self.child_order], numpy.arange(-1, count + 1)).astype(numpy.int32)[1:]
+		self.roots = numpy.flatnonzero(self.parent == -1)
+		self.depth = numpy.zeros(count, dtype=numpy.int32)
+		level = self.roots
+		d = 0
+		while len(level) > 0:
+			self.depth[level] = d
+			level = numpy.concatenate([self.children(i) for i in level])
+			d += 1
+
+	def __len__(self):
+		return len(self.names)
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def find(self, names):
+		"""Returns the first of some bone names which is in the armature, or None"""
+		return next((n for n in names if n in self.index), None)
+
+	def children(self, i):
+		return self.child_order[self.child_start[i]:self.child_start[i + 1]]
+
+	def children_names(self, name):
+		i = self.index.get(name)
+		if i is None:
+			return []
+		return [self.names[c] for c in self.children(i)]
+
+	def parent_name(self, name):
+		p = self.parent[self.index[name]]
+		return self.names[p] if p >= 0 else None
+
+	def is_parent(self, parent_name, child_name):
+		return self.parent[self.index[child_name]] == self.index[parent_name]
+
+	def chain(self, i, count=None):
+		"""Returns bone i and its ancestors, nearest first (count bones at most), as IK chains count them"""
+		result = []
+		while i >= 0 and (count is None or len(result) < count):
+			result.append(i)
+			i = int(self.parent[i])
+		return result
+
+	def subtree(self, i):
+		"""Returns bone i and all its descendants in depth-first pre-order"""
+		result = []
+		stack = [i]
+		while stack:
+			b = stack.pop()
+			result.append(b)
+			stack.extend(reversed(self.children(b).tolist()))
+		return result
+
+	def lca(self, a, b):
+		"""Returns the lowest common ancestor of bones a and b, or -1 if they are in different trees"""
+		while self.depth[a] > self.depth[b]:
+			a = self.parent[a]
+		while self.depth[b] > self.depth[a]:
+			b = self.parent[b]
+		while a != b:
+			a = self.parent[a]
+			b = self.parent[b]
+			if a < 0 or b < 0:
+				return -1
+		return int(a)
+
+	def selected_names(self):
+		return [self.names[i] for i in numpy.flatnonzero(self.selected)]
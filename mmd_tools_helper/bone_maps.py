@@ -0,0 +1,167 @@
+import csv
+import os
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+# Process-wide store of the bone map csv files.
+# Each csv file is parsed once and kept in memory as an immutable table
+# (a tuple of row tuples, the first row being the bone map names).
+# A table is parsed again only when the mtime or size of its file changes.
+# Every bone map column is also compiled into a hash index (bone name -> row id),
+# so translating a bone name from one bone map to another is a single dict lookup.
+
+BONES_DICTIONARY_CSV = os.path.join(os.path.dirname(__file__), "bones_dictionary.csv")
+FINGER_BONES_DICTIONARY_CSV = os.path.join(os.path.dirname(__file__), "bones_fingers_dictionary.csv")
+
+
+class BoneMapTable:
+	"""Compiled, read-only form of one bone map csv file"""
+
+	def __init__(self, path, rows):
+		self.path = path
+		self.rows = rows
+		self.header = rows[0] if len(rows) > 0 else ()
+		self.columns = MappingProxyType({bone_map: c for c, bone_map in enumerate(self.header)})
+		index = {}
+		for c, bone_map in enumerate(self.header):
+			names = {}
+			for r in range(1, len(rows)):
+				name = rows[r][c] if c < len(rows[r]) else ''
+				# the first row of a name wins, as list.index() did
+				if name != '' and name not in names:
+					names[name] = r
+			index[bone_map] = MappingProxyType(names)
+		self.index = MappingProxyType(index)
+		self.name_sets = MappingProxyType({bone_map: frozenset(names) for bone_map, names in index.items()})
+
+	def __len__(self):
+		return len(self.rows)
+
+	def column(self, bone_map):
+		return self.header.index(bone_map)
+
+	def row_id(self, name, bone_map):
+		"""Returns the row id of a bone name in a bone map, or None"""
+		names = self.index.get(bone_map)
+		if names is None:
+			return None
+		return names.get(name)
+
+	def translate(self, name, from_map, to_map):
+		"""Returns the name in to_map of the bone called name in from_map, or None if there is none"""
+		r = self.row_id(name, from_map)
+		c = self.columns.get(to_map)
+		if r is None or c is None or c >= len(self.rows[r]):
+			return None
+		translated = self.rows[r][c]
+		if translated == '':
+			return None
+		return translated
+
+	def __repr__(self):
+		return "<BoneMapTable %s: %d bone maps, %d bones>" % (os.path.basename(self.path), len(self.header), max(len(self.rows) - 1, 0))
+
+
+_lock = threading.Lock()
+_tables = {}
+
+
+def _file_stamp(path):
+	st = os.stat(path)
+	return (st.st_mtime_ns, st.st_size)
+
+
+def _parse(path):
+	with open(path, newline='', encoding='utf-8') as csvfile:
+		CSVreader = csv.reader(csvfile, delimiter=',', skipinitialspace=True)
+		return tuple(tuple(x) for x in CSVreader)
+
+
+def load(path):
+	"""Returns the BoneMapTable of a csv file, parsing it only if it is new or has changed on disk"""
+	path = os.path.abspath(path)
+	stamp = _file_stamp(path)
+	cached = _tables.get(path)
+	if cached is not None and cached[0] == stamp:
+		return cached[1]
+	with _lock:
+		cached = _tables.get(path)
+		if cached is not None and cached[0] == stamp:
+			return cached[1]
+		table = BoneMapTable(path, _parse(path))
+		_tables[path] = (stamp, table)
+		return table
+
+
+def invalidate(path=None):
+	"""Forgets one cached table, or all of them if no path is given"""
+	with _lock:
+		if path is None:
+			_tables.clear()
+		else:
+			_tables.pop(os.path.abspath(path), None)
+
+
+def bones_dictionary():
+	return load(BONES_DICTIONARY_CSV)
+
+
+def fingers_dictionary():
+	return load(FINGER_BONES_DICTIONARY_CSV)
+
+
+def tables():
+	return (bones_dictionary(), fingers_dictionary())
+
+
+def translate(name, from_map, to_map):
+	"""Translates a bone name between bone maps, looking in the bones and then the finger bones dictionary"""
+	for table in tables():
+		translated = table.translate(name, from_map, to_map)
+		if translated is not None:
+			return translated
+	return None
+
+
+DetectedArmatureType = namedtuple("DetectedArmatureType", ["bone_map", "matched", "total", "coverage"])
+
+
+def detect_armature_type(bone_names):
+	"""Scores every bone map of the bones and finger bones dictionaries against a collection of bone names.
+	Returns a list of DetectedArmatureType, best match first.
+	coverage is the fraction (0.0 - 1.0) of the bone map's bone names which were found."""
+	bone_names = frozenset(bone_names)
+	matched = {}
+	total = {}
+	for table in tables():
+		for bone_map, names in table.name_sets.items():
+			matched[bone_map] = matched.get(bone_map, 0) + len(names & bone_names)
+			total[bone_map] = total.get(bone_map, 0) + len(names)
+	scores = []
+	for bone_map in matched:
+		coverage = matched[bone_map] / total[bone_map] if total[bone_map] > 0 else 0.0
+		scores.append(DetectedArmatureType(bone_map, matched[bone_map], total[bone_map], coverage))
+	scores.sort(key=lambda d: (d.matched, d.coverage), reverse=True)
+	return scores
+
+
+# MMD semi-standard bones, which are not essential in an MMD armature
+SEMI_STANDARD_BONE_NAMES = frozenset(["upper body 2", "上半身2"])
+SEMI_STANDARD_FINGER_BONE_NAMES = frozenset(["thumb0_L", "thumb0_R", "左親指0", "親指0.L", "右親指0", "親指0.R"])
+
+
+def missing_bone_names(bone_names, bone_map):
+	"""Returns the bone names of a bone map (bones and then finger bones, in dictionary order)
+	which are not in bone_names, leaving out the MMD semi-standard bones"""
+	bone_names = frozenset(bone_names)
+	missing = []
+	for table, semi_standard in zip(tables(), (SEMI_STANDARD_BONE_NAMES, SEMI_STANDARD_FINGER_BONE_NAMES)):
+		c = table.columns.get(bone_map)
+		if c is None:
+			continue
+		for row in table.rows[1:]:
+			name = row[c] if c < len(row) else ''
+			if name != '' and name not in semi_standard and name not in bone_names:
+				missing.append(name)
+	return missing
@@ -160,8 +160,8 @@ def display_panel_groups_create(root, armature_object):
 	finger_names = []
 	ik_names = [] # ["IK", "ik", ＩＫ"]
 
-	for b in BONE_NAMES_DICTIONARY:
-		if BONE_NAMES_DICTIONARY.index(b) not in [0,1,3]:
+	for i, b in enumerate(BONE_NAMES_DICTIONARY):
+		if i not in [0,1,3]:
 			# not in [0,1,3] , not a bonemap ID, not a root bone, not a head bone
 			body_names = body_names + list(b)
 	for f in FINGER_BONE_NAMES_DICTIONARY:
@@ -0,0 +1,106 @@
+import os
+
+import bpy
+from . import toon_ramp_cache
+
+# Merges the images of the blend file which have the same content.
+# mmd_tools loads the toon, sphere and diffuse textures of every model it
+# imports, so the same file often exists as toon01.bmp, toon01.bmp.001 ...
+# each with its own pixel buffer in RAM and GPU memory. Images are hashed by
+# content (see toon_ramp_cache.image_content_hash), every user of a duplicate
+# (image texture nodes of materials and node groups, textures ...) is remapped
+# to one image, and the duplicates are removed.
+
+
+class ImageDedupPanel(bpy.types.Panel):
+	"""Merges the images which have the same content"""
+	bl_idname = "OBJECT_PT_mmd_image_dedup"
+	bl_label = "Merge duplicate images"
+	bl_space_type = "VIEW_3D"
+	bl_region_type = "UI"
+	bl_category = "mmd_tools_helper"
+
+	def draw(self, context):
+		layout = self.layout
+		row = layout.row()
+
+		row.label(text="Merge duplicate images", icon="IMAGE_DATA")
+		row = layout.row()
+		row.operator("mmd_tools_helper.image_dedup", text = "Merge duplicate images")
+		row = layout.row()
+
+
+def image_key(image):
+	"""Returns the content key of an image, or None if it has no content to compare"""
+	if image.type != 'IMAGE' or image.source not in ('FILE', 'GENERATED'):
+		return None
+	# unsaved paint edits are not in the file or packed data which would be hashed
+	if image.is_dirty:
+		return None
+	if image.source == 'FILE' and image.packed_file is None:
+		filepath = bpy.path.abspath(image.filepath, library=image.library)
+		if filepath == '' or not os.path.isfile(filepath):
+			return None
+	try:
+		content = toon_ramp_cache.image_content_hash(image)
+	except (OSError, RuntimeError):
+		return None
+	# the same pixels read with other settings render differently
+	return (content, image.colorspace_settings.name, image.alpha_mode, image.use_half_precision)
+
+
+def find_duplicate_images():
+	"""Returns {duplicate image: image it is merged into}, keeping the image with the shortest name"""
+	by_key = {}
+	for image in bpy.data.images:
+		if image.library is not None:
+			continue
+		key = image_key(image)
+		if key is not None:
+			by_key.setdefault(key, []).append(image)
+	duplicates = {}
+	for images in by_key.values():
+		if len(images) > 1:
+			images.sort(key=lambda i: (len(i.name), i.name))
+			for image in images[1:]:
+				duplicates[image] = images[0]
+	return duplicates
+
+
+def main(context):
+	duplicates = find_duplicate_images()
+	for image, original in duplicates.items():
+		print("Merged image", image.name, "into", original.name)
+		image.user_remap(original)
+	removed = 0
+	for image in list(duplicates):
+		if image.users == 0 or (image.users == 1 and image.use_fake_user):
+			bpy.data.images.remove(image)
+			removed += 1
+	return removed
+
+
+class ImageDedup(bpy.types.Operator):
+	"""Merges the images which have the same content"""
+	bl_idname = "mmd_tools_helper.image_dedup"
+	bl_label = "Merge duplicate images"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	def execute(self, context):
+		removed = main(context)
+		self.report({'INFO'}, "Removed %d duplicate images" % removed)
+		return {'FINISHED'}
+
+
+def register():
+	bpy.utils.register_class(ImageDedup)
+	bpy.utils.register_class(ImageDedupPanel)
+
+
+def unregister():
+	bpy.utils.unregister_class(ImageDedup)
+	bpy.utils.unregister_class(ImageDedupPanel)
+
+
+if __name__ == "__main__":
+	register()
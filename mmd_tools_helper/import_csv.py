@@ -1,13 +1,11 @@
-import bpy
-import csv
+from . import bone_maps
 
-# Each row read from the csv file is returned as a list of strings.
+# Each row read from the csv file is returned as a tuple of strings.
+# The bones dictionaries are immutable tuples of rows shared by all callers.
 
 def use_csv_bones_dictionary():
-	bones_dictionary = (__file__ + "bones_dictionary.csv").replace("import_csv.py" , "")
-	with open(bones_dictionary, newline='', encoding='utf-8') as csvfile:
-		CSVreader = csv.reader(csvfile, delimiter=',', skipinitialspace=True)
-		BONES_DICTIONARY = [tuple(x) for x in CSVreader]
+	# The csv file is parsed once per process by bone_maps and re-parsed only when it changes on disk.
+	BONES_DICTIONARY = bone_maps.bones_dictionary().rows
 
 	# print('\n')
 	# print("BONES_DICTIONARY = ")
@@ -18,10 +16,7 @@ def use_csv_bones_dictionary():
 
 
 def use_csv_bones_fingers_dictionary():
-	finger_bones_dictionary = (__file__ + "bones_fingers_dictionary.csv").replace("import_csv.py" , "")
-	with open(finger_bones_dictionary, newline='', encoding='utf-8') as csvfile:
-		CSVreader = csv.reader(csvfile, delimiter=',', skipinitialspace=True)
-		FINGER_BONES_DICTIONARY = [tuple(x) for x in CSVreader]
+	FINGER_BONES_DICTIONARY = bone_maps.fingers_dictionary().rows
 
 	# print('\n')
 	# print("FINGER_BONES_DICTIONARY = ")
@@ -29,16 +24,3 @@ def use_csv_bones_fingers_dictionary():
 		# print(t , ",")
 
 	return FINGER_BONES_DICTIONARY
-
-def use_csv_translations_dictionary():
-	translations_dictionary = (__file__ + "translations.csv").replace("import_csv.py" , "")
-	with open(translations_dictionary, newline='', encoding='utf-8') as csvfile:
-		CSVreader = csv.reader(csvfile, delimiter=',', skipinitialspace=True)
-		TRANSLATIONS_DICTIONARY = [tuple(x[:2]) for x in CSVreader]
-
-	# print('\n')
-	# print("TRANSLATIONS_DICTIONARY = ")
-	# for t in TRANSLATIONS_DICTIONARY:
-		# print(t , ",")
-
-	return TRANSLATIONS_DICTIONARY
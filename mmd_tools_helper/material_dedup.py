@@ -0,0 +1,233 @@
+import bpy
+import numpy
+from . import model
+
+# Merges the duplicate materials of an MMD model.
+# Two materials are duplicates when their mmd_material settings (colors, toon,
+# sphere, edge and shadow settings) and their node trees are the same; their
+# names do not matter. The material slots of every mesh of the
+# model are remapped to the first material of each set of duplicates, and the
+# polygons' material indices are rewritten in one foreach_get/foreach_set pass.
+# The node trees are compared in full: node settings, unlinked input values
+# and links, so a material whose nodes were tweaked by the user is kept.
+# Materials used by material morphs are never merged, since the morph refers
+# to them by name.
+
+# mmd_material properties which do not change how a material renders
+IGNORED_MMD_MATERIAL_PROPERTIES = frozenset(['rna_type', 'name', 'name_j', 'name_e', 'comment', 'material_id'])
+
+
+class MaterialDedupPanel(bpy.types.Panel):
+	"""Merges the duplicate materials of an MMD model"""
+	bl_idname = "OBJECT_PT_mmd_material_dedup"
+	bl_label = "Merge duplicate materials"
+	bl_space_type = "VIEW_3D"
+	bl_region_type = "UI"
+	bl_category = "mmd_tools_helper"
+
+	def draw(self, context):
+		layout = self.layout
+		row = layout.row()
+
+		row.label(text="Merge duplicate materials", icon="MATERIAL")
+		row = layout.row()
+		row.operator("mmd_tools_helper.material_dedup", text = "Merge duplicate materials")
+		row = layout.row()
+
+
+# node properties which do not change how a material renders
+IGNORED_NODE_PROPERTIES = frozenset(['rna_type', 'name', 'label', 'location', 'width', 'width_hidden', 'height', 'dimensions', 'select', 'show_options', 'show_preview', 'show_texture', 'hide', 'color', 'use_custom_color', 'parent', 'type', 'bl_idname', 'bl_label', 'bl_description', 'bl_icon', 'bl_static_type', 'bl_width_default', 'bl_width_min', 'bl_width_max', 'bl_height_default', 'bl_height_min', 'bl_height_max', 'image_user'])
+
+
+def _value(v):
+	if isinstance(v, (set, frozenset)):
+		# enum flag sets have no stable order
+		return tuple(sorted(v))
+	if hasattr(v, '__len__') and not isinstance(v, str):
+		return tuple(round(x, 5) if isinstance(x, float) else x for x in v)
+	if isinstance(v, float):
+		return round(v, 5)
+	return v
+
+
+def _pointer_value(v):
+	if v is None:
+		return None
+	if isinstance(v, bpy.types.ColorRamp):
+		return (v.color_mode, v.interpolation, v.hue_interpolation, tuple((_value(e.position), _value(e.color)) for e in v.elements))
+	if isinstance(v, bpy.types.CurveMapping):
+		return tuple(tuple((_value(p.location), p.handle_type) for p in c.points) for c in v.curves)
+	return getattr(v, 'name', None)
+
+
+def node_fingerprint(n, ignored_node=None):
+	values = []
+	for p in n.bl_rna.properties:
+		if p.identifier in IGNORED_NODE_PROPERTIES or p.type == 'COLLECTION':
+			continue
+		if p.identifier == 'image' and n.name == ignored_node:
+			continue
+		v = getattr(n, p.identifier)
+		values.append((p.identifier, _pointer_value(v) if p.type == 'POINTER' else _value(v)))
+	inputs = tuple(
+		(i, _value(socket.default_value))
+		for i, socket in enumerate(n.inputs)
+		if not socket.is_linked and hasattr(socket, 'default_value')
+		)
+	return (n.bl_idname, n.name, tuple(values), inputs)
+
+
+def material_fingerprint(m, ignored_node=None):
+	"""Returns a hashable summary of everything which changes how a material renders.
+	The image of the node called ignored_node is left out."""
+	mmd_values = ()
+	if hasattr(m, 'mmd_material'):
+		mmd_material = m.mmd_material
+		mmd_values = tuple(
+			(p.identifier, _value(getattr(mmd_material, p.identifier)))
+			for p in mmd_material.bl_rna.properties
+			if p.identifier not in IGNORED_MMD_MATERIAL_PROPERTIES and p.type != 'POINTER' and p.type != 'COLLECTION'
+			)
+	nodes = ()
+	links = ()
+	if m.use_nodes and m.node_tree is not None:
+		nodes = tuple(sorted(node_fingerprint(n, ignored_node) for n in m.node_tree.nodes))
+		links = tuple(sorted(
+			(l.from_node.name, l.from_socket.identifier, l.to_node.name, l.to_socket.identifier, l.is_muted)
+			for l in m.node_tree.links
+			))
+	return (
+		mmd_values,
+		nodes,
+		links,
+		_value(m.diffuse_color),
+		m.blend_method,
+		m.shadow_method,
+		m.use_backface_culling,
+		)
+
+
+def morph_material_names(root):
+	"""Names of the materials used by the material morphs of a model"""
+	names = set()
+	for morph in root.mmd_root.material_morphs:
+		for d in morph.data:
+			names.add(d.material)
+	return names
+
+
+def model_materials(root):
+	materials = []
+	for o in model.meshes(root):
+		for m in o.data.materials:
+			if m is not None and m not in materials:
+				materials.append(m)
+	return materials
+
+
+def find_duplicate_materials(root):
+	"""Returns {duplicate material: material it is merged into} for the materials of a model"""
+	keep = morph_material_names(root)
+	first = {}
+	duplicates = {}
+	for m in model_materials(root):
+		if m.name in keep:
+			continue
+		fingerprint = material_fingerprint(m)
+		original = first.setdefault(fingerprint, m)
+		if original != m:
+			duplicates[m] = original
+	return duplicates
+
+
+def remap_mesh_materials(mesh, duplicates):
+	"""Replaces the duplicate materials of a mesh and merges the slots which end up with the same material.
+	Returns the number of removed slots."""
+	materials = [duplicates.get(m, m) for m in mesh.materials]
+	first_slot = {}
+	kept = []
+	target = numpy.empty(len(materials), dtype=numpy.int32)
+	for i, m in enumerate(materials):
+		# empty slots are never merged
+		key = m if m is not None else i
+		if key not in first_slot:
+			first_slot[key] = len(kept)
+			kept.append(i)
+		target[i] = first_slot[key]
+	for i in kept:
+		if mesh.materials[i] != materials[i]:
+			mesh.materials[i] = materials[i]
+	removed = len(materials) - len(kept)
+	if removed == 0:
+		return 0
+	indices = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+	mesh.polygons.foreach_get('material_index', indices)
+	# polygons with an out of range index keep the last slot, as Blender draws them
+	indices = target[numpy.clip(indices, 0, len(materials) - 1)]
+	kept_set = set(kept)
+	for i in reversed(range(len(materials))):
+		if i not in kept_set:
+			mesh.materials.pop(index=i)
+	mesh.polygons.foreach_set('material_index', indices)
+	mesh.update()
+	return removed
+
+
+def main(context):
+	root = model.findRoot(context.active_object)
+	assert(root is not None), "The active object is not an MMD model."
+	duplicates = find_duplicate_materials(root)
+	if len(duplicates) == 0:
+		print("No duplicate materials")
+		return 0, 0
+	removed_slots = 0
+	meshes_done = set()
+	for o in model.meshes(root):
+		mesh = o.data
+		if mesh.as_pointer() in meshes_done:
+			continue
+		meshes_done.add(mesh.as_pointer())
+		if any(s.link == 'OBJECT' for s in o.material_slots):
+			print("Skipped", o.name, "which has materials linked to the object")
+			continue
+		removed_slots += remap_mesh_materials(mesh, duplicates)
+	for m in duplicates:
+		print("Merged material", m.name, "into", duplicates[m].name)
+	removed_materials = 0
+	for m in list(duplicates):
+		if m.users == 0:
+			bpy.data.materials.remove(m)
+			removed_materials += 1
+	return removed_materials, removed_slots
+
+
+class MaterialDedup(bpy.types.Operator):
+	"""Merges the duplicate materials of an MMD model"""
+	bl_idname = "mmd_tools_helper.material_dedup"
+	bl_label = "Merge duplicate materials"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	@classmethod
+	def poll(cls, context):
+		return context.active_object is not None
+
+	def execute(self, context):
+		if context.mode != 'OBJECT':
+			bpy.ops.object.mode_set(mode='OBJECT')
+		removed_materials, removed_slots = main(context)
+		self.report({'INFO'}, "Removed %d duplicate materials and %d material slots" % (removed_materials, removed_slots))
+		return {'FINISHED'}
+
+
+def register():
+	bpy.utils.register_class(MaterialDedup)
+	bpy.utils.register_class(MaterialDedupPanel)
+
+
+def unregister():
+	bpy.utils.unregister_class(MaterialDedup)
+	bpy.utils.unregister_class(MaterialDedupPanel)
+
+
+if __name__ == "__main__":
+	register()
@@ -1,5 +1,7 @@
 import bpy
+import numpy
 from . import model
+from . import bone_graph
 
 
 class MiscellaneousToolsPanel(bpy.types.Panel):
@@ -37,48 +39,95 @@ def combine_2_bones_1_bone(parent_bone_name, child_bone_name):
 	bpy.ops.object.mode_set(mode='POSE')
 	print("Combined 2 bones: ", parent_bone_name, child_bone_name)
 
-def combine_2_vg_1_vg(parent_vg_name, child_vg_name):
-	for o in bpy.context.scene.objects:
-		if o.type == 'MESH':
-			if parent_vg_name in o.vertex_groups.keys():
-				if child_vg_name in o.vertex_groups.keys():
-					for v in o.data.vertices:
-						for g in v.groups:
-							if o.vertex_groups[g.group] == o.vertex_groups[child_vg_name]:
-								o.vertex_groups[parent_vg_name].add([v.index], o.vertex_groups[child_vg_name].weight(v.index), 'ADD')
-					o.vertex_groups.remove(o.vertex_groups[child_vg_name])
-					print("Combined 2 vertex groups: ", parent_vg_name, child_vg_name)
+def armature_meshes(armature):
+	"""Mesh objects deformed by the armature (through an Armature modifier or by parenting)"""
+	return [o for o in bpy.context.scene.objects if o.type == 'MESH' and (o.parent == armature or o.find_armature() == armature)]
+
+# merged weights are rounded to this step, so that the few hundred distinct
+# values need one add() call each instead of one call per vertex
+WEIGHT_STEP = 1.0 / 255.0
+
+def vertex_group_members(mesh_object, vertex_group):
+	"""Returns the indices of the vertices of a vertex group. They are selected by vertex_group_select
+	(C code) in edit mode, instead of reading the groups of every vertex in Python.
+	The selection, active vertex group and mode of the mesh are restored."""
+	mesh = mesh_object.data
+	selection = numpy.empty(len(mesh.vertices), dtype=bool)
+	mesh.vertices.foreach_get('select', selection)
+	active_index = mesh_object.vertex_groups.active_index
+	with bpy.context.temp_override(active_object=mesh_object, object=mesh_object, selected_objects=[mesh_object], selected_editable_objects=[mesh_object]):
+		bpy.ops.object.mode_set(mode='EDIT')
+		try:
+			bpy.ops.mesh.select_mode(type='VERT')
+			bpy.ops.mesh.select_all(action='DESELECT')
+			mesh_object.vertex_groups.active_index = vertex_group.index
+			bpy.ops.object.vertex_group_select()
+		finally:
+			bpy.ops.object.mode_set(mode='OBJECT')
+	members = numpy.empty(len(mesh.vertices), dtype=bool)
+	mesh.vertices.foreach_get('select', members)
+	mesh.vertices.foreach_set('select', selection)
+	mesh_object.vertex_groups.active_index = active_index
+	return numpy.flatnonzero(members)
+
+def read_vertex_group_weights(mesh_object, group_indices, vertex_indices):
+	"""Reads the weights of some vertex groups for some vertices of a mesh.
+	Returns {group index: float32 array of weights, 0 for the vertices not in the group}"""
+	vertices = mesh_object.data.vertices
+	weights = {i: numpy.zeros(len(vertex_indices), dtype=numpy.float32) for i in group_indices}
+	for k, index in enumerate(vertex_indices.tolist()):
+		for g in vertices[index].groups:
+			if g.group in weights:
+				weights[g.group][k] = g.weight
+	return weights
+
+def combine_2_vg_1_vg(parent_vg_name, child_vg_name, armature=None):
+	if armature is None:
+		armature = bpy.context.active_object
+	mode = bpy.context.mode
+	if mode != 'OBJECT':
+		bpy.ops.object.mode_set(mode='OBJECT')
+	for o in armature_meshes(armature):
+		if parent_vg_name in o.vertex_groups.keys():
+			if child_vg_name in o.vertex_groups.keys():
+				parent_vg = o.vertex_groups[parent_vg_name]
+				child_vg = o.vertex_groups[child_vg_name]
+				# only the vertices of the child group change
+				in_child = vertex_group_members(o, child_vg)
+				weights = read_vertex_group_weights(o, (parent_vg.index, child_vg.index), in_child)
+				merged = numpy.clip(weights[parent_vg.index] + weights[child_vg.index], 0.0, 1.0)
+				steps = numpy.rint(merged / WEIGHT_STEP).astype(numpy.int32)
+				# one add() call per weight step instead of one per vertex
+				values, buckets = numpy.unique(steps, return_inverse=True)
+				order = numpy.argsort(buckets, kind='stable')
+				bounds = numpy.searchsorted(buckets[order], numpy.arange(len(values) + 1))
+				for i, value in enumerate(values):
+					parent_vg.add(in_child[order[bounds[i]:bounds[i + 1]]].tolist(), float(value) * WEIGHT_STEP, 'REPLACE')
+				o.vertex_groups.remove(child_vg)
+				print("Combined 2 vertex groups: ", parent_vg_name, child_vg_name)
+	if mode == 'POSE':
+		bpy.ops.object.mode_set(mode='POSE')
 
 def analyze_selected_parent_child_bone_pair():
-	selected_bones = []
-
-	for b in bpy.context.active_object.pose.bones:
-		if b.bone.select == True:
-			selected_bones.append(b.bone.name)
+	graph = bone_graph.BoneGraph(bpy.context.active_object.data)
+	selected_bones = graph.selected_names()
 
 	if len(selected_bones) != 2:
 		print("Exactly 2 bones must be selected." , len(selected_bones), "are selected.")
 		return None, None
-	if len(selected_bones) == 2:
-
-		if bpy.context.active_object.data.bones[selected_bones[0]].parent == bpy.context.active_object.data.bones[selected_bones[1]]:
-			parent_bone_name = selected_bones[1]
-			child_bone_name = selected_bones[0]
-			return parent_bone_name, child_bone_name
-			# combine_2_bones_1_bone(parent_bone, child_bone)
-			# combine_2_vg_1_vg(parent_bone, child_bone)
-
-		if bpy.context.active_object.data.bones[selected_bones[1]].parent == bpy.context.active_object.data.bones[selected_bones[0]]:
-			parent_bone_name = selected_bones[0]
-			child_bone_name = selected_bones[1]
-			return parent_bone_name, child_bone_name
-			# combine_2_bones_1_bone(parent_bone, child_bone)
-			# combine_2_vg_1_vg(parent_bone, child_bone)
-
-		if bpy.context.active_object.data.bones[selected_bones[0]].parent != bpy.context.active_object.data.bones[selected_bones[1]]:
-			if bpy.context.active_object.data.bones[selected_bones[1]].parent != bpy.context.active_object.data.bones[selected_bones[0]]:
-				print("Combining 2 bones to 1 bone requires a parent-child bone pair to be selected. There is no parent-child relationship between the 2 selected bones.")
-				return None, None
+
+	if graph.is_parent(selected_bones[1], selected_bones[0]):
+		parent_bone_name = selected_bones[1]
+		child_bone_name = selected_bones[0]
+		return parent_bone_name, child_bone_name
+
+	if graph.is_parent(selected_bones[0], selected_bones[1]):
+		parent_bone_name = selected_bones[0]
+		child_bone_name = selected_bones[1]
+		return parent_bone_name, child_bone_name
+
+	print("Combining 2 bones to 1 bone requires a parent-child bone pair to be selected. There is no parent-child relationship between the 2 selected bones.")
+	return None, None
 
 	bpy.ops.object.mode_set(mode='POSE')
 
@@ -178,7 +227,7 @@ def main(context):
 		parent_bone_name, child_bone_name = analyze_selected_parent_child_bone_pair()
 		if parent_bone_name is not None:
 			if child_bone_name is not None:
-				combine_2_vg_1_vg(parent_bone_name, child_bone_name)
+				combine_2_vg_1_vg(parent_bone_name, child_bone_name, bpy.context.active_object)
 				combine_2_bones_1_bone(parent_bone_name, child_bone_name)
 	if bpy.context.scene.selected_miscellaneous_tools == "delete_unused":
 		bpy.context.view_layer.objects.active = model.findArmature(bpy.context.active_object)
@@ -1,20 +1,21 @@
 import bpy
+from bpy.app.handlers import persistent
 
 def findRoot(obj):
 	if obj is not None:
+		info = _models.get(_object_roots.get(obj.as_pointer()))
+		if _is_current(info):
+			return info.root
+	while obj is not None:
 		if obj.mmd_type == 'ROOT':
 			return obj
-		else:
-			return findRoot(obj.parent)
-	else:
-		return None
+		obj = obj.parent
+	return None
 
 def armature(root):
-	armatures = []
-	for c in root.children:
-		if c.type == 'ARMATURE':
-			c.hide = False
-			armatures.append(c)
+	armatures = model_info(root).armatures
+	for a in armatures:
+		a.hide_set(False)
 	if len(armatures) == 1:
 		return armatures[0]
 	if len(armatures) == 0:
@@ -22,24 +23,54 @@ def armature(root):
 	if len(armatures) > 1:
 		print("Error. More than 1 armature found", armatures)
 
-def __allObjects(obj):
-	r = []
-	for i in obj.children:
-		r.append(i)
-		r += __allObjects(i)
-	return r
+def iter_descendants(obj, types=None, mmd_types=None):
+	"""Yields the descendants of obj in depth-first pre-order (the order of allObjects), without recursion.
+	types and mmd_types are optional collections of the object types and mmd_types to yield;
+	the children of the objects which are not yielded are still visited."""
+	stack = list(reversed(obj.children))
+	while stack:
+		o = stack.pop()
+		if (types is None or o.type in types) and (mmd_types is None or o.mmd_type in mmd_types):
+			yield o
+		stack.extend(reversed(o.children))
+
+def first_descendant(obj, types=None, mmd_types=None):
+	"""Returns the first descendant of obj matching the filters, stopping the walk there, or None"""
+	return next(iter_descendants(obj, types, mmd_types), None)
 
 def allObjects(obj, root):
 	if obj is None:
 		obj = root
-	return [obj] + __allObjects(obj)
+	return [obj] + list(iter_descendants(obj))
 
 def meshes(root):
-	arm = armature(root)
-	if arm is None:
-		return []
+	return list(model_info(root).meshes)
+
+
+def model_roots(context, scope='ACTIVE'):
+	"""Returns the MMD root objects of the model of the active object ('ACTIVE'),
+	of the models of the selected objects ('SELECTED') or of every model of the scene ('SCENE')"""
+	if scope == 'SCENE':
+		return [o for o in context.scene.objects if o.mmd_type == 'ROOT']
+	if scope == 'SELECTED':
+		objects = context.selected_objects
 	else:
-		return filter(lambda x: x.type == 'MESH' and x.mmd_type == 'NONE', allObjects(arm, root))
+		objects = [context.active_object]
+	roots = []
+	for o in objects:
+		root = findRoot(o)
+		if root is not None and root not in roots:
+			roots.append(root)
+	return roots
+
+def activate(obj):
+	"""Makes obj the only selected object and the active object, in object mode"""
+	if bpy.context.mode != 'OBJECT':
+		bpy.ops.object.mode_set(mode='OBJECT')
+	for o in bpy.context.view_layer.objects.selected:
+		o.select_set(False)
+	bpy.context.view_layer.objects.active = obj
+	obj.select_set(True)
 
 
 def find_MMD_Armature(obj):
@@ -51,11 +82,11 @@ def find_MMD_Armature(obj):
 
 def findArmature(obj):
 	if obj.type == 'ARMATURE':
-		obj.hide = False
+		obj.hide_set(False)
 		return obj
 	if obj.parent is not None:
 		if obj.parent.type == 'ARMATURE':
-			obj.parent.hide = False
+			obj.parent.hide_set(False)
 			return obj.parent
 	if hasattr(obj, "mmd_type"):
 		if obj.mmd_type == 'ROOT':
@@ -94,20 +125,209 @@ def findMeshesList(obj):
 		return list(meshes(obj))
 
 def find_mmd_rigid_bodies_list(root):
-	for c in root.children:
-		if c.type == 'EMPTY':
-			if c.name == "rigidbodies":
-				rigidbodies = c
-	rigid_bodies_list = list(rigidbodies.children)
-	return rigid_bodies_list
+	return list(model_info(root).rigid_bodies)
 
 def find_mmd_joints_list(root):
-	for c in root.children:
-		if c.type == 'EMPTY':
-			if c.name == "joints":
-				joints = c
-	joints_list = list(joints.children)
-	return joints_list
+	return list(model_info(root).joints)
+
+
+# Registry of the MMD models of the blend file.
+# The armature, meshes, rigid bodies and joints of a model are found once and
+# kept by root object, with an index of the rigid bodies and joints (by name,
+# bone, collision group and joint connections) built when first needed.
+# An entry is dropped by the depsgraph handler when an object of the model is
+# parented elsewhere, when an object is parented into the model, or when
+# objects are added or deleted; the physics index alone is dropped when a
+# rigid body or joint is changed. As the handler does not run inside an
+# operator or a background script, every lookup also compares the cached
+# objects and parents with the file by pointer (_is_current).
+
+class ModelInfo:
+	"""The objects of one MMD model, as found from its root object"""
+
+	def __init__(self, root):
+		self.root = root
+		self.armatures = [c for c in root.children if c.type == 'ARMATURE']
+		self.meshes = []
+		self.rigid_bodies = []
+		self.joints = []
+		if len(self.armatures) == 1:
+			arm = self.armatures[0]
+			self.meshes = list(iter_descendants(arm, types={'MESH'}, mmd_types={'NONE'}))
+		for c in root.children:
+			if c.type == 'EMPTY':
+				if c.name == "rigidbodies":
+					self.rigid_bodies = list(c.children)
+				if c.name == "joints":
+					self.joints = list(c.children)
+		self.objects = allObjects(root, root)
+		self.object_count = len(bpy.data.objects)
+		# parent of every object of the model when it was indexed
+		self.parents = {o.as_pointer(): _pointer(o.parent) for o in self.objects}
+		# PhysicsIndex, built on first use
+		self.physics = None
+
+class PhysicsIndex:
+	"""Lookups of the rigid bodies and joints of a model, built in one pass over them"""
+
+	def __init__(self, rigid_bodies, joints):
+		self.by_name = {}
+		self.by_mmd_name = {}
+		self.by_bone = {}
+		self.by_collision_group = {}
+		for r in rigid_bodies:
+			self.by_name[r.name] = r
+			mmd_rigid = r.mmd_rigid
+			self.by_mmd_name.setdefault(mmd_rigid.name_j, r)
+			self.by_bone.setdefault(mmd_rigid.bone, []).append(r)
+			self.by_collision_group.setdefault(mmd_rigid.collision_group_number, []).append(r)
+		# rigid body name -> joints attached to it, (name, name) -> joints between two rigid bodies
+		self.joints_by_body = {}
+		self.joints_by_pair = {}
+		for j in joints:
+			constraint = j.rigid_body_constraint
+			if constraint is None:
+				continue
+			a, b = constraint.object1, constraint.object2
+			for body in (a, b):
+				if body is not None:
+					self.joints_by_body.setdefault(body.name, []).append(j)
+			if a is not None and b is not None:
+				self.joints_by_pair.setdefault(frozenset((a.name, b.name)), []).append(j)
+
+	def rigid_bodies_of_bone(self, bone_name):
+		return self.by_bone.get(bone_name, [])
+
+	def joints_of(self, rigid_body):
+		return self.joints_by_body.get(rigid_body.name, [])
+
+	def joints_between(self, a, b):
+		return self.joints_by_pair.get(frozenset((a.name, b.name)), [])
+
+	def neighbours(self, rigid_body):
+		"""Returns the rigid bodies connected to a rigid body by a joint"""
+		result = []
+		for j in self.joints_of(rigid_body):
+			constraint = j.rigid_body_constraint
+			for body in (constraint.object1, constraint.object2):
+				if body is not None and body != rigid_body and body not in result:
+					result.append(body)
+		return result
+
+_models = {}
+_object_roots = {}
+
+def _pointer(obj):
+	return obj.as_pointer() if obj is not None else 0
+
+def _is_valid(obj):
+	try:
+		obj.name
+		return True
+	except ReferenceError:
+		return False
+
+def _is_current(info):
+	"""Checks a cached model against the objects of the file by pointer only, without touching the
+	cached objects, which may have been freed: the objects of the model must still exist with the
+	same parents, and no other object may have been parented into the model. This also covers the
+	changes made inside one operator or script, where no depsgraph update has run yet."""
+	if info is None or info.object_count != len(bpy.data.objects):
+		return False
+	live = {o.as_pointer(): _pointer(o.parent) for o in bpy.data.objects}
+	for p, parent in info.parents.items():
+		if live.get(p, -1) != parent:
+			return False
+	# every object of the model except the root has its parent in the model
+	children = sum(1 for parent in live.values() if parent in info.parents)
+	return children == len(info.parents) - 1 and _is_valid(info.root)
+
+def model_info(root):
+	"""Returns the ModelInfo of an MMD root object, indexing the model only when it is new or has changed"""
+	info = _models.get(root.as_pointer())
+	if _is_current(info):
+		return info
+	_invalidate_pointer(root.as_pointer())
+	info = ModelInfo(root)
+	_models[root.as_pointer()] = info
+	for p in info.parents:
+		_object_roots[p] = root.as_pointer()
+	return info
+
+def physics_index(root):
+	"""Returns the PhysicsIndex of the rigid bodies and joints of an MMD model"""
+	info = model_info(root)
+	if info.physics is None:
+		info.physics = PhysicsIndex(info.rigid_bodies, info.joints)
+	return info.physics
+
+def invalidate(root=None):
+	"""Forgets one model, or all of them"""
+	if root is None:
+		_models.clear()
+		_object_roots.clear()
+	else:
+		_invalidate_pointer(root.as_pointer())
+
+def _invalidate_pointer(root_pointer):
+	info = _models.pop(root_pointer, None)
+	if info is not None:
+		for p in info.parents:
+			_object_roots.pop(p, None)
+
+@persistent
+def _depsgraph_update_post(scene, depsgraph):
+	if len(_models) == 0:
+		return
+	if any(info.object_count != len(bpy.data.objects) for info in _models.values()):
+		invalidate()
+		return
+	for update in depsgraph.updates:
+		obj = update.id.original if update.id is not None else None
+		if not isinstance(obj, bpy.types.Object):
+			continue
+		p = obj.as_pointer()
+		parent = _pointer(obj.parent)
+		root_pointer = _object_roots.get(p)
+		if root_pointer is None:
+			# an object was parented to an object of a model
+			root_pointer = _object_roots.get(parent)
+			if root_pointer is not None:
+				_invalidate_pointer(root_pointer)
+			continue
+		info = _models.get(root_pointer)
+		if info is None:
+			continue
+		# an object of the model has a new parent
+		if info.parents.get(p) != parent:
+			_invalidate_pointer(root_pointer)
+		# the bone, collision group or bodies of a rigid body or joint may have changed
+		elif obj.mmd_type in ('RIGID_BODY', 'JOINT'):
+			info.physics = None
+
+# loading a file, undo and redo free and reallocate the objects of the file,
+# so the cached Object references must not even be touched afterwards
+@persistent
+def _invalidate_all(*args):
+	invalidate()
+
+_handlers = (
+	(bpy.app.handlers.depsgraph_update_post, _depsgraph_update_post),
+	(bpy.app.handlers.load_post, _invalidate_all),
+	(bpy.app.handlers.undo_post, _invalidate_all),
+	(bpy.app.handlers.redo_post, _invalidate_all),
+	)
+
+def register():
+	for handlers, handler in _handlers:
+		if handler not in handlers:
+			handlers.append(handler)
+
+def unregister():
+	for handlers, handler in _handlers:
+		if handler in handlers:
+			handlers.remove(handler)
+	invalidate()
 
 def test():
 	if hasattr(bpy.context, "active_object"):
@@ -0,0 +1,114 @@
+import bpy
+from . import model
+
+# Runs the add-on's model operators on several MMD models at once: the model of
+# the active object, the models of the selected objects or every model of the
+# scene. The roots are enumerated once with the model module and the operator
+# is run for each model inside one undo step. The bone maps (bone_maps), toon
+# ramps (toon_ramp_cache) and model lookups (model.model_info) are cached, so
+# the models after the first one reuse them.
+
+# operator idname -> (button text, object which must be active: 'ARMATURE' or 'MESH')
+MODEL_OPERATORS = {
+	'object.bones_renamer': ("Rename bones", 'ARMATURE'),
+	'object.add_foot_leg_ik': ("Add foot leg IK", 'ARMATURE'),
+	'object.add_hand_arm_ik': ("Add hand arm IK", 'ARMATURE'),
+	'object.add_display_panel_groups': ("Add display panel groups", 'ARMATURE'),
+	'mmd_tools_helper.mmd_toon_render_node_editor': ("Create toon material nodes", 'MESH'),
+	'mmd_tools_helper.toon_modifier': ("Modify toon", 'MESH'),
+	'mmd_tools_helper.material_dedup': ("Merge duplicate materials", 'ARMATURE'),
+	'mmd_tools_helper.texture_atlas': ("Build texture atlas", 'ARMATURE'),
+	}
+
+# scene settings which an operator changes after its run and which must be the
+# same for every model, e.g. the renamer sets the source armature type to the
+# destination one
+MODEL_OPERATOR_INPUTS = {
+	'object.bones_renamer': ('Origin_Armature_Type',),
+	}
+
+
+def draw_model_operators(layout, context):
+	"""Draws the scope and the buttons running an operator on every model of the scope"""
+	row = layout.row()
+	row.prop(context.scene, "mmd_model_scope", expand=True)
+	if context.scene.mmd_model_scope == 'ACTIVE':
+		return
+	for idname, (text, target) in MODEL_OPERATORS.items():
+		row = layout.row()
+		row.operator("mmd_tools_helper.run_for_models", text=text).operator = idname
+
+
+def target_object(root, target):
+	if target == 'MESH':
+		meshes = model.meshes(root)
+		return meshes[0] if len(meshes) > 0 else None
+	return model.armature(root)
+
+
+class RunForModels(bpy.types.Operator):
+	"""Runs an operator on every MMD model of the scope, in one undo step"""
+	bl_idname = "mmd_tools_helper.run_for_models"
+	bl_label = "Run for MMD models"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	bpy.types.Scene.mmd_model_scope = bpy.props.EnumProperty(items = [('ACTIVE', 'Active', 'The model of the active object'), ('SELECTED', 'Selected', 'The models of the selected objects'), ('SCENE', 'Scene', 'All MMD models of the scene')], name = "Models", default = 'ACTIVE')
+
+	operator: bpy.props.EnumProperty(items = [(idname, text, text) for idname, (text, target) in MODEL_OPERATORS.items()], name = "Operator")
+
+	def execute(self, context):
+		roots = model.model_roots(context, context.scene.mmd_model_scope)
+		if len(roots) == 0:
+			self.report({'ERROR'}, "No MMD model found")
+			return {'CANCELLED'}
+		text, target = MODEL_OPERATORS[self.operator]
+		category, name = self.operator.split('.')
+		operator = getattr(getattr(bpy.ops, category), name)
+		active = context.view_layer.objects.active
+		selected = list(context.selected_objects)
+		inputs = {name: getattr(context.scene, name) for name in MODEL_OPERATOR_INPUTS.get(self.operator, ())}
+		done = []
+		failed = []
+		try:
+			for root in roots:
+				obj = target_object(root, target)
+				if obj is None:
+					failed.append(root.name)
+					continue
+				for name, value in inputs.items():
+					setattr(context.scene, name, value)
+				model.activate(obj)
+				try:
+					result = operator()
+				except RuntimeError as e:
+					print(text, root.name, e)
+					result = {'CANCELLED'}
+				if 'FINISHED' in result:
+					done.append(root.name)
+				else:
+					failed.append(root.name)
+		finally:
+			if context.mode != 'OBJECT':
+				bpy.ops.object.mode_set(mode='OBJECT')
+			for o in context.view_layer.objects.selected:
+				o.select_set(False)
+			for o in selected:
+				o.select_set(True)
+			context.view_layer.objects.active = active
+		if failed:
+			self.report({'WARNING'}, "%s: %d models done, failed: %s" % (text, len(done), ", ".join(failed)))
+		else:
+			self.report({'INFO'}, "%s: %d models done" % (text, len(done)))
+		return {'FINISHED'}
+
+
+def register():
+	bpy.utils.register_class(RunForModels)
+
+
+def unregister():
+	bpy.utils.unregister_class(RunForModels)
+
+
+if __name__ == "__main__":
+	register()
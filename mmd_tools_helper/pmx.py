@@ -0,0 +1,597 @@
+# Pure python PMX 2.0 / 2.1 reader.
+#
+# Reads model files without Blender, e.g. to diagnose the bone names of many
+# .pmx files against the bone maps in CI. The file is memory-mapped and only the
+# sections which are asked for are decoded: the vertex and face blocks are
+# skipped by offset, without building any vertex data.
+#
+#   with pmx.open_pmx("model.pmx") as model:
+#       print(model.header.name_j, [b.name_j for b in model.bones])
+#
+# The names of bones, morphs and materials can be rewritten at file level:
+# only the name strings are re-encoded, every other byte (vertices, faces,
+# textures, ...) is copied unchanged from the memory map.
+#
+# Command line (does not need Blender):
+#
+#   python mmd_tools_helper/pmx.py --bone-map mmd_japanese "pmx example armatures"/*.pmx
+#   python mmd_tools_helper/pmx.py --rename xna_lara mmd_japanese --output renamed/ model.pmx
+
+import argparse
+import csv
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from collections import namedtuple
+
+try:
+	from . import bone_maps
+except ImportError:
+	# run as a script, outside the add-on package
+	import bone_maps
+
+
+class PMXError(Exception):
+	pass
+
+
+PMXHeader = namedtuple("PMXHeader", [
+	"version", "encoding", "additional_uvs",
+	"vertex_index_size", "texture_index_size", "material_index_size",
+	"bone_index_size", "morph_index_size", "rigid_body_index_size",
+	"name_j", "name_e", "comment_j", "comment_e",
+	])
+
+# names_span is the (start, end) byte range of the name_j and name_e text fields
+# of a record, which is what the PMX rename writer rewrites.
+Material = namedtuple("Material", ["index", "name_j", "name_e", "texture", "sphere_texture", "sphere_mode", "shared_toon", "toon_texture", "face_count", "names_span"])
+Bone = namedtuple("Bone", ["index", "name_j", "name_e", "position", "parent", "layer", "flags", "tail", "ik_target", "ik_links", "names_span"])
+Morph = namedtuple("Morph", ["index", "name_j", "name_e", "panel", "type", "offset_count", "names_span"])
+DisplayFrame = namedtuple("DisplayFrame", ["index", "name_j", "name_e", "is_special", "items", "names_span"])
+
+# bone flags
+BONE_TAIL_IS_BONE = 0x0001
+BONE_IS_IK = 0x0020
+BONE_INHERIT_ROTATION = 0x0100
+BONE_INHERIT_TRANSLATION = 0x0200
+BONE_FIXED_AXIS = 0x0400
+BONE_LOCAL_AXES = 0x0800
+BONE_EXTERNAL_PARENT = 0x2000
+
+# morph types
+MORPH_GROUP = 0
+MORPH_VERTEX = 1
+MORPH_BONE = 2
+MORPH_UV = 3
+MORPH_MATERIAL = 8
+MORPH_FLIP = 9
+MORPH_IMPULSE = 10
+
+# vertex weight deform types: 0 BDEF1, 1 BDEF2, 2 BDEF4, 3 SDEF, 4 QDEF
+_DEFORM_BONE_COUNTS = (1, 2, 4, 2, 4)
+_DEFORM_EXTRA_BYTES = (0, 4, 16, 4 + 36, 16)
+
+_SIGNED_INDEX = {1: 'b', 2: 'h', 4: 'i'}
+_UNSIGNED_INDEX = {1: 'B', 2: 'H', 4: 'i'}
+
+# order of the sections following the header
+SECTIONS = ("vertices", "faces", "textures", "materials", "bones", "morphs", "display_frames", "rigid_bodies", "joints")
+
+
+class _Cursor:
+	"""Reads little endian values from a buffer at a moving position"""
+
+	def __init__(self, buffer, pos, encoding='utf-16-le'):
+		self.buffer = buffer
+		self.pos = pos
+		self.encoding = encoding
+
+	def unpack(self, fmt):
+		values = struct.unpack_from('<' + fmt, self.buffer, self.pos)
+		self.pos += struct.calcsize('<' + fmt)
+		return values
+
+	def int(self):
+		value = struct.unpack_from('<i', self.buffer, self.pos)[0]
+		self.pos += 4
+		return value
+
+	def byte(self):
+		value = self.buffer[self.pos]
+		self.pos += 1
+		return value
+
+	def index(self, size, signed=True):
+		value = struct.unpack_from('<' + (_SIGNED_INDEX if signed else _UNSIGNED_INDEX)[size], self.buffer, self.pos)[0]
+		self.pos += size
+		return value
+
+	def text(self):
+		length = self.int()
+		if length < 0 or self.pos + length > len(self.buffer):
+			raise PMXError("Invalid text length %d at offset %d" % (length, self.pos - 4))
+		value = bytes(self.buffer[self.pos:self.pos + length]).decode(self.encoding, errors='replace')
+		self.pos += length
+		return value
+
+	def skip_text(self):
+		length = self.int()
+		self.pos += length
+
+	def skip(self, count):
+		self.pos += count
+
+
+class PMXFile:
+	"""Lazily decoded, memory-mapped PMX file"""
+
+	def __init__(self, filepath):
+		self.filepath = filepath
+		self._file = open(filepath, 'rb')
+		try:
+			self.buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# empty files can not be memory-mapped
+			self.buffer = b''
+		self._offsets = {}
+		self._cache = {}
+		self.header = self._read_header()
+
+	def close(self):
+		if isinstance(self.buffer, mmap.mmap):
+			self.buffer.close()
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _read_header(self):
+		if len(self.buffer) < 17 or bytes(self.buffer[0:4]) != b'PMX ':
+			raise PMXError("Not a PMX file: %s" % self.filepath)
+		version = struct.unpack_from('<f', self.buffer, 4)[0]
+		globals_count = self.buffer[8]
+		if globals_count < 8:
+			raise PMXError("Unsupported PMX header in %s" % self.filepath)
+		g = bytes(self.buffer[9:9 + globals_count])
+		encoding = 'utf-8' if g[0] == 1 else 'utf-16-le'
+		c = _Cursor(self.buffer, 9 + globals_count, encoding)
+		names = (c.text(), c.text(), c.text(), c.text())
+		self._offsets["vertices"] = c.pos
+		return PMXHeader(round(version, 1), encoding, g[1], g[2], g[3], g[4], g[5], g[6], g[7], *names)
+
+	def _cursor(self, section):
+		"""Returns a cursor at the start of a section, skipping the preceding sections as needed"""
+		i = SECTIONS.index(section)
+		while section not in self._offsets:
+			known = max(j for j in range(i) if SECTIONS[j] in self._offsets)
+			c = _Cursor(self.buffer, self._offsets[SECTIONS[known]], self.header.encoding)
+			getattr(self, "_scan_" + SECTIONS[known])(c, keep=False)
+			self._offsets[SECTIONS[known + 1]] = c.pos
+		return _Cursor(self.buffer, self._offsets[section], self.header.encoding)
+
+	def section_offset(self, section):
+		"""Byte offset of the start (the item count) of a section"""
+		return self._cursor(section).pos
+
+	def _section(self, section):
+		if section not in self._cache:
+			c = self._cursor(section)
+			self._cache[section] = getattr(self, "_scan_" + section)(c, keep=True)
+			if section != SECTIONS[-1]:
+				self._offsets.setdefault(SECTIONS[SECTIONS.index(section) + 1], c.pos)
+		return self._cache[section]
+
+	# Each _scan_ function reads one section starting at the cursor and leaves the
+	# cursor at the start of the next section. With keep=False nothing is decoded.
+
+	def _scan_vertices(self, c, keep):
+		count = c.int()
+		fixed = 4 * (3 + 3 + 2 + 4 * self.header.additional_uvs)
+		bone_size = self.header.bone_index_size
+		buffer = self.buffer
+		pos = c.pos
+		for i in range(count):
+			pos += fixed
+			deform = buffer[pos]
+			if deform > 4:
+				raise PMXError("Invalid vertex deform type %d at offset %d" % (deform, pos))
+			pos += 1 + _DEFORM_BONE_COUNTS[deform] * bone_size + _DEFORM_EXTRA_BYTES[deform] + 4
+		c.pos = pos
+		return count
+
+	def _scan_faces(self, c, keep):
+		count = c.int()
+		c.skip(count * self.header.vertex_index_size)
+		return count // 3
+
+	def _scan_textures(self, c, keep):
+		count = c.int()
+		textures = []
+		for i in range(count):
+			if keep:
+				textures.append(c.text())
+			else:
+				c.skip_text()
+		return textures
+
+	def _scan_materials(self, c, keep):
+		h = self.header
+		count = c.int()
+		materials = []
+		for i in range(count):
+			start = c.pos
+			name_j = c.text()
+			name_e = c.text()
+			end = c.pos
+			# diffuse 4f, specular 3f, specular strength f, ambient 3f, flags byte, edge color 4f, edge size f
+			c.skip(4 * 11 + 1 + 4 * 5)
+			texture = c.index(h.texture_index_size)
+			sphere_texture = c.index(h.texture_index_size)
+			sphere_mode = c.byte()
+			shared_toon = c.byte()
+			if shared_toon == 1:
+				toon_texture = c.byte()
+			else:
+				toon_texture = c.index(h.texture_index_size)
+			c.skip_text()
+			face_count = c.int() // 3
+			if keep:
+				materials.append(Material(i, name_j, name_e, texture, sphere_texture, sphere_mode, shared_toon == 1, toon_texture, face_count, (start, end)))
+		return materials
+
+	def _scan_bones(self, c, keep):
+		bone_size = self.header.bone_index_size
+		count = c.int()
+		bones = []
+		for i in range(count):
+			start = c.pos
+			name_j = c.text()
+			name_e = c.text()
+			end = c.pos
+			position = c.unpack('3f')
+			parent = c.index(bone_size)
+			layer = c.int()
+			flags = c.unpack('H')[0]
+			if flags & BONE_TAIL_IS_BONE:
+				tail = c.index(bone_size)
+			else:
+				tail = c.unpack('3f')
+			if flags & (BONE_INHERIT_ROTATION | BONE_INHERIT_TRANSLATION):
+				c.skip(bone_size + 4)
+			if flags & BONE_FIXED_AXIS:
+				c.skip(12)
+			if flags & BONE_LOCAL_AXES:
+				c.skip(24)
+			if flags & BONE_EXTERNAL_PARENT:
+				c.skip(4)
+			ik_target = None
+			ik_links = ()
+			if flags & BONE_IS_IK:
+				ik_target = c.index(bone_size)
+				c.skip(8)
+				links = []
+				for l in range(c.int()):
+					links.append(c.index(bone_size))
+					if c.byte() == 1:
+						c.skip(24)
+				ik_links = tuple(links)
+			if keep:
+				bones.append(Bone(i, name_j, name_e, position, parent, layer, flags, tail, ik_target, ik_links, (start, end)))
+		return bones
+
+	def _morph_offset_size(self, morph_type):
+		h = self.header
+		if morph_type == MORPH_GROUP or morph_type == MORPH_FLIP:
+			return h.morph_index_size + 4
+		if morph_type == MORPH_VERTEX:
+			return h.vertex_index_size + 12
+		if morph_type == MORPH_BONE:
+			return h.bone_index_size + 28
+		if MORPH_UV <= morph_type <= 7:
+			return h.vertex_index_size + 16
+		if morph_type == MORPH_MATERIAL:
+			return h.material_index_size + 1 + 4 * 28
+		if morph_type == MORPH_IMPULSE:
+			return h.rigid_body_index_size + 1 + 24
+		raise PMXError("Unknown morph type %d" % morph_type)
+
+	def _scan_morphs(self, c, keep):
+		count = c.int()
+		morphs = []
+		for i in range(count):
+			start = c.pos
+			name_j = c.text()
+			name_e = c.text()
+			end = c.pos
+			panel = c.byte()
+			morph_type = c.byte()
+			offset_count = c.int()
+			c.skip(offset_count * self._morph_offset_size(morph_type))
+			if keep:
+				morphs.append(Morph(i, name_j, name_e, panel, morph_type, offset_count, (start, end)))
+		return morphs
+
+	def _scan_display_frames(self, c, keep):
+		h = self.header
+		count = c.int()
+		frames = []
+		for i in range(count):
+			start = c.pos
+			name_j = c.text()
+			name_e = c.text()
+			end = c.pos
+			is_special = c.byte() == 1
+			items = []
+			for e in range(c.int()):
+				item_type = c.byte()
+				items.append((item_type, c.index(h.morph_index_size if item_type == 1 else h.bone_index_size)))
+			if keep:
+				frames.append(DisplayFrame(i, name_j, name_e, is_special, tuple(items), (start, end)))
+		return frames
+
+	def _scan_rigid_bodies(self, c, keep):
+		count = c.int()
+		for i in range(count):
+			c.skip_text()
+			c.skip_text()
+			# bone index, group byte, no-collision mask H, shape byte, size 3f, position 3f,
+			# rotation 3f, mass, move attenuation, rotation damping, repulsion, friction, mode byte
+			c.skip(self.header.bone_index_size + 1 + 2 + 1 + 4 * 14 + 1)
+		return count
+
+	def _scan_joints(self, c, keep):
+		count = c.int()
+		for i in range(count):
+			c.skip_text()
+			c.skip_text()
+			# type byte, 2 rigid body indices, 8 vectors of 3 floats
+			c.skip(1 + 2 * self.header.rigid_body_index_size + 4 * 24)
+		return count
+
+	@property
+	def vertex_count(self):
+		return self._section("vertices")
+
+	@property
+	def face_count(self):
+		return self._section("faces")
+
+	@property
+	def textures(self):
+		return self._section("textures")
+
+	@property
+	def materials(self):
+		return self._section("materials")
+
+	@property
+	def bones(self):
+		return self._section("bones")
+
+	@property
+	def morphs(self):
+		return self._section("morphs")
+
+	@property
+	def display_frames(self):
+		return self._section("display_frames")
+
+	def bone_names(self):
+		return [b.name_j for b in self.bones]
+
+
+def open_pmx(filepath):
+	return PMXFile(filepath)
+
+
+def diagnose(filepath, bone_map=None):
+	"""Compares the bone names of a PMX file with the bone maps.
+	Returns a dict with the detected armature types and the bone names of bone_map
+	(by default the best detected bone map) which are missing from the model."""
+	with open_pmx(filepath) as model:
+		names = model.bone_names()
+		detected = bone_maps.detect_armature_type(names)
+		if bone_map is None and len(detected) > 0 and detected[0].matched > 0:
+			bone_map = detected[0].bone_map
+		return {
+			'file': filepath,
+			'name': model.header.name_j,
+			'version': model.header.version,
+			'bones': len(names),
+			'detected': [d._asdict() for d in detected if d.matched > 0][:3],
+			'bone_map': bone_map,
+			'missing': bone_maps.missing_bone_names(names, bone_map) if bone_map is not None else [],
+			}
+
+
+def _encode_text(text, encoding):
+	data = text.encode(encoding)
+	return struct.pack('<i', len(data)) + data
+
+
+def write_renamed(model, filepath, bones=None, morphs=None, materials=None):
+	"""Writes a copy of a PMX file in which only names are changed.
+	bones, morphs and materials map a record index to its new (name_j, name_e).
+	All other bytes are streamed unchanged from the source file."""
+	edits = []
+	for records, new_names in ((model.bones, bones), (model.morphs, morphs), (model.materials, materials)):
+		if not new_names:
+			continue
+		for i, (name_j, name_e) in new_names.items():
+			start, end = records[i].names_span
+			edits.append((start, end, _encode_text(name_j, model.header.encoding) + _encode_text(name_e, model.header.encoding)))
+	edits.sort()
+	view = memoryview(model.buffer)
+	try:
+		with open(filepath, 'wb') as f:
+			pos = 0
+			for start, end, data in edits:
+				f.write(view[pos:start])
+				f.write(data)
+				pos = end
+			f.write(view[pos:])
+	finally:
+		view.release()
+
+
+def _temporary_file(filepath):
+	"""Returns the path of a new empty file next to filepath, to be moved over it"""
+	fd, temporary = tempfile.mkstemp(suffix='.pmx', dir=os.path.dirname(os.path.abspath(filepath)))
+	os.close(fd)
+	return temporary
+
+
+def bone_renames(model, from_map, to_map):
+	"""Returns {bone index: (name_j, name_e)} translating the bones of a model with the bone maps,
+	like the Bones Renamer does (name_e is set to the mmd_english name for Japanese destinations)"""
+	set_name_e = to_map in ['mmd_japanese', 'mmd_japaneseLR']
+	renames = {}
+	for b in model.bones:
+		new_name = bone_maps.translate(b.name_j, from_map, to_map)
+		if new_name is None or new_name == b.name_j:
+			continue
+		name_e = b.name_e
+		if set_name_e:
+			name_e = bone_maps.translate(b.name_j, from_map, 'mmd_english') or name_e
+		renames[b.index] = (new_name, name_e)
+	return renames
+
+
+def drop_conflicting_renames(records, renames):
+	"""Removes the renames which would give two records the same name_j, with the rules of the
+	Bones Renamer: the first rename into a name wins, and a name can only be taken from a record
+	which is renamed too. Checked again until nothing changes, as a dropped rename keeps its name
+	and may leave its destination name to a later rename.
+	Returns (kept renames, [(index, old name, new name, reason)])"""
+	holders = {}
+	for r in records:
+		holders.setdefault(r.name_j, []).append(r.index)
+	conflicts = set()
+	changed = True
+	while changed:
+		changed = False
+		kept = {}
+		targets = set()
+		for i in sorted(renames):
+			if i not in conflicts and renames[i][0] not in targets:
+				targets.add(renames[i][0])
+				kept[i] = renames[i]
+		for i in kept:
+			if any(h not in kept for h in holders.get(kept[i][0], ())):
+				conflicts.add(i)
+				changed = True
+	dropped = []
+	for i in sorted(renames):
+		if i in conflicts:
+			dropped.append((i, records[i].name_j, renames[i][0], "destination name already used"))
+		elif i not in kept:
+			dropped.append((i, records[i].name_j, renames[i][0], "duplicate destination name"))
+	return kept, dropped
+
+
+def name_renames(records, names):
+	"""Returns {record index: (name_j, name_e)} for the records whose name_j is a key of names"""
+	return {r.index: (names[r.name_j], r.name_e) for r in records if r.name_j in names and names[r.name_j] != r.name_j}
+
+
+def rename_file(source, destination, from_map=None, to_map=None, morph_names=None, material_names=None):
+	"""Renames the bones of a PMX file from one bone map to another, and optionally morphs and materials
+	(morph_names and material_names map old to new name_j). destination may be the source file itself.
+	Returns the number of renamed bones, morphs and materials."""
+	in_place = os.path.abspath(source) == os.path.abspath(destination)
+	with open_pmx(source) as model:
+		bones = bone_renames(model, from_map, to_map) if from_map and to_map else {}
+		morphs = name_renames(model.morphs, morph_names) if morph_names else {}
+		materials = name_renames(model.materials, material_names) if material_names else {}
+		bones, dropped_bones = drop_conflicting_renames(model.bones, bones)
+		morphs, dropped_morphs = drop_conflicting_renames(model.morphs, morphs)
+		materials, dropped_materials = drop_conflicting_renames(model.materials, materials)
+		for i, old_name, new_name, reason in dropped_bones + dropped_morphs + dropped_materials:
+			print("Failed to rename", old_name, "to", new_name + ":", reason)
+		target = _temporary_file(destination) if in_place else destination
+		try:
+			write_renamed(model, target, bones, morphs, materials)
+		except BaseException:
+			if in_place:
+				os.remove(target)
+			raise
+	# the source must be unmapped and closed before it is replaced (Windows refuses otherwise)
+	if in_place:
+		try:
+			os.replace(target, destination)
+		except BaseException:
+			os.remove(target)
+			raise
+	return len(bones), len(morphs), len(materials)
+
+
+def _read_names_csv(filepath):
+	with open(filepath, newline='', encoding='utf-8') as csvfile:
+		return {row[0]: row[1] for row in csv.reader(csvfile, skipinitialspace=True) if len(row) >= 2 and row[0] != ''}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="mmd_tools_helper.pmx", description="Diagnose or rename the bones of PMX files without Blender")
+	parser.add_argument('files', nargs='+', help=".pmx files or directories of .pmx files")
+	parser.add_argument('--bone-map', default=None, help="bone map to check against (default: the best detected one)")
+	parser.add_argument('--rename', nargs=2, metavar=('FROM', 'TO'), help="rename bones from one bone map to another ('auto' detects FROM)")
+	parser.add_argument('--morph-names', help="csv file of old,new morph names to rename")
+	parser.add_argument('--material-names', help="csv file of old,new material names to rename")
+	parser.add_argument('--output', help="directory for renamed files (default: rename the files in place)")
+	options = parser.parse_args(argv)
+	files = []
+	for f in options.files:
+		if os.path.isdir(f):
+			files += sorted(os.path.join(f, n) for n in os.listdir(f) if n.lower().endswith('.pmx'))
+		else:
+			files.append(f)
+	if options.rename or options.morph_names or options.material_names:
+		return rename_main(files, options)
+	failed = 0
+	for f in files:
+		try:
+			d = diagnose(f, options.bone_map)
+		except (PMXError, OSError, struct.error) as e:
+			print(f, "ERROR", e)
+			failed += 1
+			continue
+		print(f)
+		print("  model:", d['name'], " PMX", d['version'], " bones:", d['bones'])
+		for t in d['detected']:
+			print("  detected: %s %d/%d (%.0f%%)" % (t['bone_map'], t['matched'], t['total'], 100 * t['coverage']))
+		print("  missing %s bones (%d):" % (d['bone_map'], len(d['missing'])), ", ".join(d['missing']))
+	return 1 if failed else 0
+
+
+def rename_main(files, options):
+	from_map, to_map = options.rename if options.rename else (None, None)
+	morph_names = _read_names_csv(options.morph_names) if options.morph_names else None
+	material_names = _read_names_csv(options.material_names) if options.material_names else None
+	if options.output:
+		os.makedirs(options.output, exist_ok=True)
+	failed = 0
+	for f in files:
+		destination = os.path.join(options.output, os.path.basename(f)) if options.output else f
+		try:
+			source_map = from_map
+			if source_map == 'auto':
+				detected = diagnose(f)['detected']
+				if not detected:
+					raise PMXError("Could not detect the armature type")
+				source_map = detected[0]['bone_map']
+			counts = rename_file(f, destination, source_map, to_map, morph_names, material_names)
+		except (PMXError, OSError, struct.error) as e:
+			print(f, "ERROR", e)
+			failed += 1
+			continue
+		print(f, "->", destination, ": renamed %d bones, %d morphs, %d materials" % counts)
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
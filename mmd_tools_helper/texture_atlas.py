@@ -0,0 +1,324 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import bpy
+import numpy
+from . import model
+from . import material_dedup
+from . import toon_textures_to_node_editor_shader
+
+# Packs the diffuse textures of compatible materials of an MMD model into one
+# atlas image and collapses those materials into one material.
+# Materials are compatible when everything but their diffuse texture is the
+# same (see material_dedup.material_fingerprint) and the UVs of their polygons
+# stay inside the texture (no tiling). The textures are packed with the
+# MaxRects algorithm, resampled in a thread pool when the atlas would exceed the
+# maximum size, and the UVs of the active UV map are rewritten with numpy.
+
+# name of the diffuse texture node of the materials created by mmd_tools
+MMD_BASE_TEXTURE_NODE = "mmd_base_tex"
+# UVs this far outside 0..1 still count as inside the texture
+UV_EPSILON = 0.001
+
+
+class TextureAtlasPanel(bpy.types.Panel):
+	"""Packs the diffuse textures of compatible materials into one texture atlas"""
+	bl_idname = "OBJECT_PT_mmd_texture_atlas"
+	bl_label = "Texture atlas"
+	bl_space_type = "VIEW_3D"
+	bl_region_type = "UI"
+	bl_category = "mmd_tools_helper"
+
+	def draw(self, context):
+		layout = self.layout
+		row = layout.row()
+
+		row.label(text="Texture atlas", icon="TEXTURE")
+		row = layout.row()
+		layout.prop(context.scene, "TextureAtlasMaxSize")
+		row = layout.row()
+		layout.prop(context.scene, "TextureAtlasPadding")
+		row = layout.row()
+		row.operator("mmd_tools_helper.texture_atlas", text = "Build texture atlas")
+		row = layout.row()
+
+
+class MaxRectsPacker:
+	"""MaxRects rectangle packing into a fixed size bin, best short side fit"""
+
+	def __init__(self, width, height):
+		self.free = [(0, 0, width, height)]
+
+	def insert(self, w, h):
+		"""Returns the (x, y) position of a w x h rectangle, or None if it does not fit"""
+		best = None
+		for fx, fy, fw, fh in self.free:
+			if w <= fw and h <= fh:
+				score = (min(fw - w, fh - h), max(fw - w, fh - h))
+				if best is None or score < best[0]:
+					best = (score, fx, fy)
+		if best is None:
+			return None
+		x, y = best[1], best[2]
+		self._place(x, y, w, h)
+		return x, y
+
+	def _place(self, ux, uy, uw, uh):
+		free = []
+		for f in self.free:
+			fx, fy, fw, fh = f
+			if ux >= fx + fw or ux + uw <= fx or uy >= fy + fh or uy + uh <= fy:
+				free.append(f)
+				continue
+			# split the free rectangle into the (up to 4) maximal rectangles around the used one
+			if ux > fx:
+				free.append((fx, fy, ux - fx, fh))
+			if ux + uw < fx + fw:
+				free.append((ux + uw, fy, fx + fw - ux - uw, fh))
+			if uy > fy:
+				free.append((fx, fy, fw, uy - fy))
+			if uy + uh < fy + fh:
+				free.append((fx, uy + uh, fw, fy + fh - uy - uh))
+		self.free = [a for i, a in enumerate(free) if not any(_contains(b, a) and (a != b or j < i) for j, b in enumerate(free) if j != i)]
+
+
+def _contains(a, b):
+	return b[0] >= a[0] and b[1] >= a[1] and b[0] + b[2] <= a[0] + a[2] and b[1] + b[3] <= a[1] + a[3]
+
+
+def pack_rectangles(sizes, max_size):
+	"""Packs rectangles into the smallest power of two bin found, up to max_size x max_size.
+	Returns ([(x, y)] in the order of sizes, width, height), or None if they do not fit."""
+	area = sum(w * h for w, h in sizes)
+	side = 2 ** math.ceil(math.log2(max(1, math.sqrt(area))))
+	width = max(side, 2 ** math.ceil(math.log2(max(w for w, h in sizes))))
+	height = max(side, 2 ** math.ceil(math.log2(max(h for w, h in sizes))))
+	# largest rectangles first
+	order = sorted(range(len(sizes)), key=lambda i: (max(sizes[i]), sizes[i][0] * sizes[i][1]), reverse=True)
+	while width <= max_size and height <= max_size:
+		packer = MaxRectsPacker(width, height)
+		positions = [None] * len(sizes)
+		for i in order:
+			positions[i] = packer.insert(*sizes[i])
+			if positions[i] is None:
+				break
+		else:
+			return positions, width, height
+		if width <= height:
+			width *= 2
+		else:
+			height *= 2
+	return None
+
+
+def image_pixels(image):
+	width, height = image.size[0], image.size[1]
+	pixels = numpy.empty(width * height * 4, dtype=numpy.float32)
+	image.pixels.foreach_get(pixels)
+	return pixels.reshape(height, width, 4)
+
+
+def resample(pixels, width, height):
+	"""Bilinear resampling of a (h, w, 4) array to (height, width, 4)"""
+	h, w = pixels.shape[0], pixels.shape[1]
+	if (h, w) == (height, width):
+		return pixels
+	ys = numpy.clip((numpy.arange(height) + 0.5) * h / height - 0.5, 0, h - 1)
+	xs = numpy.clip((numpy.arange(width) + 0.5) * w / width - 0.5, 0, w - 1)
+	y0 = ys.astype(numpy.intp)
+	x0 = xs.astype(numpy.intp)
+	y1 = numpy.minimum(y0 + 1, h - 1)
+	x1 = numpy.minimum(x0 + 1, w - 1)
+	wy = (ys - y0).astype(numpy.float32)[:, None, None]
+	wx = (xs - x0).astype(numpy.float32)[None, :, None]
+	top = pixels[y0][:, x0] * (1 - wx) + pixels[y0][:, x1] * wx
+	bottom = pixels[y1][:, x0] * (1 - wx) + pixels[y1][:, x1] * wx
+	return top * (1 - wy) + bottom * wy
+
+
+def build_atlas(images, max_size, padding):
+	"""Packs images into one pixel array.
+	Returns (pixels, {image: (x, y, w, h) of the image in the atlas}), halving the
+	image sizes until they fit in max_size."""
+	scale = 1.0
+	while True:
+		sizes = [(max(1, round(i.size[0] * scale)), max(1, round(i.size[1] * scale))) for i in images]
+		packed = pack_rectangles([(w + 2 * padding, h + 2 * padding) for w, h in sizes], max_size)
+		if packed is not None:
+			break
+		scale *= 0.5
+		if scale < 1 / 64:
+			raise RuntimeError("The textures do not fit in a %d x %d atlas" % (max_size, max_size))
+	positions, width, height = packed
+	# pixels are read on the main thread; numpy releases the GIL while resampling
+	sources = [image_pixels(i) for i in images]
+
+	def block(job):
+		pixels, (w, h) = job
+		# padding repeats the edge pixels, so that filtering does not bleed neighbours
+		return numpy.pad(resample(pixels, w, h), ((padding, padding), (padding, padding), (0, 0)), mode='edge')
+
+	with ThreadPoolExecutor() as executor:
+		blocks = list(executor.map(block, zip(sources, sizes)))
+	atlas = numpy.zeros((height, width, 4), dtype=numpy.float32)
+	rects = {}
+	for image, (x, y), (w, h), b in zip(images, positions, sizes, blocks):
+		atlas[y:y + b.shape[0], x:x + b.shape[1]] = b
+		rects[image] = (x + padding, y + padding, w, h)
+	return atlas, rects
+
+
+def diffuse_texture_node(m):
+	"""Returns the image texture node of the diffuse texture of a material, or None"""
+	if not m.use_nodes or m.node_tree is None:
+		return None
+	n = m.node_tree.nodes.get(MMD_BASE_TEXTURE_NODE)
+	if n is not None and n.type == 'TEX_IMAGE':
+		return n
+	diffuse_image = toon_textures_to_node_editor_shader.mmd_texture_slot_images(m)[0]
+	if diffuse_image is None:
+		return None
+	for n in m.node_tree.nodes:
+		if n.type == 'TEX_IMAGE' and n.image == diffuse_image:
+			return n
+	return None
+
+
+class MeshLoops:
+	"""UVs of the active UV map of a mesh and the material slot of each loop, as numpy arrays"""
+
+	def __init__(self, mesh):
+		self.mesh = mesh
+		self.uv_layer = mesh.uv_layers.active
+		loop_count = len(mesh.loops)
+		self.uvs = numpy.empty(loop_count * 2, dtype=numpy.float32)
+		if self.uv_layer is not None:
+			self.uv_layer.data.foreach_get('uv', self.uvs)
+		self.uvs = self.uvs.reshape(loop_count, 2)
+		polygon_count = len(mesh.polygons)
+		material_index = numpy.empty(polygon_count, dtype=numpy.int32)
+		loop_start = numpy.empty(polygon_count, dtype=numpy.int32)
+		loop_total = numpy.empty(polygon_count, dtype=numpy.int32)
+		mesh.polygons.foreach_get('material_index', material_index)
+		mesh.polygons.foreach_get('loop_start', loop_start)
+		mesh.polygons.foreach_get('loop_total', loop_total)
+		offsets = numpy.repeat(numpy.cumsum(loop_total) - loop_total, loop_total)
+		loops = numpy.repeat(loop_start, loop_total) + numpy.arange(offsets.size) - offsets
+		self.slots = numpy.full(loop_count, -1, dtype=numpy.int32)
+		self.slots[loops] = numpy.repeat(material_index, loop_total)
+
+	def uvs_inside(self, slot):
+		uvs = self.uvs[self.slots == slot]
+		return bool(((uvs >= -UV_EPSILON) & (uvs <= 1 + UV_EPSILON)).all())
+
+	def remap(self, slot, rect, width, height):
+		x, y, w, h = rect
+		mask = self.slots == slot
+		uvs = numpy.clip(self.uvs[mask], 0.0, 1.0)
+		self.uvs[mask, 0] = (x + uvs[:, 0] * w) / width
+		self.uvs[mask, 1] = (y + uvs[:, 1] * h) / height
+
+	def write(self):
+		self.uv_layer.data.foreach_set('uv', self.uvs.ravel())
+
+
+def atlas_groups(root, model_meshes):
+	"""Returns the lists of compatible materials of a model which can share an atlas"""
+	keep = material_dedup.morph_material_names(root)
+	groups = {}
+	for m in material_dedup.model_materials(root):
+		if m.name in keep:
+			continue
+		n = diffuse_texture_node(m)
+		if n is None or n.image is None or n.image.size[0] * n.image.size[1] == 0:
+			continue
+		# the UVs of every polygon using the material must stay inside the texture
+		inside = True
+		for mesh, loops in model_meshes:
+			for slot, slot_material in enumerate(mesh.materials):
+				if slot_material == m and (loops.uv_layer is None or not loops.uvs_inside(slot)):
+					inside = False
+		if inside:
+			groups.setdefault(material_dedup.material_fingerprint(m, n.name), []).append(m)
+	return [g for g in groups.values() if len(g) > 1]
+
+
+def main(context):
+	root = model.findRoot(context.active_object)
+	assert(root is not None), "The active object is not an MMD model."
+	scene = context.scene
+	model_meshes = []
+	meshes_done = set()
+	for o in model.meshes(root):
+		if o.data.as_pointer() in meshes_done or any(s.link == 'OBJECT' for s in o.material_slots):
+			continue
+		meshes_done.add(o.data.as_pointer())
+		model_meshes.append((o.data, MeshLoops(o.data)))
+	atlases = 0
+	for group in atlas_groups(root, model_meshes):
+		images = []
+		for m in group:
+			image = diffuse_texture_node(m).image
+			if image not in images:
+				images.append(image)
+		pixels, rects = build_atlas(images, int(scene.TextureAtlasMaxSize), scene.TextureAtlasPadding)
+		height, width = pixels.shape[0], pixels.shape[1]
+		atlas_image = bpy.data.images.new(root.name + "_atlas", width, height, alpha=True)
+		atlas_image.pixels.foreach_set(pixels.ravel())
+		atlas_image.pack()
+		atlas_material = group[0].copy()
+		atlas_material.name = group[0].name + "_atlas"
+		atlas_material.node_tree.nodes[diffuse_texture_node(group[0]).name].image = atlas_image
+		for k, (mesh, loops) in enumerate(model_meshes):
+			changed = False
+			for slot, slot_material in enumerate(mesh.materials):
+				if slot_material in group:
+					loops.remap(slot, rects[diffuse_texture_node(slot_material).image], width, height)
+					changed = True
+			if changed:
+				loops.write()
+				material_dedup.remap_mesh_materials(mesh, {m: atlas_material for m in group})
+				# the material slots have changed
+				model_meshes[k] = (mesh, MeshLoops(mesh))
+		for m in group:
+			if m.users == 0:
+				bpy.data.materials.remove(m)
+		print("Texture atlas", atlas_image.name, width, "x", height, "for", len(group), "materials")
+		atlases += 1
+	return atlases
+
+
+class TextureAtlas(bpy.types.Operator):
+	"""Packs the diffuse textures of compatible materials into one texture atlas"""
+	bl_idname = "mmd_tools_helper.texture_atlas"
+	bl_label = "Build texture atlas"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	bpy.types.Scene.TextureAtlasMaxSize = bpy.props.EnumProperty(items = [('1024', '1024', '1024 x 1024'), ('2048', '2048', '2048 x 2048'), ('4096', '4096', '4096 x 4096'), ('8192', '8192', '8192 x 8192')], name = "Max Atlas Size", default = '4096')
+
+	bpy.types.Scene.TextureAtlasPadding = bpy.props.IntProperty(name="Padding", description="pixels around each texture in the atlas", default=4, min=0, max=64)
+
+	@classmethod
+	def poll(cls, context):
+		return context.active_object is not None
+
+	def execute(self, context):
+		if context.mode != 'OBJECT':
+			bpy.ops.object.mode_set(mode='OBJECT')
+		atlases = main(context)
+		self.report({'INFO'}, "Built %d texture atlases" % atlases)
+		return {'FINISHED'}
+
+
+def register():
+	bpy.utils.register_class(TextureAtlas)
+	bpy.utils.register_class(TextureAtlasPanel)
+
+
+def unregister():
+	bpy.utils.unregister_class(TextureAtlas)
+	bpy.utils.unregister_class(TextureAtlasPanel)
+
+
+if __name__ == "__main__":
+	register()
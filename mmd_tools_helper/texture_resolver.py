@@ -0,0 +1,169 @@
+# Finds the files of broken texture references of MMD models.
+#
+# MMD models often reference their textures with the wrong case, with names
+# mangled by a Shift-JIS / UTF-8 mix-up (typically when a zip archive made on a
+# Japanese Windows is extracted elsewhere), or in sub-folders which have been
+# moved or renamed. Instead of searching the disk for every missing image, each
+# model folder is walked once and indexed by normalized names (NFKC, case
+# folded, every plausible decoding of the name's bytes). The indexes are kept
+# for the session, so the models of one library share them. An index is walked
+# again when any of its folders has changed (a file added, removed or renamed
+# changes the modification time of its own folder only).
+# This module does not use bpy.
+
+import os
+import threading
+import unicodedata
+
+# how many parent folders of a missing texture are tried to find an existing model folder
+MAX_PARENT_LEVELS = 2
+# folders with more files than this are not indexed (e.g. a whole home directory)
+MAX_INDEXED_FILES = 50000
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def normalize(name):
+	return unicodedata.normalize('NFKC', name).casefold()
+
+
+def name_variants(name):
+	"""Returns the normalized forms of a file name under every plausible decoding of its bytes"""
+	variants = {normalize(name)}
+	raw = os.fsencode(name)
+	candidates = [raw]
+	# names whose Shift-JIS bytes were read as cp437 or latin-1 by an archiver
+	for mangled in ('cp437', 'latin-1'):
+		try:
+			candidates.append(name.encode(mangled))
+		except UnicodeEncodeError:
+			pass
+	for data in candidates:
+		for encoding in ('utf-8', 'cp932'):
+			try:
+				variants.add(normalize(data.decode(encoding)))
+			except UnicodeDecodeError:
+				pass
+	return variants
+
+
+def split_reference(path):
+	"""Splits a texture reference, which may use Windows separators, into its parts"""
+	return [p for p in path.replace('\\', '/').split('/') if p not in ('', '.')]
+
+
+class DirectoryIndex:
+	"""Index of the files below one folder by normalized file name and relative path"""
+
+	def __init__(self, directory):
+		self.directory = directory
+		# stamp of every indexed folder, as a change below the top folder does not touch its own stamp
+		self.stamps = {}
+		self.names = {}
+		self.complete = True
+		count = 0
+		for dirpath, dirnames, filenames in os.walk(directory):
+			dirnames.sort()
+			self.stamps[dirpath] = _directory_stamp(dirpath)
+			for f in sorted(filenames):
+				path = os.path.join(dirpath, f)
+				for variant in name_variants(f):
+					self.names.setdefault(variant, []).append(path)
+				count += 1
+			if count > MAX_INDEXED_FILES:
+				self.complete = False
+				break
+
+	def is_current(self):
+		"""Returns whether none of the indexed folders has changed since the index was made"""
+		for dirpath, stamp in self.stamps.items():
+			try:
+				if _directory_stamp(dirpath) != stamp:
+					return False
+			except OSError:
+				return False
+		return True
+
+	def resolve(self, reference):
+		"""Returns the indexed file best matching a texture reference (a path relative
+		to the folder, or an absolute one), or None"""
+		parts = split_reference(reference)
+		if len(parts) == 0:
+			return None
+		candidates = []
+		for variant in name_variants(parts[-1]):
+			for path in self.names.get(variant, ()):
+				if path not in candidates:
+					candidates.append(path)
+		if len(candidates) <= 1:
+			return candidates[0] if candidates else None
+		# several files have that name: prefer the one whose parent folders match the reference
+		wanted = [name_variants(p) for p in reversed(parts[:-1])]
+
+		def score(path):
+			folders = split_reference(os.path.relpath(os.path.dirname(path), self.directory))
+			matched = 0
+			for variants, folder in zip(wanted, reversed(folders)):
+				if normalize(folder) not in variants:
+					break
+				matched += 1
+			return matched
+
+		return max(candidates, key=score)
+
+
+def _directory_stamp(directory):
+	st = os.stat(directory)
+	return (st.st_mtime_ns, st.st_ino)
+
+
+def directory_index(directory):
+	"""Returns the index of a folder, walking it only the first time or when one of its folders has changed"""
+	directory = os.path.abspath(directory)
+	with _lock:
+		index = _indexes.get(directory)
+		if index is not None and index.is_current():
+			return index
+		index = DirectoryIndex(directory)
+		_indexes[directory] = index
+		return index
+
+
+def invalidate(directory=None):
+	with _lock:
+		if directory is None:
+			_indexes.clear()
+		else:
+			_indexes.pop(os.path.abspath(directory), None)
+
+
+def search_directory(filepath):
+	"""Returns the nearest existing folder of a missing file, at most MAX_PARENT_LEVELS above its own folder"""
+	directory = os.path.dirname(os.path.abspath(filepath))
+	for level in range(MAX_PARENT_LEVELS + 1):
+		if os.path.isdir(directory):
+			return directory
+		parent = os.path.dirname(directory)
+		if parent == directory:
+			break
+		directory = parent
+	return None
+
+
+def resolve(filepath, directory=None):
+	"""Returns the existing file a broken texture path refers to, or None.
+	directory is the model folder to search; by default the nearest existing folder of filepath."""
+	if os.path.isfile(filepath):
+		return filepath
+	if directory is None:
+		directory = search_directory(filepath)
+		if directory is None:
+			return None
+	index = directory_index(directory)
+	if not index.complete:
+		return None
+	reference = filepath
+	if os.path.isabs(filepath):
+		reference = os.path.relpath(os.path.abspath(filepath), directory)
+	return index.resolve(reference)
@@ -1,4 +1,5 @@
 import bpy
+from bpy.app.handlers import persistent
 from . import model
 
  # blend_type
@@ -17,36 +18,182 @@ class MMDToonModifierPanel(bpy.types.Panel):
 		row = layout.row()
 
 		row.label(text="MMD Toon modifier", icon="MATERIAL")
-		layout.prop(context.scene, "ToonModifierBlendType")
-		row = layout.row()
-		layout.prop(context.scene, "ToonModifierColor")
+		root = model.findRoot(context.active_object)
+		if root is not None:
+			layout.prop(root, "mmd_toon_modifier_blend_type")
+			row = layout.row()
+			layout.prop(root, "mmd_toon_modifier_color")
 		row = layout.row()
 		row.operator("mmd_tools_helper.toon_modifier", text = "Modify Toon")
 
-def main(context):
-	mesh_objects_list = model.find_MMD_MeshesList(bpy.context.active_object)
-	# print("mesh_objects_list = ", mesh_objects_list)
-	assert(mesh_objects_list is not None), "The active object is not an MMD model."
-	for o in mesh_objects_list:
-		bpy.context.scene.objects.active = o
-		for m in bpy.context.active_object.data.materials:
+TOON_MODIFIER_NODE = "toon_modifier"
+# The toon modifier color and blend type are properties of the MMD root object,
+# so every model has its own. The color input of the toon modifier nodes is
+# driven by the root's color: dragging it needs no Python, the drivers are
+# evaluated by the depsgraph. Only a new blend type is written to the nodes.
+TOON_MODIFIER_COLOR = "mmd_toon_modifier_color"
+TOON_MODIFIER_BLEND_TYPE = "mmd_toon_modifier_blend_type"
+TOON_MODIFIER_BLEND_TYPES = ["MIX", "ADD", "MULTIPLY", "SUBTRACT", "SCREEN", "DIVIDE", "DIFFERENCE", "DARKEN", "LIGHTEN", "OVERLAY", "DODGE", "BURN", "HUE", "SATURATION", "VALUE", "COLOR", "SOFT_LIGHT", "LINEAR_LIGHT"]
+# Scene properties of older versions, saved in .blend files as plain ID properties
+OLD_SCENE_COLOR = "ToonModifierColor"
+OLD_SCENE_BLEND_TYPE = "ToonModifierBlendType"
+# Custom property of the MMD root object, written by the toon node setup:
+# {'materials': {material name: toon modifier node name}, 'groups': [shared node group names]}
+TOON_MODIFIER_INDEX = "mmd_tools_helper_toon_modifiers"
+
+
+def is_toon_modifier_node(n):
+	return n.name == TOON_MODIFIER_NODE or n.label == TOON_MODIFIER_NODE
+
+
+def read_toon_modifier_index(root):
+	index = root.get(TOON_MODIFIER_INDEX)
+	if index is None:
+		return {'materials': {}, 'groups': []}
+	index = index.to_dict()
+	return {'materials': dict(index.get('materials', {})), 'groups': list(index.get('groups', []))}
+
+
+def index_toon_modifier_nodes(root, materials, groups=()):
+	"""Records the toon modifier nodes of some materials in the model root.
+	materials is {material name: node name}, or None for the materials which use a shared node group."""
+	index = read_toon_modifier_index(root)
+	for material_name, node_name in materials.items():
+		if node_name is None:
+			index['materials'].pop(material_name, None)
+		else:
+			index['materials'][material_name] = node_name
+	for g in groups:
+		if g not in index['groups']:
+			index['groups'].append(g)
+	root[TOON_MODIFIER_INDEX] = index
+
+
+def scan_toon_modifier_nodes(root):
+	"""Finds the toon modifier nodes of a model by looking at every node of its materials,
+	for models set up before the index existed. Rebuilds the index and returns the nodes."""
+	materials = {}
+	groups = []
+	nodes = []
+	for o in model.meshes(root):
+		for m in o.data.materials:
+			if m is None or m.node_tree is None or m.name in materials:
+				continue
 			for n in m.node_tree.nodes:
-				if n.label == "toon_modifier":
-					n.inputs['Color2'].default_value[0] = bpy.context.scene.ToonModifierColor[0]
-					n.inputs['Color2'].default_value[1] = bpy.context.scene.ToonModifierColor[1]
-					n.inputs['Color2'].default_value[2] = bpy.context.scene.ToonModifierColor[2]
-					n.blend_type = bpy.context.scene.ToonModifierBlendType
+				if is_toon_modifier_node(n):
+					materials[m.name] = n.name
+					nodes.append(n)
+				elif n.type == 'GROUP' and n.node_tree is not None and n.node_tree.name not in groups:
+					for group_node in n.node_tree.nodes:
+						if is_toon_modifier_node(group_node):
+							groups.append(n.node_tree.name)
+							nodes.append(group_node)
+	root[TOON_MODIFIER_INDEX] = {'materials': materials, 'groups': groups}
+	return nodes
+
+
+def toon_modifier_nodes(root):
+	"""Returns the toon modifier nodes of a model: one node per shared node group
+	and one per material set up without node groups"""
+	index = read_toon_modifier_index(root)
+	nodes = []
+	for group_name in index['groups']:
+		group = bpy.data.node_groups.get(group_name)
+		n = group.nodes.get(TOON_MODIFIER_NODE) if group is not None else None
+		if n is None:
+			return scan_toon_modifier_nodes(root)
+		nodes.append(n)
+	for material_name, node_name in index['materials'].items():
+		m = bpy.data.materials.get(material_name)
+		n = m.node_tree.nodes.get(node_name) if m is not None and m.node_tree is not None else None
+		if n is None:
+			return scan_toon_modifier_nodes(root)
+		nodes.append(n)
+	if len(nodes) == 0:
+		return scan_toon_modifier_nodes(root)
+	return nodes
+
+
+def drive_toon_modifier_node(n, root):
+	"""Drives the color of a toon modifier node by the toon modifier color of its model root"""
+	color = n.inputs.get('Color2')
+	if color is None:
+		return
+	color.default_value[3] = 1.0
+	path = color.path_from_id('default_value')
+	for i in range(3):
+		# driver_add returns the existing driver of a channel
+		driver = n.id_data.driver_add(path, i).driver
+		driver.type = 'AVERAGE'
+		while len(driver.variables) > 0:
+			driver.variables.remove(driver.variables[0])
+		variable = driver.variables.new()
+		variable.name = "color"
+		variable.type = 'SINGLE_PROP'
+		variable.targets[0].id_type = 'OBJECT'
+		variable.targets[0].id = root
+		variable.targets[0].data_path = "%s[%d]" % (TOON_MODIFIER_COLOR, i)
+
+
+def setup_toon_modifier_node(n, root):
+	if n is None or n.type != 'MIX_RGB':
+		return
+	drive_toon_modifier_node(n, root)
+	n.blend_type = root.mmd_toon_modifier_blend_type
+
+
+def apply_toon_modifier(root):
+	for n in toon_modifier_nodes(root):
+		setup_toon_modifier_node(n, root)
+
+
+def migrate_scene_toon_modifier(scene):
+	"""Moves the toon modifier color and blend type saved on a scene by older versions
+	to the MMD models of the scene which have no values of their own"""
+	color = scene.get(OLD_SCENE_COLOR)
+	blend_type = scene.get(OLD_SCENE_BLEND_TYPE)
+	if color is None and blend_type is None:
+		return
+	for root in scene.objects:
+		if getattr(root, 'mmd_type', None) != 'ROOT':
+			continue
+		if color is not None and root.get(TOON_MODIFIER_COLOR) is None:
+			root.mmd_toon_modifier_color = tuple(color)[:3]
+		if blend_type is not None and root.get(TOON_MODIFIER_BLEND_TYPE) is None and 0 <= blend_type < len(TOON_MODIFIER_BLEND_TYPES):
+			root.mmd_toon_modifier_blend_type = TOON_MODIFIER_BLEND_TYPES[blend_type]
+		apply_toon_modifier(root)
+	for key in (OLD_SCENE_COLOR, OLD_SCENE_BLEND_TYPE):
+		if key in scene:
+			del scene[key]
+
+
+@persistent
+def _load_post(*args):
+	for scene in bpy.data.scenes:
+		migrate_scene_toon_modifier(scene)
+
+
+def update_toon_modifier_blend_type(self, context):
+	"""Applies the blend type of a model root as soon as it is changed in the panel"""
+	blend_type = self.mmd_toon_modifier_blend_type
+	for n in toon_modifier_nodes(self):
+		n.blend_type = blend_type
 
 
+def main(context):
+	root = model.findRoot(context.active_object)
+	assert(root is not None), "The active object is not an MMD model."
+	apply_toon_modifier(root)
+
 
 class MMDToonModifier(bpy.types.Operator):
 	"""User can modify the rendering of toon texture color"""
 	bl_idname = "mmd_tools_helper.toon_modifier"
 	bl_label = "MMD toon modifier"
 
-	bpy.types.Scene.ToonModifierColor = bpy.props.FloatVectorProperty(name="Toon Modifer Color", description="toon modifer color", default=(1.0, 1.0, 1.0), min=0.0, max=1.0, soft_min=0.0, soft_max=1.0, step=3, precision=2, options={'ANIMATABLE'}, subtype='COLOR', unit='NONE', size=3, update=None, get=None, set=None)
+	bpy.types.Object.mmd_toon_modifier_color = bpy.props.FloatVectorProperty(name="Toon Modifer Color", description="toon modifer color of the MMD model", default=(1.0, 1.0, 1.0), min=0.0, max=1.0, soft_min=0.0, soft_max=1.0, step=3, precision=2, options={'ANIMATABLE'}, subtype='COLOR', unit='NONE', size=3)
 
-	bpy.types.Scene.ToonModifierBlendType = bpy.props.EnumProperty(items = [('MIX', 'MIX', 'MIX'), ('ADD', 'ADD', 'ADD'), ('MULTIPLY', 'MULTIPLY', 'MULTIPLY'), ('SUBTRACT', 'SUBTRACT', 'SUBTRACT'), ('SCREEN', 'SCREEN', 'SCREEN'), ('DIVIDE', 'DIVIDE', 'DIVIDE'), ('DIFFERENCE', 'DIFFERENCE', 'DIFFERENCE'), ('DARKEN', 'DARKEN', 'DARKEN'), ('LIGHTEN', 'LIGHTEN', 'LIGHTEN'), ('OVERLAY', 'OVERLAY', 'OVERLAY'), ('DODGE', 'DODGE', 'DODGE'), ('BURN', 'BURN', 'BURN'), ('HUE', 'HUE', 'HUE'), ('SATURATION', 'SATURATION', 'SATURATION'), ('VALUE', 'VALUE', 'VALUE'), ('COLOR', 'COLOR', 'COLOR'), ('SOFT_LIGHT', 'SOFT_LIGHT', 'SOFT_LIGHT'), ('LINEAR_LIGHT', 'LINEAR_LIGHT', 'LINEAR_LIGHT')], name = "Toon Modifier Blend Type", default = 'MULTIPLY')
+	bpy.types.Object.mmd_toon_modifier_blend_type = bpy.props.EnumProperty(items = [(t, t, t) for t in TOON_MODIFIER_BLEND_TYPES], name = "Toon Modifier Blend Type", default = 'MULTIPLY', update=update_toon_modifier_blend_type)
 
 	# @classmethod
 	# def poll(cls, context):
@@ -60,9 +207,13 @@ class MMDToonModifier(bpy.types.Operator):
 def register():
 	bpy.utils.register_class(MMDToonModifier)
 	bpy.utils.register_class(MMDToonModifierPanel)
+	if _load_post not in bpy.app.handlers.load_post:
+		bpy.app.handlers.load_post.append(_load_post)
 
 
 def unregister():
+	if _load_post in bpy.app.handlers.load_post:
+		bpy.app.handlers.load_post.remove(_load_post)
 	bpy.utils.unregister_class(MMDToonModifier)
 	bpy.utils.unregister_class(MMDToonModifierPanel)
 
@@ -0,0 +1,189 @@
+# Cache of the color ramp stops computed from toon textures.
+#
+# Most MMD models share the same few toon textures (toon01.bmp ... toon10.bmp
+# and some common custom ones), so the ramp stops of a toon texture are cached
+# by the hash of the image content: in memory (least recently used entries are
+# dropped first) and in a json file in the add-on's Blender config directory,
+# which is kept across sessions and shared by the batch_pool workers.
+# The cache key also contains the extraction parameters (number of stops ...),
+# so changing them never returns stops computed with other settings.
+# New entries are written to the file by flush(), once per operator run.
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import bpy
+import numpy
+
+CACHE_FILE_NAME = "toon_ramp_cache.json"
+# change this when the ramp extraction changes, to ignore older disk entries
+CACHE_VERSION = 1
+MEMORY_CACHE_SIZE = 256
+DISK_CACHE_SIZE = 4096
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+_disk = None
+# keys put since the cache file was last written
+_unsaved = set()
+# (path, mtime, size) -> hash, so an image file is read once per session
+_file_hashes = {}
+# (packed file pointer, size) -> hash, so packed data is hashed once per session
+_packed_hashes = {}
+
+
+def cache_file_path():
+	directory = bpy.utils.user_resource('CONFIG', path="mmd_tools_helper", create=True)
+	return os.path.join(directory, CACHE_FILE_NAME)
+
+
+def _hash_file(filepath):
+	st = os.stat(filepath)
+	stamp = (filepath, st.st_mtime_ns, st.st_size)
+	digest = _file_hashes.get(stamp)
+	if digest is None:
+		h = hashlib.sha1()
+		with open(filepath, 'rb') as f:
+			for block in iter(lambda: f.read(1024 * 1024), b''):
+				h.update(block)
+		digest = h.hexdigest()
+		_file_hashes[stamp] = digest
+	return digest
+
+
+def image_content_hash(image):
+	"""Returns a hash of the content of an image: of its packed data, of its file,
+	or of its pixels if it has neither (generated or missing file)"""
+	if image.packed_file is not None:
+		packed = image.packed_file
+		stamp = (packed.as_pointer(), packed.size)
+		digest = _packed_hashes.get(stamp)
+		if digest is None:
+			digest = hashlib.sha1(packed.data).hexdigest()
+			_packed_hashes[stamp] = digest
+		return digest
+	filepath = bpy.path.abspath(image.filepath, library=image.library)
+	if filepath != '' and os.path.isfile(filepath):
+		return _hash_file(filepath)
+	width, height = image.size[0], image.size[1]
+	pixels = numpy.empty(width * height * image.channels, dtype=numpy.float32)
+	image.pixels.foreach_get(pixels)
+	h = hashlib.sha1(("%d %d %d " % (width, height, image.channels)).encode('ascii'))
+	h.update(pixels.tobytes())
+	return h.hexdigest()
+
+
+def cache_key(content_hash, **params):
+	return "%d:%s:%s" % (CACHE_VERSION, content_hash, json.dumps(params, sort_keys=True))
+
+
+def _stops_from_json(stops):
+	return [(position, tuple(color)) for position, color in stops]
+
+
+def _read_disk():
+	try:
+		with open(cache_file_path(), encoding='utf-8') as f:
+			data = json.load(f)
+	except (OSError, ValueError):
+		return {}
+	if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+		return {}
+	return data.get('entries', {})
+
+
+def _load_disk():
+	global _disk
+	if _disk is None:
+		_disk = _read_disk()
+	return _disk
+
+
+def _write_disk():
+	# merge with entries written meanwhile by other Blender processes
+	entries = _read_disk()
+	entries.update(_disk)
+	while len(entries) > DISK_CACHE_SIZE:
+		del entries[next(iter(entries))]
+	path = cache_file_path()
+	temp = "%s.%d.tmp" % (path, os.getpid())
+	try:
+		with open(temp, 'w', encoding='utf-8') as f:
+			json.dump({'version': CACHE_VERSION, 'entries': entries}, f)
+		os.replace(temp, path)
+	except OSError as e:
+		print("toon ramp cache: could not write", path, e)
+
+
+def get(key):
+	"""Returns the cached stops of a key, or None"""
+	with _lock:
+		stops = _memory.get(key)
+		if stops is not None:
+			_memory.move_to_end(key)
+			return stops
+		stops = _load_disk().get(key)
+		if stops is None:
+			return None
+		stops = _stops_from_json(stops)
+		_remember(key, stops)
+		return stops
+
+
+def _remember(key, stops):
+	_memory[key] = stops
+	_memory.move_to_end(key)
+	while len(_memory) > MEMORY_CACHE_SIZE:
+		_memory.popitem(last=False)
+
+
+def put(key, stops):
+	"""Caches the stops of a key in memory; they are written to the cache file by flush()"""
+	with _lock:
+		_remember(key, stops)
+		_load_disk()[key] = stops
+		_unsaved.add(key)
+
+
+def flush():
+	"""Writes the entries put since the last flush to the cache file"""
+	with _lock:
+		if len(_unsaved) == 0:
+			return
+		_write_disk()
+		_unsaved.clear()
+
+
+def clear(disk=False):
+	"""Empties the memory cache, and also the cache file with disk=True"""
+	global _disk
+	with _lock:
+		_memory.clear()
+		_file_hashes.clear()
+		_packed_hashes.clear()
+		_unsaved.clear()
+		_disk = None
+		if disk:
+			try:
+				os.remove(cache_file_path())
+			except OSError:
+				pass
+
+
+def ramp_stops(image, extract, **params):
+	"""Returns the ramp stops of a toon image, calling extract(image, **params) only if they are not cached"""
+	try:
+		key = cache_key(image_content_hash(image), **params)
+	except (OSError, RuntimeError) as e:
+		print("toon ramp cache: could not hash", image.name, e)
+		return extract(image, **params)
+	stops = get(key)
+	if stops is None:
+		stops = extract(image, **params)
+		# an image which could not be loaded has no stops, do not remember that
+		if len(stops) > 0:
+			put(key, stops)
+	return stops
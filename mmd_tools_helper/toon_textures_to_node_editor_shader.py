@@ -1,5 +1,13 @@
+import bisect
+import os
+
 import bpy
+import mathutils
+import numpy
 from . import model
+from . import toon_ramp_cache
+from . import toon_modifier
+from . import texture_resolver
 
 
 # Each image is a list of numbers(floats): R,G,B,A,R,G,B,A etc.
@@ -20,42 +28,363 @@ class MMDToonTexturesToNodeEditorShaderPanel(bpy.types.Panel):
 
 		row.label(text="MMD Render Toon Textures", icon="MATERIAL")
 		row = layout.row()
+		layout.prop(context.scene, "ToonRampFitting")
+		if context.scene.ToonRampFitting == 'ADAPTIVE':
+			layout.prop(context.scene, "ToonRampTolerance")
+		row = layout.row()
 		row.operator("mmd_tools_helper.mmd_toon_render_node_editor", text="Create Toon Material Nodes")
 		row = layout.row()
 
 
+TOON_RAMP_MAX_STOPS = 32
+# ADAPTIVE 拟合的默认最大颜色误差（0-1）
+TOON_RAMP_TOLERANCE = 0.01
+
+
+def toon_image_pixels(toon_image):
+	"""一次性读取图像全部像素，返回 (高, 宽, 4) 的 float32 数组（第0行为图像底部）"""
+	width, height = toon_image.size[0], toon_image.size[1]
+	pixels = numpy.empty(width * height * 4, dtype=numpy.float32)
+	toon_image.pixels.foreach_get(pixels)
+	return pixels.reshape(height, width, 4)
+
+
+def toon_gradient(pixels):
+	"""取出TOON纹理变化方向上的一维渐变（每个位置为一行/一列的平均颜色）"""
+	# MMD TOON纹理通常是上下渐变（底部为阴影），比较两个方向上的颜色变化量
+	vertical = numpy.abs(numpy.diff(pixels, axis=0)).sum()
+	horizontal = numpy.abs(numpy.diff(pixels, axis=1)).sum()
+	if vertical >= horizontal:
+		# 从底部到顶部
+		return pixels.mean(axis=1)
+	gradient = pixels.mean(axis=0)
+	# 左右渐变时，让较暗的一端作为渐变起点（阴影）
+	if gradient[0, :3].sum() > gradient[-1, :3].sum():
+		gradient = gradient[::-1]
+	return gradient
+
+
+def fit_gradient(gradient, tolerance, max_stops):
+	"""用最少的控制点分段线性拟合渐变，使每个像素的颜色误差不超过 tolerance（最多 max_stops 个点）
+	每次在误差最大的像素处加入一个控制点（Douglas–Peucker 算法），返回控制点所在像素的下标"""
+	x = numpy.arange(len(gradient))
+	selected = [0, len(gradient) - 1]
+	while len(selected) < max_stops:
+		fitted = numpy.stack([numpy.interp(x, selected, gradient[selected, c]) for c in range(4)], axis=1)
+		error = numpy.abs(fitted - gradient).max(axis=1)
+		worst = int(error.argmax())
+		if error[worst] <= tolerance:
+			break
+		bisect.insort(selected, worst)
+	return numpy.array(selected, dtype=numpy.intp)
+
+
+def toon_image_ramp_stops(toon_image, max_stops=TOON_RAMP_MAX_STOPS, fitting='SAMPLED', tolerance=TOON_RAMP_TOLERANCE):
+	"""由TOON纹理计算颜色渐变的控制点，返回 [(位置, (R, G, B, A)), ...]
+	fitting 为 'SAMPLED' 时等距采样，为 'ADAPTIVE' 时用误差不超过 tolerance 的最少控制点拟合"""
+	if toon_image.size[0] * toon_image.size[1] == 0:
+		return []
+	gradient = toon_gradient(toon_image_pixels(toon_image))
+	count = min(max_stops, len(gradient))
+	if count < 2:
+		return []
+	if fitting == 'ADAPTIVE':
+		gradient = gradient.copy()
+		# 先应用透明规则再拟合，使拟合结果保留透明的边界
+		middle = numpy.arange(len(gradient))
+		gradient[(middle > (len(gradient) - 1) / 2) & (middle < len(gradient) - 1), 3] = 0.0
+		indices = fit_gradient(gradient, tolerance, count)
+		samples = gradient[indices]
+		positions = indices / (len(gradient) - 1)
+	else:
+		# 在渐变上等距采样（最多32个采样点，避免像素过多导致节点异常）
+		samples = gradient[numpy.linspace(0, len(gradient) - 1, count).round().astype(numpy.intp)].copy()
+		# 后半段渐变设为透明（MMD TOON纹理特性），首尾两点除外
+		middle = numpy.arange(count)
+		samples[(middle > count / 2) & (middle < count - 1), 3] = 0.0
+		positions = numpy.arange(count) / (count - 1)
+	return [(float(p), tuple(float(c) for c in color)) for p, color in zip(positions, samples)]
+
+
+def set_color_ramp_stops(toon_texture_color_ramp, stops):
+	"""把控制点写入颜色渐变节点"""
+	if len(stops) < 2:
+		return
+	elements = toon_texture_color_ramp.color_ramp.elements
+	elements[0].color = stops[0][1]
+	elements[-1].color = stops[-1][1]
+	for position, color in stops[1:-1]:
+		elements.new(position).color = color
+
+
 def toon_image_to_color_ramp(toon_texture_color_ramp, toon_image):
 	"""将TOON纹理图像转换为颜色渐变节点"""
-	pixels_width = toon_image.size[0]
-	pixels_height = toon_image.size[1]
-	toon_image_pixels = []
-	toon_image_gradient = []
-
-	# 提取像素RGBA数据
-	for f in range(0, len(toon_image.pixels), 4):
-		pixel_rgba = toon_image.pixels[f:f+4]
-		toon_image_pixels.append(pixel_rgba)
-
-	# 采样生成渐变（避免像素过多导致节点异常）
-	sample_step = max(1, int(len(toon_image_pixels) / 32))  # 最多32个采样点
-	for p in range(0, len(toon_image_pixels), sample_step):
-		toon_image_gradient.append(toon_image_pixels[p])
-
-	# 设置渐变首尾颜色
-	if len(toon_image_gradient) >= 2:
-		toon_texture_color_ramp.color_ramp.elements[0].color = toon_image_gradient[0]
-		toon_texture_color_ramp.color_ramp.elements[-1].color = toon_image_gradient[-1]
-
-	# 添加中间渐变点
-	for i in range(1, len(toon_image_gradient)-1):
-		# 计算渐变位置（0-1范围）
-		position = i / (len(toon_image_gradient) - 1)
-		elem = toon_texture_color_ramp.color_ramp.elements.new(position)
-		elem.color = toon_image_gradient[i]
-		# 后半段渐变设为透明（MMD TOON纹理特性）
-		if i > len(toon_image_gradient) / 2:
-			elem.color[3] = 0.0  # Alpha通道设为0
-	return
+	# 相同内容的TOON纹理只计算一次（见 toon_ramp_cache）
+	scene = bpy.context.scene
+	params = {'max_stops': TOON_RAMP_MAX_STOPS, 'fitting': scene.ToonRampFitting}
+	# 容差只影响自适应拟合，均匀采样的缓存键不含容差
+	if scene.ToonRampFitting == 'ADAPTIVE':
+		params['tolerance'] = round(scene.ToonRampTolerance, 6)
+	stops = toon_ramp_cache.ramp_stops(toon_image, toon_image_ramp_stops, **params)
+	set_color_ramp_stops(toon_texture_color_ramp, stops)
+
+
+def mmd_texture_slot_images(mat):
+	"""读取材质的MMD纹理槽（0=漫反射，1=TOON，2=球面）
+	返回 (漫反射图像, TOON图像, 球面图像, 球面混合模式)，没有的为 None"""
+	# 注意：Blender 2.8+ 移除了 texture_slots，需通过旧版数据或手动关联纹理
+	# 实际使用时建议直接在图像纹理节点中加载纹理，或通过自定义属性关联
+	images = [None, None, None]
+	sphere_blend_type = None
+	if hasattr(mat, 'mmd_texture_slots'):  # 若材质有自定义MMD纹理槽属性
+		for idx, tex in enumerate(mat.mmd_texture_slots):
+			if idx > 2:
+				break
+			if not tex or not tex.texture:
+				continue
+			tex_obj = tex.texture
+			if tex_obj.type == 'IMAGE' and tex_obj.image:
+				images[idx] = tex_obj.image
+				if idx == 2 and hasattr(tex, 'blend_type'):
+					sphere_blend_type = tex.blend_type
+	return images[0], images[1], images[2], sphere_blend_type
+
+
+# 模型节点组：同一模型的所有材质共用一份TOON光照与颜色合成逻辑，每个材质只保留
+# 自己的纹理节点和颜色渐变（TOON纹理不同），大幅减少节点数量与着色器编译时间。
+# 颜色渐变位于两个节点组之间，因此分为两个节点组。
+# 节点组按模型分别创建（名称后附根对象名），TOON修改节点在组内，
+# 修改一个模型的TOON颜色不会影响其他模型。
+# 光照因子在 EEVEE 中使用 Shader to RGB（含投射阴影）；Cycles 不支持，改用
+# 半兰伯特光照（不含投射阴影），切换渲染引擎后需重新创建TOON节点。
+TOON_LIGHT_FACTOR_GROUP = "MMD Toon Light Factor"
+TOON_COMBINE_GROUP = "MMD Toon Combine"
+# 模型根对象的自定义属性：{节点组基础名称: 该模型的节点组名称}
+TOON_NODE_GROUPS = "mmd_tools_helper_toon_node_groups"
+# 节点组的自定义属性：光照因子节点组适用的渲染引擎（'EEVEE' 或 'CYCLES'）
+TOON_GROUP_ENGINE = "mmd_tools_helper_engine"
+TOON_LIGHT_DIRECTION_NODE = "light_direction"
+
+
+def toon_engine(scene):
+	return 'CYCLES' if scene.render.engine == 'CYCLES' else 'EEVEE'
+
+
+def sun_light_direction(sun_lamp):
+	"""返回指向太阳灯的方向（世界坐标），找不到太阳灯物体时为正上方"""
+	sun_obj = next((o for o in bpy.data.objects if o.data == sun_lamp), None)
+	if sun_obj is None:
+		return (0.0, 0.0, 1.0)
+	direction = sun_obj.matrix_world.to_3x3() @ mathutils.Vector((0.0, 0.0, 1.0))
+	return tuple(direction.normalized())
+
+
+def model_node_group(root, base_name, build, engine=None):
+	"""获取/创建模型专用的节点组；不属于MMD模型的物体使用按基础名称共享的节点组"""
+	if root is None:
+		group = bpy.data.node_groups.get(base_name)
+	else:
+		names = root.get(TOON_NODE_GROUPS)
+		name = names.get(base_name) if names is not None else None
+		group = bpy.data.node_groups.get(name) if name else None
+	if group is not None and group.bl_idname == 'ShaderNodeTree' and group.get(TOON_GROUP_ENGINE) == engine:
+		return group
+	group = bpy.data.node_groups.new(base_name if root is None else f"{base_name} ({root.name})", 'ShaderNodeTree')
+	if engine is not None:
+		group[TOON_GROUP_ENGINE] = engine
+	build(group)
+	if root is not None:
+		names = root.get(TOON_NODE_GROUPS)
+		names = names.to_dict() if names is not None else {}
+		names[base_name] = group.name
+		root[TOON_NODE_GROUPS] = names
+	return group
+
+
+def build_toon_light_factor_group(group, engine):
+	group.outputs.new('NodeSocketFloat', "Fac")
+	nodes = group.nodes
+	links = group.links
+	group_output = nodes.new(type='NodeGroupOutput')
+	group_output.location = (100, 0)
+
+	if engine == 'CYCLES':
+		# Cycles 不支持 Shader to RGB（结果为黑色），改用半兰伯特光照：
+		# (法线 · 太阳灯方向) * 0.5 + 0.5，不含投射阴影；太阳灯方向在创建节点时写入
+		geometry = nodes.new(type='ShaderNodeNewGeometry')
+		geometry.location = (-700, 0)
+		dot = nodes.new(type='ShaderNodeVectorMath')
+		dot.operation = 'DOT_PRODUCT'
+		dot.name = TOON_LIGHT_DIRECTION_NODE
+		dot.location = (-500, 0)
+		half_lambert = nodes.new(type='ShaderNodeMath')
+		half_lambert.operation = 'MULTIPLY_ADD'
+		half_lambert.inputs[1].default_value = 0.5
+		half_lambert.inputs[2].default_value = 0.5
+		half_lambert.use_clamp = True
+		half_lambert.location = (-300, 0)
+		links.new(dot.inputs[0], geometry.outputs['Normal'])
+		links.new(half_lambert.inputs[0], dot.outputs['Value'])
+		links.new(group_output.inputs['Fac'], half_lambert.outputs['Value'])
+		return
+
+	# Blender 2.8+ 的材质中没有灯光数据节点，用漫反射BSDF + Shader to RGB 得到
+	# 包含灯光方向与阴影的光照强度（仅 EEVEE 支持）
+	diffuse_bsdf = nodes.new(type='ShaderNodeBsdfDiffuse')
+	diffuse_bsdf.inputs['Color'].default_value = (1.0, 1.0, 1.0, 1.0)
+	diffuse_bsdf.location = (-500, 0)
+	shader_to_rgb = nodes.new(type='ShaderNodeShaderToRGB')
+	shader_to_rgb.location = (-300, 0)
+	rgb_to_bw = nodes.new(type='ShaderNodeRGBToBW')
+	rgb_to_bw.location = (-100, 0)
+
+	links.new(shader_to_rgb.inputs['Shader'], diffuse_bsdf.outputs['BSDF'])
+	links.new(rgb_to_bw.inputs['Color'], shader_to_rgb.outputs['Color'])
+	links.new(group_output.inputs['Fac'], rgb_to_bw.outputs['Val'])
+
+
+def toon_light_factor_group(root, engine='EEVEE', light_direction=(0.0, 0.0, 1.0)):
+	"""获取/创建模型的光照因子节点组（输出 Fac：0 = 阴影，1 = 受光）
+	EEVEE 与 Cycles 使用不同的节点，切换渲染引擎后需重新创建TOON节点"""
+	group = model_node_group(root, TOON_LIGHT_FACTOR_GROUP, lambda g: build_toon_light_factor_group(g, engine), engine)
+	direction_node = group.nodes.get(TOON_LIGHT_DIRECTION_NODE)
+	if direction_node is not None:
+		direction_node.inputs[1].default_value = light_direction
+	return group
+
+
+def toon_combine_group(root):
+	"""获取/创建模型的颜色合成节点组：TOON颜色 x 修改色 x 漫反射 + 球面纹理"""
+	return model_node_group(root, TOON_COMBINE_GROUP, build_toon_combine_group)
+
+
+def build_toon_combine_group(group):
+	group.inputs.new('NodeSocketColor', "Toon Color").default_value = (1.0, 1.0, 1.0, 1.0)
+	toon_alpha = group.inputs.new('NodeSocketFloatFactor', "Toon Alpha")
+	toon_alpha.default_value = 1.0
+	toon_alpha.min_value = 0.0
+	toon_alpha.max_value = 1.0
+	group.inputs.new('NodeSocketColor', "Diffuse").default_value = (1.0, 1.0, 1.0, 1.0)
+	group.inputs.new('NodeSocketColor', "Sphere").default_value = (0.0, 0.0, 0.0, 1.0)
+	group.outputs.new('NodeSocketColor', "Color")
+	# 不含球面纹理的颜色，供球面混合模式不是 ADD 的材质使用
+	group.outputs.new('NodeSocketColor', "Toon Diffuse")
+	nodes = group.nodes
+	links = group.links
+
+	group_input = nodes.new(type='NodeGroupInput')
+	group_input.location = (-300, 0)
+
+	# TOON颜色修改节点（由 toon_modifier 设置颜色与混合模式，模型的所有材质共用）
+	mix_rgb_toon = nodes.new(type='ShaderNodeMixRGB')
+	mix_rgb_toon.name = toon_modifier.TOON_MODIFIER_NODE
+	mix_rgb_toon.label = toon_modifier.TOON_MODIFIER_NODE
+	mix_rgb_toon.blend_type = 'MULTIPLY'
+	mix_rgb_toon.inputs['Color2'].default_value = (1.0, 1.0, 1.0, 1.0)
+	mix_rgb_toon.location = (0, 100)
+
+	mix_rgb_diffuse = nodes.new(type='ShaderNodeMixRGB')
+	mix_rgb_diffuse.blend_type = 'MULTIPLY'
+	mix_rgb_diffuse.inputs['Fac'].default_value = 1.0
+	mix_rgb_diffuse.location = (200, 100)
+
+	mix_rgb_sphere = nodes.new(type='ShaderNodeMixRGB')
+	mix_rgb_sphere.blend_type = 'ADD'
+	mix_rgb_sphere.inputs['Fac'].default_value = 1.0
+	mix_rgb_sphere.location = (400, 100)
+
+	group_output = nodes.new(type='NodeGroupOutput')
+	group_output.location = (600, 0)
+
+	links.new(mix_rgb_toon.inputs['Fac'], group_input.outputs['Toon Alpha'])
+	links.new(mix_rgb_toon.inputs['Color1'], group_input.outputs['Toon Color'])
+	links.new(mix_rgb_diffuse.inputs['Color1'], mix_rgb_toon.outputs['Color'])
+	links.new(mix_rgb_diffuse.inputs['Color2'], group_input.outputs['Diffuse'])
+	links.new(mix_rgb_sphere.inputs['Color1'], mix_rgb_diffuse.outputs['Color'])
+	links.new(mix_rgb_sphere.inputs['Color2'], group_input.outputs['Sphere'])
+	links.new(group_output.inputs['Color'], mix_rgb_sphere.outputs['Color'])
+	links.new(group_output.inputs['Toon Diffuse'], mix_rgb_diffuse.outputs['Color'])
+
+
+def create_toon_group_nodes(mat, principled_node, light_factor_group, combine_group):
+	"""用模型节点组为一个材质创建TOON节点，每个材质只有约6个节点"""
+	nodes = mat.node_tree.nodes
+	links = mat.node_tree.links
+	diffuse_image, toon_image, sphere_image, sphere_blend_type = mmd_texture_slot_images(mat)
+
+	light_factor = nodes.new(type='ShaderNodeGroup')
+	light_factor.node_tree = light_factor_group
+	light_factor.location = (-90, 470)
+
+	toon_color_ramp = nodes.new(type='ShaderNodeValToRGB')
+	toon_color_ramp.location = (120, 470)
+	links.new(toon_color_ramp.inputs['Fac'], light_factor.outputs['Fac'])
+	if toon_image:
+		toon_image_to_color_ramp(toon_color_ramp, toon_image)
+
+	combine = nodes.new(type='ShaderNodeGroup')
+	combine.node_tree = combine_group
+	combine.location = (690, 470)
+	links.new(combine.inputs['Toon Color'], toon_color_ramp.outputs['Color'])
+	links.new(combine.inputs['Toon Alpha'], toon_color_ramp.outputs['Alpha'])
+
+	if diffuse_image:
+		diffuse_tex = nodes.new(type='ShaderNodeTexImage')
+		diffuse_tex.image = diffuse_image
+		diffuse_tex.location = (420, 250)  # 未连接矢量输入时使用默认UV
+		links.new(combine.inputs['Diffuse'], diffuse_tex.outputs['Color'])
+	else:
+		# 若无漫反射纹理，使用材质基础色
+		combine.inputs['Diffuse'].default_value = principled_node.inputs['Base Color'].default_value
+
+	color_output = combine.outputs['Color']
+	if sphere_image:
+		tex_coord = nodes.new(type='ShaderNodeTexCoord')
+		tex_coord.location = (220, -50)
+		sphere_tex = nodes.new(type='ShaderNodeTexImage')
+		sphere_tex.image = sphere_image
+		sphere_tex.location = (420, -50)
+		links.new(sphere_tex.inputs['Vector'], tex_coord.outputs['Normal'])  # 法线控制球面纹理
+		if sphere_blend_type is None or sphere_blend_type == 'ADD':
+			links.new(combine.inputs['Sphere'], sphere_tex.outputs['Color'])
+		else:
+			# 球面混合模式不是 ADD 时在节点组外混合
+			mix_rgb_sphere = nodes.new(type='ShaderNodeMixRGB')
+			mix_rgb_sphere.blend_type = sphere_blend_type
+			mix_rgb_sphere.inputs['Fac'].default_value = 1.0
+			mix_rgb_sphere.location = (1000, 470)
+			links.new(mix_rgb_sphere.inputs['Color1'], combine.outputs['Toon Diffuse'])
+			links.new(mix_rgb_sphere.inputs['Color2'], sphere_tex.outputs['Color'])
+			color_output = mix_rgb_sphere.outputs['Color']
+
+	links.new(principled_node.inputs['Base Color'], color_output)  # 最终颜色输入
+
+
+def resolve_missing_images(mesh_objects_list):
+	"""为文件丢失的纹理查找正确的文件（大小写、SJIS文件名、移动过的子文件夹），返回修复的图像数量
+	每个模型文件夹只遍历一次（见 texture_resolver）"""
+	images = set()
+	for obj in mesh_objects_list:
+		for mat in obj.data.materials:
+			if not mat:
+				continue
+			images.update(i for i in mmd_texture_slot_images(mat)[:3] if i is not None)
+			if mat.use_nodes and mat.node_tree:
+				images.update(n.image for n in mat.node_tree.nodes if n.type == 'TEX_IMAGE' and n.image is not None)
+	resolved = 0
+	for image in images:
+		if image.source != 'FILE' or image.packed_file is not None:
+			continue
+		filepath = bpy.path.abspath(image.filepath, library=image.library)
+		if filepath == '' or os.path.isfile(filepath):
+			continue
+		found = texture_resolver.resolve(filepath)
+		if found is not None:
+			print("Resolved missing texture", filepath, "->", found)
+			image.filepath = found
+			image.reload()
+			resolved += 1
+	return resolved
 
 
 def clear_material_nodes(context):
@@ -91,6 +420,14 @@ def main(context):
 		context.scene.collection.objects.link(lamp_obj)
 		context.scene.view_layers[0].objects.active = obj  # 恢复选中物体为活跃
 
+	# 每个材质只保留纹理节点和颜色渐变，光照与颜色合成在模型节点组中
+	# （旧版逐材质节点使用的灯光数据、几何节点在 Blender 2.8+ 中已不存在）
+	root = model.findRoot(obj)
+	light_factor_group = toon_light_factor_group(root, toon_engine(context.scene), sun_light_direction(sun_lamp))
+	combine_group = toon_combine_group(root)
+	# 材质名 -> None：这些材质的TOON修改节点在模型节点组中，记录在模型根对象上供 toon_modifier 使用
+	toon_modifier_nodes = {}
+
 	# 遍历物体的所有材质
 	for mat in obj.data.materials:
 		if not mat:
@@ -112,138 +449,17 @@ def main(context):
 		if not principled_node:
 			principled_node = nodes.new(type='ShaderNodeBsdfPrincipled')
 		principled_node.location = (-800, 800)
-		principled_node.inputs['Base Color'].default_value = (*mat.diffuse_color, 1.0)  # 同步漫反射色
-
-		# 2. 创建TOON效果所需节点
-		# 灯光数据节点（获取灯光方向和阴影信息）
-		lamp_node = nodes.new(type='ShaderNodeLightData')
-		lamp_node.light_object = bpy.data.objects[sun_lamp.name]  # 关联太阳灯物体
-		lamp_node.location = (-530, -50)
-
-		# RGB转灰度节点（处理阴影）
-		rgb_to_bw = nodes.new(type='ShaderNodeRGBToBW')
-		rgb_to_bw.location = (-90, -50)
-
-		# 向量点积节点（计算法线与灯光方向夹角）
-		vector_math_dot = nodes.new(type='ShaderNodeVectorMath')
-		vector_math_dot.operation = 'DOT_PRODUCT'
-		vector_math_dot.location = (-520, 470)
-
-		# 数学节点（调整点积结果范围）
-		math_add = nodes.new(type='ShaderNodeMath')
-		math_add.operation = 'ADD'
-		math_add.inputs[1].default_value = 1.0
-		math_add.location = (-325, 470)
-
-		math_mul1 = nodes.new(type='ShaderNodeMath')
-		math_mul1.operation = 'MULTIPLY'
-		math_mul1.inputs[1].default_value = 0.5
-		math_mul1.location = (-90, 470)
-
-		math_mul2 = nodes.new(type='ShaderNodeMath')
-		math_mul2.operation = 'MULTIPLY'
-		math_mul2.location = (120, 470)
-
-		# 颜色渐变节点（TOON核心效果）
-		toon_color_ramp = nodes.new(type='ShaderNodeValToRGB')
-		toon_color_ramp.location = (340, 470)
-
-		# 混合RGB节点（TOON颜色叠加）
-		mix_rgb_toon = nodes.new(type='ShaderNodeMixRGB')
-		mix_rgb_toon.blend_type = 'MULTIPLY'
-		mix_rgb_toon.inputs['Fac'].default_value = 1.0
-		mix_rgb_toon.inputs['Color2'].default_value = (1.0, 1.0, 1.0, 1.0)
-		mix_rgb_toon.location = (690, 470)
-		mix_rgb_toon.label = "Toon Modifier"
-
-		# 混合RGB节点（漫反射色混合）
-		mix_rgb_diffuse = nodes.new(type='ShaderNodeMixRGB')
-		mix_rgb_diffuse.blend_type = 'MULTIPLY'
-		mix_rgb_diffuse.inputs['Fac'].default_value = 1.0
-		mix_rgb_diffuse.location = (1000, 470)
-
-		# 混合RGB节点（球面纹理叠加）
-		mix_rgb_sphere = nodes.new(type='ShaderNodeMixRGB')
-		mix_rgb_sphere.blend_type = 'ADD'
-		mix_rgb_sphere.inputs['Fac'].default_value = 1.0
-		mix_rgb_sphere.location = (1240, 470)
-
-		# 几何节点（获取UV和法线）
-		geo_uv = nodes.new(type='ShaderNodeGeometry')
-		geo_uv.location = (620, 250)
-
-		geo_normal = nodes.new(type='ShaderNodeGeometry')
-		geo_normal.location = (620, -50)
-
-		# 图像纹理节点（漫反射和球面纹理）
-		diffuse_tex = nodes.new(type='ShaderNodeTexImage')
-		diffuse_tex.location = (820, 250)
-
-		sphere_tex = nodes.new(type='ShaderNodeTexImage')
-		sphere_tex.location = (820, -50)
-
-		# 3. 连接节点链路
-		# 基础链路：原理化BSDF -> 输出节点
+		principled_node.inputs['Base Color'].default_value = (*mat.diffuse_color[:3], 1.0)  # 同步漫反射色
 		links.new(output_node.inputs['Surface'], principled_node.outputs['BSDF'])
 
-		# TOON灯光计算链路
-		links.new(vector_math_dot.inputs[0], principled_node.outputs['Normal'])  # 物体法线
-		links.new(vector_math_dot.inputs[1], lamp_node.outputs['Light Direction'])  # 灯光方向
-		links.new(math_add.inputs[0], vector_math_dot.outputs['Value'])  # 点积结果+1
-		links.new(math_mul1.inputs[0], math_add.outputs['Value'])  # 结果*0.5（范围缩至0-1）
-
-		# 阴影处理链路
-		links.new(rgb_to_bw.inputs['Color'], lamp_node.outputs['Shadow'])  # 阴影转灰度
-		links.new(math_mul2.inputs[0], math_mul1.outputs['Value'])  # 灯光因子 * 阴影因子
-		links.new(math_mul2.inputs[1], rgb_to_bw.outputs['Value'])
-
-		# TOON渐变链路
-		links.new(toon_color_ramp.inputs['Fac'], math_mul2.outputs['Value'])  # 因子控制渐变
-		links.new(mix_rgb_toon.inputs['Color1'], toon_color_ramp.outputs['Color'])  # 渐变颜色
-		links.new(mix_rgb_toon.inputs['Fac'], toon_color_ramp.outputs['Alpha'])  # 渐变透明度
-
-		# 漫反射纹理链路
-		links.new(diffuse_tex.inputs['Vector'], geo_uv.outputs['UV'])  # UV控制纹理坐标
-		links.new(mix_rgb_diffuse.inputs['Color1'], mix_rgb_toon.outputs['Color'])  # TOON色
-		links.new(mix_rgb_diffuse.inputs['Color2'], diffuse_tex.outputs['Color'])  # 漫反射纹理
-
-		# 球面纹理链路
-		links.new(sphere_tex.inputs['Vector'], geo_normal.outputs['Normal'])  # 法线控制球面纹理
-		links.new(mix_rgb_sphere.inputs['Color1'], mix_rgb_diffuse.outputs['Color'])  # 漫反射+TOON
-		links.new(mix_rgb_sphere.inputs['Color2'], sphere_tex.outputs['Color'])  # 球面纹理
-
-		# 最终输出链路
-		links.new(principled_node.inputs['Base Color'], mix_rgb_sphere.outputs['Color'])  # 最终颜色输入
-
-		# 4. 读取材质纹理槽（适配Blender 2.8+ 纹理系统：材质使用节点，纹理通过图像纹理节点加载）
-		# 注意：Blender 2.8+ 移除了 texture_slots，需通过旧版数据或手动关联纹理
-		# 此处兼容旧版MMD材质的纹理索引（0=漫反射，1=TOON，2=球面）
-		# 实际使用时建议直接在图像纹理节点中加载纹理，或通过自定义属性关联
-		if hasattr(mat, 'mmd_texture_slots'):  # 若材质有自定义MMD纹理槽属性
-			texture_slots = mat.mmd_texture_slots
-			for idx, tex in enumerate(texture_slots):
-				if not tex or not tex.texture:
-					continue
-				tex_obj = tex.texture
-				if idx == 0 and tex_obj.type == 'IMAGE' and tex_obj.image:
-					# 漫反射纹理
-					diffuse_tex.image = tex_obj.image
-				elif idx == 1 and tex_obj.type == 'IMAGE' and tex_obj.image:
-					# TOON纹理：生成渐变
-					toon_image_to_color_ramp(toon_color_ramp, tex_obj.image)
-				elif idx == 2 and tex_obj.type == 'IMAGE' and tex_obj.image:
-					# 球面纹理
-					sphere_tex.image = tex_obj.image
-					# 同步混合模式
-					if hasattr(tex, 'blend_type'):
-						mix_rgb_sphere.blend_type = tex.blend_type
+		# 2. 创建TOON节点
+		create_toon_group_nodes(mat, principled_node, light_factor_group, combine_group)
+		toon_modifier_nodes[mat.name] = None
 
-		# 若无漫反射纹理，使用材质基础色
-		if not diffuse_tex.image:
-			# 移除原有Color2连接，连接材质基础色
-			if mix_rgb_diffuse.inputs['Color2'].links:
-				links.remove(mix_rgb_diffuse.inputs['Color2'].links[0])
-			links.new(mix_rgb_diffuse.inputs['Color2'], principled_node.inputs['Base Color'])
+	if root is not None:
+		toon_modifier.index_toon_modifier_nodes(root, toon_modifier_nodes, [combine_group.name])
+		# TOON修改色由模型根对象的属性经驱动器实时控制
+		toon_modifier.setup_toon_modifier_node(combine_group.nodes[toon_modifier.TOON_MODIFIER_NODE], root)
 
 
 class MMDToonTexturesToNodeEditorShader(bpy.types.Operator):
@@ -252,6 +468,10 @@ class MMDToonTexturesToNodeEditorShader(bpy.types.Operator):
 	bl_label = "Create MMD Toon Material Nodes"
 	bl_options = {'REGISTER', 'UNDO'}  # 支持撤销
 
+	bpy.types.Scene.ToonRampFitting = bpy.props.EnumProperty(items = [('SAMPLED', 'Sampled', 'Up to 32 evenly spaced color ramp stops'), ('ADAPTIVE', 'Adaptive', 'As few color ramp stops as the max color error allows')], name = "Toon Ramp", default = 'SAMPLED')
+
+	bpy.types.Scene.ToonRampTolerance = bpy.props.FloatProperty(name="Max Color Error", description="largest color difference allowed between the toon texture and the fitted color ramp", default=TOON_RAMP_TOLERANCE, min=0.0, max=1.0, precision=3, step=0.1)
+
 	@classmethod
 	def poll(cls, context):
 		"""仅当活跃物体存在且为网格时可用"""
@@ -265,6 +485,9 @@ class MMDToonTexturesToNodeEditorShader(bpy.types.Operator):
 				self.report({'ERROR'}, "Active object is not an MMD model.")
 				return {'CANCELLED'}
 
+			# 先修复丢失的纹理文件，以便读取TOON纹理的像素
+			resolve_missing_images(mesh_objects_list)
+
 			# 为每个网格物体创建节点
 			for obj in mesh_objects_list:
 				context.view_layer.objects.active = obj  # 切换活跃物体
@@ -276,6 +499,9 @@ class MMDToonTexturesToNodeEditorShader(bpy.types.Operator):
 		except Exception as e:
 			self.report({'ERROR'}, f"Failed to create nodes: {str(e)}")
 			return {'CANCELLED'}
+		finally:
+			# 新计算的TOON渐变一次性写入缓存文件
+			toon_ramp_cache.flush()
 
 
 def register():
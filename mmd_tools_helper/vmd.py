@@ -0,0 +1,258 @@
+# Streaming VMD motion retargeting between bone maps.
+#
+# Renames the bone keyframes of a VMD motion file with the bones dictionaries
+# used by the Bones Renamer, so that motions authored for the original bone
+# names keep working after an armature has been renamed. The file is processed
+# in fixed size chunks of 111 byte bone keyframe records with constant memory.
+# The bone names of the IK on/off keyframes are renamed the same way; the
+# morph, camera, light and self shadow keyframes are copied unchanged.
+# This module does not use bpy:
+#
+#   python mmd_tools_helper/vmd.py --rename mmd_japanese mmd_english dance.vmd dance_english.vmd
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+
+try:
+	from . import bone_maps
+except ImportError:
+	# run as a script, outside the add-on package
+	import bone_maps
+
+VMD_SIGNATURE = b'Vocaloid Motion Data 0002'
+VMD_SIGNATURE_OLD = b'Vocaloid Motion Data file'
+BONE_FRAME_SIZE = 111
+BONE_NAME_SIZE = 15
+# IK on/off keyframes name their bones with 20 bytes
+IK_NAME_SIZE = 20
+IK_FRAME_HEADER_SIZE = 9
+IK_STATE_SIZE = IK_NAME_SIZE + 1
+# record sizes of the sections between the bone and the IK keyframes
+MORPH_FRAME_SIZE = 23
+CAMERA_FRAME_SIZE = 61
+LIGHT_FRAME_SIZE = 28
+SELF_SHADOW_FRAME_SIZE = 9
+# MikuMikuDance stores names as Shift-JIS (Windows code page 932)
+NAME_ENCODING = 'cp932'
+
+
+class VMDError(Exception):
+	pass
+
+
+_RENAME, _KEEP, _UNMAPPED, _DROP = range(4)
+
+
+def decode_name(field):
+	return field.split(b'\0', 1)[0].decode(NAME_ENCODING, errors='replace')
+
+
+def encode_name(name, size=BONE_NAME_SIZE):
+	"""Encodes a name as MMD does: Shift-JIS, cut to size bytes"""
+	return name.encode(NAME_ENCODING, errors='replace')[:size]
+
+
+def _name_field(encoded, size=BONE_NAME_SIZE):
+	return encoded + b'\0' * (size - len(encoded))
+
+
+def build_translation(from_map, to_map, size=BONE_NAME_SIZE):
+	"""Returns {encoded from_map name: size byte name field of the to_map name} for both bones dictionaries.
+	Keys are encoded and cut exactly as MMD writes names, so names longer than size bytes still match."""
+	translation = {}
+	for table in bone_maps.tables():
+		if from_map not in table.columns or to_map not in table.columns:
+			continue
+		for name in table.index[from_map]:
+			key = encode_name(name, size)
+			if key in translation:
+				continue
+			translated = table.translate(name, from_map, to_map)
+			if translated is not None:
+				translation[key] = _name_field(encode_name(translated, size), size)
+	return translation
+
+
+class _Renamer:
+	"""Decides once per distinct name field whether a keyframe is renamed, kept or dropped"""
+
+	def __init__(self, from_map, to_map, drop_unmapped):
+		self.from_map = from_map
+		self.to_map = to_map
+		self.drop_unmapped = drop_unmapped
+		self.translations = {}
+		self.decisions = {}
+		self.unmapped = {}
+
+	def decide(self, field):
+		"""Returns (action, new name field or decoded name) for a name field of any size"""
+		decision = self.decisions.get(field)
+		if decision is None:
+			size = len(field)
+			if size not in self.translations:
+				translation = build_translation(self.from_map, self.to_map, size)
+				# destination names are already correct and are never reported as unmapped
+				self.translations[size] = (translation, set(translation.values()))
+			translation, known = self.translations[size]
+			name = field.split(b'\0', 1)[0]
+			if name in translation and translation[name] != _name_field(name, size):
+				decision = (_RENAME, translation[name])
+			elif name in translation or _name_field(name, size) in known:
+				decision = (_KEEP, None)
+			else:
+				decision = (_DROP if self.drop_unmapped else _UNMAPPED, decode_name(field))
+			self.decisions[field] = decision
+		if decision[0] in (_UNMAPPED, _DROP):
+			self.unmapped[decision[1]] = self.unmapped.get(decision[1], 0) + 1
+		return decision
+
+
+def read_header(f):
+	signature = f.read(30)
+	if signature.startswith(VMD_SIGNATURE):
+		model_name_size = 20
+	elif signature.startswith(VMD_SIGNATURE_OLD):
+		model_name_size = 10
+	else:
+		raise VMDError("Not a VMD file")
+	model_name = f.read(model_name_size)
+	return signature + model_name, decode_name(model_name)
+
+
+def _copy_bytes(src, dst, size):
+	while size > 0:
+		data = src.read(min(size, 1024 * 1024))
+		if len(data) == 0:
+			raise VMDError("Truncated VMD file")
+		dst.write(data)
+		size -= len(data)
+
+
+def _copy_section(src, dst, record_size):
+	"""Copies a keyframe section. Returns False if the file ends before it (older files omit the last sections)."""
+	count_data = src.read(4)
+	dst.write(count_data)
+	if len(count_data) < 4:
+		return False
+	_copy_bytes(src, dst, struct.unpack('<I', count_data)[0] * record_size)
+	return True
+
+
+def _retarget_ik_frames(src, dst, renamer, report):
+	"""Renames (or drops) the bones of the IK on/off keyframes"""
+	count_data = src.read(4)
+	dst.write(count_data)
+	if len(count_data) < 4:
+		return
+	for frame in range(struct.unpack('<I', count_data)[0]):
+		header = src.read(IK_FRAME_HEADER_SIZE)
+		if len(header) != IK_FRAME_HEADER_SIZE:
+			raise VMDError("Truncated IK keyframes")
+		ik_count = struct.unpack_from('<I', header, 5)[0]
+		states = src.read(ik_count * IK_STATE_SIZE)
+		if len(states) != ik_count * IK_STATE_SIZE:
+			raise VMDError("Truncated IK keyframes")
+		kept = []
+		for i in range(0, len(states), IK_STATE_SIZE):
+			field = states[i:i + IK_NAME_SIZE]
+			action, value = renamer.decide(field)
+			if action == _RENAME:
+				field = value
+				report['ik_renamed'] += 1
+			elif action == _DROP:
+				report['ik_dropped'] += 1
+				continue
+			kept.append(field + states[i + IK_NAME_SIZE:i + IK_STATE_SIZE])
+		dst.write(header[:5] + struct.pack('<I', len(kept)))
+		dst.write(b''.join(kept))
+
+
+def retarget(source, destination, from_map, to_map, drop_unmapped=False, chunk_frames=8192):
+	"""Copies a VMD file renaming its bone and IK keyframes from one bone map to another.
+	Keyframes of bones which are not in from_map are kept unchanged, or dropped with drop_unmapped.
+	Returns a report dict with the keyframe counts and the unmapped bone names."""
+	renamer = _Renamer(from_map, to_map, drop_unmapped)
+	report = {'file': source, 'frames': 0, 'renamed': 0, 'dropped': 0, 'ik_renamed': 0, 'ik_dropped': 0, 'unmapped': {}}
+	buffer = bytearray(BONE_FRAME_SIZE * chunk_frames)
+	view = memoryview(buffer)
+	with open(source, 'rb') as src, open(destination, 'wb') as dst:
+		header, report['model'] = read_header(src)
+		dst.write(header)
+		count_data = src.read(4)
+		if len(count_data) != 4:
+			raise VMDError("Truncated VMD file")
+		count = struct.unpack('<I', count_data)[0]
+		count_offset = dst.tell()
+		dst.write(count_data)
+		remaining = count
+		while remaining > 0:
+			n = min(remaining, chunk_frames)
+			size = n * BONE_FRAME_SIZE
+			if src.readinto(view[:size]) != size:
+				raise VMDError("Truncated bone keyframes")
+			remaining -= n
+			keep_from = 0
+			for i in range(0, size, BONE_FRAME_SIZE):
+				action, value = renamer.decide(bytes(view[i:i + BONE_NAME_SIZE]))
+				if action == _RENAME:
+					view[i:i + BONE_NAME_SIZE] = value
+					report['renamed'] += 1
+				elif action == _DROP:
+					# write the kept records before this one
+					dst.write(view[keep_from:i])
+					keep_from = i + BONE_FRAME_SIZE
+					report['dropped'] += 1
+			dst.write(view[keep_from:size])
+		report['frames'] = count
+		# morph, camera, light and self shadow keyframes are copied unchanged
+		if all(_copy_section(src, dst, size) for size in (MORPH_FRAME_SIZE, CAMERA_FRAME_SIZE, LIGHT_FRAME_SIZE, SELF_SHADOW_FRAME_SIZE)):
+			_retarget_ik_frames(src, dst, renamer, report)
+		shutil.copyfileobj(src, dst, 1024 * 1024)
+		if report['dropped'] > 0:
+			dst.seek(count_offset)
+			dst.write(struct.pack('<I', count - report['dropped']))
+	report['unmapped'] = renamer.unmapped
+	view.release()
+	return report
+
+
+def read_bone_frame_names(filepath):
+	"""Returns {bone name: keyframe count} of a VMD file"""
+	names = {}
+	with open(filepath, 'rb') as f:
+		read_header(f)
+		count = struct.unpack('<I', f.read(4))[0]
+		for i in range(count):
+			record = f.read(BONE_FRAME_SIZE)
+			if len(record) != BONE_FRAME_SIZE:
+				raise VMDError("Truncated bone keyframes")
+			name = decode_name(record[:BONE_NAME_SIZE])
+			names[name] = names.get(name, 0) + 1
+	return names
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="mmd_tools_helper.vmd", description="Rename the bone keyframes of VMD motions between bone maps")
+	parser.add_argument('source', help="source .vmd file")
+	parser.add_argument('destination', help="destination .vmd file (must differ from the source)")
+	parser.add_argument('--rename', nargs=2, required=True, metavar=('FROM', 'TO'), help="bone maps to rename from and to")
+	parser.add_argument('--drop-unmapped', action='store_true', help="drop keyframes of bones which are not in the FROM bone map")
+	options = parser.parse_args(argv)
+	if os.path.abspath(options.source) == os.path.abspath(options.destination):
+		parser.error("source and destination must be different files")
+	try:
+		report = retarget(options.source, options.destination, options.rename[0], options.rename[1], options.drop_unmapped)
+	except (VMDError, OSError, struct.error) as e:
+		print(options.source, "ERROR", e)
+		return 1
+	print("%s -> %s: %d bone keyframes, %d renamed, %d dropped; IK keyframe bones: %d renamed, %d dropped" % (options.source, options.destination, report['frames'], report['renamed'], report['dropped'], report['ik_renamed'], report['ik_dropped']))
+	if report['unmapped']:
+		print("Unmapped bones:", ", ".join("%s (%d)" % (n, c) for n, c in sorted(report['unmapped'].items())))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())